@@ -1,3 +1,14 @@
+import sys
+import time
+STARTED = time.perf_counter()
+if "--profile-startup" in sys.argv[1:]:
+    # Profiles everything up to the first idle landing screen, imports
+    # included, and prints where the time went (see report_startup()).
+    import cProfile
+    startup_profile = cProfile.Profile()
+    startup_profile.enable()
+else:
+    startup_profile = None
 import csv
 import os
 import webbrowser
@@ -7,224 +18,216 @@ import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, filedialog, font as tkfont
 import uuid
 import logging
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet
+import sqlite3
+import threading
+import queue
+import atexit
+import bisect
+import checkout_engine
+from checkout_engine import *
 # ---------- Config ----------
-PRODUCTS_CSV = "products.csv"
-CUSTOMERS_CSV = "customers.csv"
-INVOICES_DIR = "invoices"
-INVOICES_ARCHIVE_DIR = os.path.join(INVOICES_DIR, "archive")
+# Storage and invoice settings live in checkout_engine; the ones changed from
+# the admin panel are assigned there so every writer sees them.
+LAZY_RENDER = False # when True only the CSV is written at checkout
 CHARTS_DIR = "charts"
-GST_DEFAULT = Decimal("18.0") # percent
-CURRENCY_QUANT = Decimal("0.01")
-SHOP_NAME = "Serenia Ltd."
 PASSWORD = "1515"
 ADMIN_PASSWORD = "1234"
-GST_NUMBER = "GSTIN: 27ABCDE1234F1Z5" # Default GST Number
 PROMOTION_TEXT = "No current promotions."
+RENDER_WORKERS = 2
+RENDER_RETRIES = 3
+RENDER_QUEUE_SIZE = 200
+RENDER_POLL_MS = 100
+SCAN_BURST_MS = 40 # scans arriving within this window update the cart together
+EVENT_POLL_MS = 500 # how often open windows pick up changes from the change feed
+STARTUP_TARGET_MS = 300 # --profile-startup flags launches slower than this
+STARTUP_PROFILE_LINES = 25
 # ----------------------------
 # Configure logging
 logging.basicConfig(filename='billing.log', level=logging.WARNING)
-def money(d: Decimal) -> str:
-    return f"{d.quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)}"
-def read_products(path=PRODUCTS_CSV):
-    products = {}
-    if not os.path.exists(path):
-        with open(path, "w", newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"])
-            writer.writerow(["P001", "Sample Product 1", "10.00", "5.00", "100", "10", "General"])
-            writer.writerow(["P002", "Sample Product 2", "20.00", "10.00", "50", "10", "General"])
-            writer.writerow(["P003", "Sample Product 3", "15.75", "7.00", "75", "10", "General"])
-        messagebox.showinfo("Created", f"Sample {path} created. Please edit it and reload.")
-    with open(path, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        expected_headers = ["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"]
-        if not all(h in reader.fieldnames for h in ["code", "name", "price", "stock"]):
-            messagebox.showerror("Error", f"Invalid headers in {path}. Expected at least: code, name, price, stock")
-            return {}
-        for r in reader:
-            code = r.get("code") or r.get("id") or r.get("sku")
-            name = r.get("name") or r.get("product") or ""
-            price = r.get("price") or "0"
-            cost_price = r.get("cost_price") or "0"
-            stock = r.get("stock") or "0"
-            low_threshold = r.get("low_stock_threshold") or "10"
-            category = r.get("category") or "General"
-            if not code:
-                continue
-            try:
-                price_d = Decimal(price)
-                cost_price_d = Decimal(cost_price)
-                stock_i = int(stock)
-                threshold_i = int(low_threshold)
-            except:
-                price_d = Decimal("0")
-                cost_price_d = Decimal("0")
-                stock_i = 0
-                threshold_i = 10
-            products[code] = {"name": name, "price": price_d, "cost_price": cost_price_d, "stock": stock_i, "low_stock_threshold": threshold_i, "category": category}
-    return products
-def read_customers(path=CUSTOMERS_CSV):
-    customers = {}
-    if not os.path.exists(path):
-        with open(path, "w", newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(["id", "name", "phone", "loyalty_points"])
-            writer.writerow(["C001", "Sample Customer", "1234567890", "0"])
-        messagebox.showinfo("Created", f"Sample {path} created. Please edit it and reload.")
-    with open(path, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        if not all(h in reader.fieldnames for h in ["id", "name", "phone"]):
-            messagebox.showerror("Error", f"Invalid headers in {path}. Expected: id, name, phone")
-            return {}
-        for r in reader:
-            id_ = r.get("id")
-            name = r.get("name") or ""
-            phone = r.get("phone") or ""
-            points = r.get("loyalty_points") or "0"
-            if not id_:
-                continue
-            try:
-                points_i = int(points)
-            except:
-                points_i = 0
-            customers[id_] = {"name": name, "phone": phone, "loyalty_points": points_i}
-    return customers
-def ensure_invoices_dir():
-    os.makedirs(INVOICES_DIR, exist_ok=True)
-    os.makedirs(INVOICES_ARCHIVE_DIR, exist_ok=True)
+def show_notice(title, message, error=False):
+    if error:
+        messagebox.showerror(title, message)
+    else:
+        messagebox.showinfo(title, message)
+checkout_engine.notify = show_notice
+def show_stock_conflict(products, conflict):
+    lines = [f"{products[code]['name']} (Code: {code}): {qty} left" if code in products else f"{code}: {qty} left"
+             for code, qty in conflict.shortages.items()]
+    messagebox.showerror("Stock changed", "Another till sold some of these items first:\n" + "\n".join(lines)
+                         + "\n\nAdjust the quantities and try again.")
+# ---------- Change feed ----------
+# One EventFeed per process, read every EVENT_POLL_MS by whichever Tk root is
+# open. Windows follow it through watch_changes until they are closed.
+change_feed = None
+def watch_changes(window, callback, kinds=None):
+    global change_feed
+    if change_feed is None:
+        change_feed = EventFeed()
+    change_feed.subscribe(callback, kinds)
+    def closed(event):
+        if event.widget is window:
+            change_feed.unsubscribe(callback)
+    window.bind("<Destroy>", closed, add="+")
+def poll_changes(root):
+    if change_feed is not None:
+        try:
+            change_feed.poll()
+        except sqlite3.Error as e:
+            logging.warning(f"Change feed poll failed: {e}")
+    root.after(EVENT_POLL_MS, poll_changes, root)
 def ensure_charts_dir():
     os.makedirs(CHARTS_DIR, exist_ok=True)
-def next_invoice_number():
-    ensure_invoices_dir()
-    nums = []
-    for fname in os.listdir(INVOICES_DIR):
-        if fname.startswith("invoice_") and fname.endswith(".csv"):
+def run_with_progress(root, title, work, on_done):
+    # Runs work(progress) on a background thread behind a small progress
+    # window; on_done(result) is called on the Tk thread afterwards.
+    win = tk.Toplevel(root)
+    win.title(title)
+    win.transient(root)
+    label = tk.Label(win, text="Reading invoices...")
+    label.pack(padx=20, pady=(15, 5))
+    bar = ttk.Progressbar(win, length=300, mode="determinate")
+    bar.pack(padx=20, pady=(0, 15))
+    updates = queue.Queue()
+    def progress(done, total):
+        updates.put(("progress", (done, total)))
+    def worker():
+        try:
+            updates.put(("done", work(progress)))
+        except Exception as e:
+            logging.warning(f"{title} failed: {e}")
+            updates.put(("error", e))
+    def poll():
+        try:
+            while True:
+                kind, value = updates.get_nowait()
+                if kind == "progress":
+                    done, total = value
+                    bar["maximum"] = max(total, 1)
+                    bar["value"] = done
+                    label.config(text=f"Reading invoices... {done} of {total}")
+                    continue
+                if win.winfo_exists():
+                    win.destroy()
+                if kind == "error":
+                    messagebox.showerror(title, str(value))
+                else:
+                    on_done(value)
+                return
+        except queue.Empty:
+            pass
+        root.after(RENDER_POLL_MS, poll)
+    threading.Thread(target=worker, name="invoice-scan", daemon=True).start()
+    root.after(RENDER_POLL_MS, poll)
+# ---------- Background invoice rendering ----------
+class RenderJob:
+    def __init__(self, inv_number, invoice_data, on_done=None, root=None):
+        self.inv_number = inv_number
+        self.invoice_data = invoice_data
+        self.on_done = on_done
+        self.root = root
+        self.state = "queued"
+        self.attempts = 0
+        self.error = None
+        self.files = {}
+class InvoiceRenderer:
+    # HTML and PDF documents are rendered on a small pool of worker threads so
+    # checkout only waits for the CSV. Completion callbacks never run on a
+    # worker: finished jobs are handed back through a queue that the owning Tk
+    # root drains with after().
+    formats = (("html", save_invoice_html), ("pdf", save_invoice_pdf))
+    def __init__(self, workers=RENDER_WORKERS, retries=RENDER_RETRIES, maxsize=RENDER_QUEUE_SIZE):
+        self.workers = workers
+        self.retries = retries
+        self.queue = queue.Queue(maxsize)
+        self.completed = queue.Queue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        self.polling = set()
+    def submit(self, inv_number, invoice_data, on_done=None, root=None):
+        snapshot = dict(invoice_data, items=[dict(item) for item in invoice_data["items"]])
+        job = RenderJob(inv_number, snapshot, on_done, root)
+        with self.lock:
+            self.jobs[inv_number] = job
+            if not self.threads:
+                for i in range(self.workers):
+                    t = threading.Thread(target=self._work, name=f"invoice-render-{i}", daemon=True)
+                    t.start()
+                    self.threads.append(t)
+        if root is not None:
+            self._ensure_polling(root)
+        self.queue.put(job)
+        return job
+    def status(self, inv_number):
+        job = self.jobs.get(inv_number)
+        return job.state if job else None
+    def is_pending(self, inv_number):
+        return self.status(inv_number) in ("queued", "running")
+    def pending_jobs(self):
+        with self.lock:
+            return [job for job in self.jobs.values() if job.state in ("queued", "running")]
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending_jobs():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+    def _work(self):
+        while True:
+            job = self.queue.get()
             try:
-                n = int(fname[len("invoice_"):-len(".csv")])
-                nums.append(n)
-            except ValueError:
-                logging.warning(f"Invalid invoice filename: {fname}")
-    return max(nums + [0]) + 1
-def save_invoice_csv(inv_number, invoice_data, filename=None):
-    ensure_invoices_dir()
-    if filename is None:
-        filename = os.path.join(INVOICES_DIR, f"invoice_{inv_number}.csv")
-    with open(filename, "w", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(["shop_name", SHOP_NAME])
-        writer.writerow(["gst_number", GST_NUMBER])
-        writer.writerow(["invoice_number", inv_number])
-        writer.writerow(["date", invoice_data["date"]])
-        writer.writerow(["customer_name", invoice_data.get("customer_name", "")])
-        writer.writerow(["customer_phone", invoice_data.get("customer_phone", "")])
-        writer.writerow(["total_item_count", invoice_data["total_item_count"]])
-        writer.writerow([])
-        writer.writerow(["code", "name", "price", "qty", "total"])
-        for row in invoice_data["items"]:
-            writer.writerow([row["code"], row["name"], money(row["price"]), row["qty"], money(row["line_total"])])
-        writer.writerow([])
-        writer.writerow(["subtotal", money(invoice_data["subtotal"])])
-        writer.writerow(["discount_percent", str(invoice_data["discount_percent"])])
-        writer.writerow(["discount_amount", money(invoice_data["discount_amount"])])
-        writer.writerow(["subtotal_after_discount", money(invoice_data["subtotal_after_discount"])])
-        writer.writerow(["gst_percent", str(invoice_data["gst_percent"])])
-        writer.writerow(["gst_total", money(invoice_data["gst_total"])])
-        writer.writerow(["cgst", money(invoice_data["cgst"])])
-        writer.writerow(["sgst", money(invoice_data["sgst"])])
-        writer.writerow(["grand_total", money(invoice_data["grand_total"])])
-        writer.writerow(["points_awarded", invoice_data.get("points_awarded", 0)])
-        writer.writerow(["payment_status", invoice_data.get("payment_status", "pending")])
-    return filename
-def save_invoice_html(inv_number, invoice_data, filename=None):
-    ensure_invoices_dir()
-    if filename is None:
-        filename = os.path.join(INVOICES_DIR, f"invoice_{inv_number}.html")
-    rows_html = ""
-    for row in invoice_data["items"]:
-        rows_html += f"<tr><td>{row['code']}</td><td>{row['name']}</td><td align='right'>{money(row['price'])}</td><td align='center'>{row['qty']}</td><td align='right'>{money(row['line_total'])}</td></tr>\n"
-    html = f"""
-    <html>
-    <head><meta charset="utf-8"><title>Invoice {inv_number}</title></head>
-    <body>
-    <h1>{SHOP_NAME}</h1>
-    <p>GST Number: {GST_NUMBER}</p>
-    <h2>Invoice #{inv_number}</h2>
-    <p>Date: {invoice_data['date']}</p>
-    <p>Customer: {invoice_data.get('customer_name', '-')} ({invoice_data.get('customer_phone', '-')})</p>
-    <p>Total Item Count: {invoice_data['total_item_count']}</p>
-    <p>Payment Status: {invoice_data.get('payment_status', 'pending').capitalize()}</p>
-    <table border="1" cellspacing="0" cellpadding="6" width="80%">
-      <thead>
-        <tr><th>Code</th><th>Item</th><th>Price</th><th>Qty</th><th>Line Total</th></tr>
-      </thead>
-      <tbody>
-      {rows_html}
-      </tbody>
-    </table>
-    <p>Subtotal: <b>{money(invoice_data['subtotal'])}</b></p>
-    <p>Discount ({invoice_data['discount_percent']}%): <b>{money(invoice_data['discount_amount'])}</b></p>
-    <p>Subtotal after discount: <b>{money(invoice_data['subtotal_after_discount'])}</b></p>
-    <p>GST ({invoice_data['gst_percent']}%): <b>{money(invoice_data['gst_total'])}</b> (CGST {money(invoice_data['cgst'])} + SGST {money(invoice_data['sgst'])})</p>
-    <h3>Grand Total: {money(invoice_data['grand_total'])}</h3>
-    <p>Points Awarded: {invoice_data.get('points_awarded', 0)}</p>
-    <hr>
-    <p>Thank you for your business!</p>
-    </body>
-    </html>
-    """
-    with open(filename, "w", encoding='utf-8') as f:
-        f.write(html)
-    return filename
-def save_invoice_pdf(inv_number, invoice_data, filename=None):
-    ensure_invoices_dir()
-    if filename is None:
-        filename = os.path.join(INVOICES_DIR, f"invoice_{inv_number}.pdf")
-    doc = SimpleDocTemplate(filename, pagesize=A4)
-    elements = []
-    styles = getSampleStyleSheet()
-   
-    elements.append(Paragraph(SHOP_NAME, styles['Title']))
-    elements.append(Paragraph(f"GST Number: {GST_NUMBER}", styles['Normal']))
-    elements.append(Paragraph(f"Invoice #{inv_number}", styles['Heading2']))
-    elements.append(Paragraph(f"Date: {invoice_data['date']}", styles['Normal']))
-    elements.append(Paragraph(f"Customer: {invoice_data.get('customer_name', '-')} ({invoice_data.get('customer_phone', '-')})", styles['Normal']))
-    elements.append(Paragraph(f"Total Item Count: {invoice_data['total_item_count']}", styles['Normal']))
-    elements.append(Paragraph(f"Payment Status: {invoice_data.get('payment_status', 'pending').capitalize()}", styles['Normal']))
-    elements.append(Spacer(1, 12))
-   
-    data = [["Code", "Item", "Price", "Qty", "Line Total"]]
-    for row in invoice_data["items"]:
-        data.append([row["code"], row["name"], money(row["price"]), str(row["qty"]), money(row["line_total"])])
-   
-    table = Table(data)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    elements.append(table)
-    elements.append(Spacer(1, 12))
-   
-    elements.append(Paragraph(f"Subtotal: {money(invoice_data['subtotal'])}", styles['Normal']))
-    elements.append(Paragraph(f"Discount ({invoice_data['discount_percent']}%): {money(invoice_data['discount_amount'])}", styles['Normal']))
-    elements.append(Paragraph(f"Subtotal after discount: {money(invoice_data['subtotal_after_discount'])}", styles['Normal']))
-    elements.append(Paragraph(f"GST ({invoice_data['gst_percent']}%): {money(invoice_data['gst_total'])} (CGST {money(invoice_data['cgst'])} + SGST {money(invoice_data['sgst'])})", styles['Normal']))
-    elements.append(Paragraph(f"<b>Grand Total: {money(invoice_data['grand_total'])}</b>", styles['Heading3']))
-    elements.append(Paragraph(f"Points Awarded: {invoice_data.get('points_awarded', 0)}", styles['Normal']))
-    elements.append(Spacer(1, 12))
-    elements.append(Paragraph("Thank you for your business!", styles['Normal']))
-   
-    doc.build(elements)
-    return filename
+                self._render(job)
+            except Exception as e:
+                job.state = "failed"
+                job.error = e
+                logging.error(f"Rendering invoice {job.inv_number} crashed: {e}")
+            finally:
+                self.queue.task_done()
+            with self.lock:
+                for num in [n for n, j in self.jobs.items() if j.state == "done" and j is not job]:
+                    del self.jobs[num]
+            if job.on_done is not None:
+                self.completed.put(job)
+    def _render(self, job):
+        job.state = "running"
+        while True:
+            job.attempts += 1
+            try:
+                for fmt, render in self.formats:
+                    if fmt not in job.files:
+                        job.files[fmt] = render(job.inv_number, job.invoice_data)
+                job.state = "done"
+                job.error = None
+                return
+            except Exception as e:
+                job.error = e
+                logging.warning(f"Rendering invoice {job.inv_number} failed (attempt {job.attempts}): {e}")
+                if job.attempts >= self.retries:
+                    job.state = "failed"
+                    return
+                time.sleep(0.2 * job.attempts)
+    def _ensure_polling(self, root):
+        if root not in self.polling:
+            self.polling.add(root)
+            root.after(RENDER_POLL_MS, self._poll, root)
+    def _poll(self, root):
+        while True:
+            try:
+                job = self.completed.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                job.on_done(job)
+            except tk.TclError as e:
+                logging.warning(f"Render callback for invoice {job.inv_number} skipped: {e}")
+        try:
+            root.after(RENDER_POLL_MS, self._poll, root)
+        except tk.TclError:
+            self.polling.discard(root)
+invoice_renderer = InvoiceRenderer()
+if not is_pool_worker():
+    atexit.register(invoice_renderer.wait, 60)
 def save_sales_chart(dates, totals, filename=None):
     ensure_charts_dir()
     if filename is None:
@@ -287,20 +290,7 @@ def plot_sales_trend():
     def generate_chart():
         start_date = start_var.get() or "1900-01-01"
         end_date = end_var.get() or "9999-12-31"
-        sales_by_date = {}
-        for fname in sorted(os.listdir(INVOICES_DIR)):
-            if fname.startswith("invoice_") and fname.endswith(".csv"):
-                try:
-                    with open(os.path.join(INVOICES_DIR, fname), newline='', encoding='utf-8') as f:
-                        reader = csv.reader(f)
-                        data = list(reader)
-                        date = data[3][1].split()[0] if len(data) > 3 and len(data[3]) > 1 else ""
-                        total = float(data[-3][1]) if data[-3][0] == "grand_total" and len(data[-3]) > 1 else 0
-                        if date and total and start_date <= date <= end_date:
-                            sales_by_date[date] = sales_by_date.get(date, 0) + total
-                except Exception as e:
-                    logging.warning(f"Error reading {fname}: {e}")
-                    continue
+        sales_by_date = {date: float(total) for date, total in daily_sales_totals(start_date, end_date) if date and total}
         if not sales_by_date:
             messagebox.showwarning("No data", "No valid invoices found for the selected date range.")
             return
@@ -310,6 +300,136 @@ def plot_sales_trend():
         webbrowser.open_new_tab(os.path.abspath(chart_file))
         win.destroy()
     tk.Button(win, text="Generate Chart", command=generate_chart).pack(pady=5)
+# ---------- Virtual list widgets ----------
+class VirtualRowsMixin:
+    # Backing model is a sequence of keys plus a render callback; only the
+    # rows that fit in the widget are materialized. Scrolling moves a window
+    # over the keys instead of letting Tk hold one item per product.
+    def _init_virtual(self, render, scrollbar=None):
+        self.render = render
+        self.keys = []
+        self.top = 0
+        self.scrollbar = scrollbar
+        if scrollbar is not None:
+            scrollbar.configure(command=self.yview_model)
+        self.bind("<MouseWheel>", self._on_wheel)
+        self.bind("<Button-4>", lambda e: self.scroll_rows(-3))
+        self.bind("<Button-5>", lambda e: self.scroll_rows(3))
+        self.bind("<Configure>", lambda e: self.redraw())
+    def set_keys(self, keys):
+        self.keys = keys
+        self.top = max(0, min(self.top, len(keys) - self.visible_rows()))
+        self.redraw()
+    def scroll_rows(self, n):
+        top = max(0, min(self.top + n, len(self.keys) - self.visible_rows()))
+        if top != self.top:
+            self.top = top
+            self.redraw()
+        return "break"
+    def _on_wheel(self, event):
+        return self.scroll_rows(-3 if event.delta > 0 else 3)
+    def yview_model(self, *args):
+        if args[0] == "moveto":
+            self.top = int(float(args[1]) * len(self.keys))
+        elif args[0] == "scroll":
+            step = self.visible_rows() if args[2] == "pages" else 1
+            self.top += int(args[1]) * step
+        self.top = max(0, min(self.top, len(self.keys) - self.visible_rows()))
+        self.redraw()
+    def _update_scrollbar(self):
+        if self.scrollbar is not None:
+            total = max(len(self.keys), 1)
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.visible_rows()) / total))
+    def ensure_visible(self, index):
+        rows = self.visible_rows()
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + rows:
+            self.top = index - rows + 1
+        self.redraw()
+class VirtualListbox(VirtualRowsMixin, tk.Listbox):
+    def __init__(self, master, render=str, scrollbar=None, **kw):
+        super().__init__(master, **kw)
+        self._init_virtual(render, scrollbar)
+        self.selected = None
+        self.bind("<<ListboxSelect>>", self._on_select)
+        self.bind("<Up>", lambda e: self._move_selection(-1))
+        self.bind("<Down>", lambda e: self._move_selection(1))
+    def visible_rows(self):
+        return max(1, int(self.cget("height")))
+    def redraw(self):
+        window = self.keys[self.top:self.top + self.visible_rows()]
+        self.delete(0, tk.END)
+        if window:
+            self.insert(tk.END, *[self.render(key) for key in window])
+        if self.selected is not None and self.top <= self.selected < self.top + len(window):
+            self.selection_set(self.selected - self.top)
+        self._update_scrollbar()
+    def set_keys(self, keys):
+        # The selected key stays selected while it is still listed.
+        key = self.selected_key()
+        self.selected = None
+        if key is not None:
+            try:
+                self.selected = keys.index(key)
+            except ValueError:
+                pass
+        super().set_keys(keys)
+    def _on_select(self, event):
+        sel = tk.Listbox.curselection(self)
+        if sel:
+            self.selected = self.top + sel[0]
+    def _move_selection(self, step):
+        if not self.keys:
+            return "break"
+        index = 0 if self.selected is None else max(0, min(self.selected + step, len(self.keys) - 1))
+        self.selected = index
+        self.ensure_visible(index)
+        return "break"
+    def curselection(self):
+        return () if self.selected is None or self.selected >= len(self.keys) else (self.selected,)
+    def get(self, index, last=None):
+        return self.render(self.keys[index])
+    def selected_key(self):
+        sel = self.curselection()
+        return self.keys[sel[0]] if sel else None
+class VirtualTreeview(VirtualRowsMixin, ttk.Treeview):
+    # Row iids are the model keys, so selection() and item() keep working for
+    # the rows on screen.
+    def __init__(self, master, render, scrollbar=None, **kw):
+        super().__init__(master, **kw)
+        self._init_virtual(render, scrollbar)
+    def visible_rows(self):
+        rowheight = ttk.Style().lookup("Treeview", "rowheight") or 20
+        height = self.winfo_height()
+        if height <= 1:
+            return max(1, int(self.cget("height")))
+        return max(1, (height - 25) // int(rowheight))
+    def redraw(self):
+        window = self.keys[self.top:self.top + self.visible_rows()]
+        selected = self.selection()
+        children = self.get_children()
+        if children:
+            self.delete(*children)
+        for key in window:
+            self.insert("", tk.END, iid=key, values=self.render(key))
+        keep = [iid for iid in selected if self.exists(iid)]
+        if keep:
+            self.selection_set(keep)
+        self._update_scrollbar()
+# ---------- Startup profile ----------
+def report_startup(root, marks):
+    root.update_idletasks()
+    marks.append(("first frame", time.perf_counter()))
+    startup_profile.disable()
+    import pstats
+    last = STARTED
+    for name, at in marks:
+        print(f"{name:<16}{(at - last) * 1000:8.1f} ms")
+        last = at
+    total = (last - STARTED) * 1000
+    print(f"{'interactive':<16}{total:8.1f} ms" + (f"  (over the {STARTUP_TARGET_MS} ms target)" if total > STARTUP_TARGET_MS else ""))
+    pstats.Stats(startup_profile).sort_stats("cumulative").print_stats(STARTUP_PROFILE_LINES)
 class LandingPage(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -462,6 +582,7 @@ class LandingPage(tk.Tk):
         ).pack(side=tk.LEFT, padx=5)
         # Start animations
         self.after(100, self.animate_drop)
+        self.after(EVENT_POLL_MS, poll_changes, self)
     def animate_drop(self):
         current_rely = float(self.frame.place_info()['rely'])
         if current_rely < 0.5:
@@ -521,53 +642,32 @@ class LandingPage(tk.Tk):
         cust_var = tk.StringVar()
         tk.Entry(win, textvariable=cust_var).pack()
         def process_sale():
-            products = read_products()
+            catalog = catalog_snapshot()
             code = code_var.get()
-            prod = products.get(code)
-            if not prod:
+            if code not in catalog:
                 messagebox.showerror("Error", "Product not found.")
                 return
+            products = {code: dict(catalog[code])} # checkout() updates the stock of what it sells
             try:
                 qty = int(qty_var.get())
+                if qty <= 0:
+                    raise ValueError
             except:
                 messagebox.showerror("Error", "Invalid quantity.")
                 return
-            if prod["stock"] < qty:
-                messagebox.showerror("Error", "Insufficient stock.")
+            cart = Cart()
+            error = add_product_to_cart(cart, products, code, qty)
+            if error:
+                messagebox.showerror("Error", f"Insufficient stock. {error}")
+                return
+            try:
+                inv_num, invoice_data, _, _ = checkout(cart, products, customer_name=cust_var.get(), payment_status="paid")
+            except StockConflict as e:
+                show_stock_conflict(products, e)
                 return
-            subtotal = prod["price"] * Decimal(qty)
-            gst_total = subtotal * GST_DEFAULT / Decimal("100")
-            grand_total = subtotal + gst_total
-            inv_num = next_invoice_number()
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            invoice_data = {
-                "date": now,
-                "customer_name": cust_var.get() or "Anonymous",
-                "customer_phone": "",
-                "items": [{"code": code, "name": prod["name"], "price": prod["price"], "qty": qty, "line_total": subtotal}],
-                "subtotal": subtotal,
-                "discount_percent": Decimal("0"),
-                "discount_amount": Decimal("0"),
-                "subtotal_after_discount": subtotal,
-                "gst_percent": GST_DEFAULT,
-                "gst_total": gst_total,
-                "cgst": gst_total / 2,
-                "sgst": gst_total / 2,
-                "grand_total": grand_total,
-                "points_awarded": 0,
-                "payment_status": "paid",
-                "total_item_count": qty
-            }
-            save_invoice_csv(inv_num, invoice_data)
-            save_invoice_html(inv_num, invoice_data)
-            save_invoice_pdf(inv_num, invoice_data)
-            prod["stock"] -= qty
-            with open(PRODUCTS_CSV, "w", newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"])
-                for c, p in products.items():
-                    writer.writerow([c, p["name"], str(p["price"]), str(p["cost_price"]), p["stock"], p["low_stock_threshold"], p["category"]])
-            messagebox.showinfo("Success", f"Quick sale #{inv_num} processed for {grand_total}.")
+            if not LAZY_RENDER:
+                invoice_renderer.submit(inv_num, invoice_data)
+            messagebox.showinfo("Success", f"Quick sale #{inv_num} processed for {money(invoice_data['grand_total'])}.")
             win.destroy()
         tk.Button(win, text="Process Sale", command=process_sale).pack(pady=10)
     def manage_promotion(self):
@@ -577,7 +677,7 @@ class LandingPage(tk.Tk):
             PROMOTION_TEXT = text
             messagebox.showinfo("Updated", f"Promotion updated: {PROMOTION_TEXT}")
     def show_inventory(self):
-        products = read_products()
+        products = catalog_copy()
         if not products:
             messagebox.showinfo("No Products", "No products available.")
             return
@@ -585,67 +685,65 @@ class LandingPage(tk.Tk):
         win.title("Inventory")
         win.geometry("600x400")
         cols = ("code", "name", "price", "stock")
-        tree = ttk.Treeview(win, columns=cols, show="headings")
+        scrollbar = ttk.Scrollbar(win, orient="vertical")
+        tree = VirtualTreeview(win, lambda code: (code, products[code]["name"], money(products[code]["price"]), products[code]["stock"]),
+                               scrollbar, columns=cols, show="headings")
         for c in cols:
             tree.heading(c, text=c.capitalize())
             tree.column(c, anchor="center")
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         tree.pack(fill=tk.BOTH, expand=True)
-        for code, p in sorted(products.items()):
-            tree.insert("", tk.END, values=(code, p["name"], money(p["price"]), p["stock"]))
+        tree.set_keys(sorted(products))
+        watch_changes(win, lambda events: self.apply_product_changes(tree, products, events), ("stock", "product", "catalog"))
+    def apply_product_changes(self, tree, products, events):
+        # Only the rows on screen are redrawn unless products came or went.
+        reloaded, touched = apply_product_events(products, events)
+        if reloaded or len(products) != len(tree.keys) or any(code not in products for code in touched):
+            tree.set_keys(sorted(products))
+        elif touched:
+            tree.redraw()
     def restock_goods(self):
-        products = read_products()
+        products = catalog_copy()
         if not products:
             messagebox.showinfo("No Products", "No products available to restock.")
             return
         win = tk.Toplevel(self)
         win.title("Restock Goods")
         win.geometry("800x500")
-        # Create a frame with scrollbar
-        canvas = tk.Canvas(win)
-        scrollbar = ttk.Scrollbar(win, orient="vertical", command=canvas.yview)
-        scrollable_frame = tk.Frame(canvas)
-        scrollable_frame.bind(
-            "<Configure>",
-            lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
-        )
-        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
+        # Restock quantities entered so far; rows only exist while on screen
+        restock_vars = {}
         cols = ("code", "name", "current_stock", "restock_qty")
-        tree = ttk.Treeview(scrollable_frame, columns=cols, show="headings", height=15)
+        table_frame = tk.Frame(win)
+        table_frame.pack(fill=tk.BOTH, expand=True)
+        scrollbar = ttk.Scrollbar(table_frame, orient="vertical")
+        tree = VirtualTreeview(table_frame, lambda code: (code, products[code]["name"], products[code]["stock"], restock_vars[code].get() if code in restock_vars else "0"),
+                               scrollbar, columns=cols, show="headings", height=15)
         for c in cols:
             tree.heading(c, text=c.replace("_", " ").title())
             tree.column(c, anchor="center", width=150)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        # Dictionary to hold StringVars for restock quantities
-        restock_vars = {}
-        for code, p in sorted(products.items()):
-            tree.insert("", tk.END, values=(code, p["name"], p["stock"], "0"))
-            restock_vars[code] = tk.StringVar(value="0")
+        tree.set_keys(sorted(products))
+        watch_changes(win, lambda events: self.apply_product_changes(tree, products, events), ("stock", "product", "catalog"))
         # Bind double-click to edit restock qty
         tree.bind("<Double-Button-1>", lambda e: self.edit_restock_qty(tree, restock_vars, products))
         def apply_restock():
-            updated = False
+            deltas = {}
             for code, var in restock_vars.items():
                 try:
                     add_stock = int(var.get())
                     if add_stock > 0:
-                        products[code]["stock"] += add_stock
-                        updated = True
+                        deltas[code] = add_stock
                 except ValueError:
                     pass
-            if updated:
-                with open(PRODUCTS_CSV, "w", newline='', encoding='utf-8') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"])
-                    for c, p in products.items():
-                        writer.writerow([c, p["name"], str(p["price"]), str(p["cost_price"]), p["stock"], p["low_stock_threshold"], p["category"]])
-                messagebox.showinfo("Success", "Stock updated and saved to products.csv.")
+            if deltas:
+                for code, qty in apply_stock_changes(deltas).items():
+                    products[code]["stock"] = qty
+                messagebox.showinfo("Success", "Stock updated and saved.")
             else:
                 messagebox.showinfo("No Changes", "No restock amounts entered.")
             win.destroy()
-        tk.Button(scrollable_frame, text="Apply Restock", command=apply_restock, font=("Arial", 12, "bold")).pack(pady=10)
-        canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
+        tk.Button(win, text="Apply Restock", command=apply_restock, font=("Arial", 12, "bold")).pack(pady=10)
     def edit_restock_qty(self, tree, restock_vars, products):
         sel = tree.selection()
         if not sel:
@@ -654,7 +752,7 @@ class LandingPage(tk.Tk):
         code = vals[0]
         new_val = simpledialog.askinteger("Restock", f"Enter restock units for {code}:", initialvalue=int(vals[3]), minvalue=0)
         if new_val is not None:
-            restock_vars[code].set(str(new_val))
+            restock_vars.setdefault(code, tk.StringVar(value="0")).set(str(new_val))
             # Update the tree display
             tree.item(sel[0], values=(vals[0], vals[1], vals[2], new_val))
     def show_about_us(self):
@@ -709,14 +807,22 @@ class BillingApp(tk.Tk):
         super().__init__()
         self.title("Billing Software By Serenia Ltd")
         self.geometry("1800x1000")
-        self.products = read_products()
+        self.products = catalog_copy()
+        self.search_index = ProductSearchIndex(self.products)
+        self.barcodes = read_barcodes()
         self.customers = read_customers()
+        self.customer_index = CustomerIndex(self.customers)
+        self.customer_choices = {}
         if not self.products:
             messagebox.showinfo("No products", f"No products found in {PRODUCTS_CSV}. Please create the file and restart.")
-        self.cart = []
+        self.cart = Cart()
+        self.totals_job = None
+        self.pending_scans = {}
+        self.scan_job = None
         self.gst_percent = GST_DEFAULT
         self.discount_percent = Decimal("0")
         self.latest_invoice = None
+        self.latest_invoice_number = None
         self.is_dark = False
         self.create_ui()
         self.refresh_product_list()
@@ -727,16 +833,57 @@ class BillingApp(tk.Tk):
         self.tree.bind("<s>", lambda e: self.adjust_quantity(-1))
         self.bind("<Control-n>", lambda e: self.add_new_customer())
         self.bind("<Control-m>", lambda e: self.open_admin_mode())
-        self.bind("<Control-p>", lambda e: self.print_invoice() if self.latest_invoice else messagebox.showwarning("No invoice", "Generate an invoice first."))
+        self.bind("<Control-p>", lambda e: self.print_invoice())
         self.bind("<Control-c>", lambda e: self.clear_cart())
         self.bind("<Control-r>", lambda e: self.remove_selected())
         self.bind("<Shift-C>", lambda e: self.open_calculator())
+        watch_changes(self, self.apply_changes)
+        self.after(EVENT_POLL_MS, poll_changes, self)
+    def apply_changes(self, events):
+        # Stock, catalog and customer changes made by admin windows, other
+        # tills or the checkout server. Stock levels and prices only redraw
+        # the rows on screen; the list is rebuilt when products come or go or
+        # their name or category changes what the search matches.
+        before = {key: self.search_fields(key) for kind, key, _ in events if kind == "product"}
+        reloaded, touched = apply_product_events(self.products, events)
+        if reloaded:
+            self.barcodes = read_barcodes()
+            self.search_index.rebuild(self.products)
+        for code in touched:
+            if code in self.products:
+                self.search_index.update(code, self.products[code])
+            else:
+                self.search_index.remove(code)
+        if reloaded or any(self.search_fields(code) != fields for code, fields in before.items()):
+            self.refresh_product_list()
+            self.category_combo['values'] = ["All"] + self.search_index.category_names()
+        elif touched:
+            self.product_listbox.redraw()
+        reloaded, touched = apply_customer_events(self.customers, events)
+        if reloaded:
+            self.customer_index.rebuild(self.customers)
+        for id_ in touched:
+            self.customer_index.update(id_, self.customers[id_])
+        id_ = getattr(self, "selected_customer_id", None)
+        if id_ in self.customers and self.customers[id_]["loyalty_points"] != self.customer_loyalty_points:
+            self.customer_loyalty_points = self.customers[id_]["loyalty_points"]
+            self.loyalty_label.config(text=str(self.customer_loyalty_points))
+            self.update_totals()
     def create_ui(self):
         left = tk.Frame(self)
         left.pack(side=tk.LEFT, fill=tk.Y, padx=10, pady=10)
+        tk.Label(left, text="Scan Barcode / Code:").pack(anchor="w")
+        self.scan_var = tk.StringVar()
+        self.scan_entry = tk.Entry(left, textvariable=self.scan_var)
+        self.scan_entry.pack(anchor="w", fill=tk.X)
+        # Leave the window out of the bind tags: scanned text must not fire the
+        # window shortcuts (Shift-C, Return to generate the invoice, ...).
+        self.scan_entry.bindtags((str(self.scan_entry), "Entry", "all"))
+        self.scan_entry.bind("<Return>", self.on_scan)
+        self.scan_entry.focus_set()
         tk.Label(left, text="Category:").pack(anchor="w")
         self.category_var = tk.StringVar(value="All")
-        categories = ["All"] + sorted(set(p["category"] for p in self.products.values()))
+        categories = ["All"] + self.search_index.category_names()
         self.category_combo = ttk.Combobox(left, textvariable=self.category_var, values=categories)
         self.category_combo.pack(anchor="w", fill=tk.X)
         self.category_var.trace("w", self.filter_products)
@@ -745,7 +892,7 @@ class BillingApp(tk.Tk):
         self.search_var.trace("w", self.filter_products)
         tk.Entry(left, textvariable=self.search_var).pack(anchor="w", fill=tk.X)
         tk.Label(left, text="Products").pack(anchor="w", pady=(10, 0))
-        self.product_listbox = tk.Listbox(left, width=40, height=20)
+        self.product_listbox = VirtualListbox(left, render=self.product_line, width=40, height=20)
         self.product_listbox.pack()
         self.product_listbox.bind("<Double-Button-1>", lambda e: self.add_selected_product())
         qty_frame = tk.Frame(left)
@@ -780,7 +927,7 @@ class BillingApp(tk.Tk):
         bottom.pack(fill=tk.X, pady=8)
         tk.Label(bottom, text="Customer:").grid(row=0, column=0, sticky="e")
         self.customer_var = tk.StringVar()
-        self.customer_entry = ttk.Combobox(bottom, textvariable=self.customer_var, values=[c["name"] for c in self.customers.values()])
+        self.customer_entry = ttk.Combobox(bottom, textvariable=self.customer_var, values=self.customer_matches(""))
         self.customer_entry.grid(row=0, column=1, sticky="w")
         self.customer_entry.bind("<KeyRelease>", self.filter_customers)
         self.customer_entry.bind("<<ComboboxSelected>>", self.update_customer_info)
@@ -847,37 +994,47 @@ class BillingApp(tk.Tk):
             return 0 <= perc <= 100
         except:
             return False
+    def product_line(self, code):
+        p = self.products[code]
+        low_stock = " (LOW STOCK)" if p["stock"] < p["low_stock_threshold"] else ""
+        return f"{code} | {p['name']} | {money(p['price'])} | Stock: {p['stock']}{low_stock}"
     def filter_products(self, *args):
-        search = self.search_var.get().lower()
-        category = self.category_var.get()
-        self.product_listbox.delete(0, tk.END)
-        for code, p in sorted(self.products.items()):
-            if (category == "All" or p["category"] == category) and (search in code.lower() or search in p["name"].lower()):
-                low_stock = " (LOW STOCK)" if p["stock"] < p["low_stock_threshold"] else ""
-                self.product_listbox.insert(tk.END, f"{code} | {p['name']} | {money(p['price'])} | Stock: {p['stock']}{low_stock}")
+        self.product_listbox.set_keys(self.search_index.search(self.search_var.get(), self.category_var.get()))
     def refresh_product_list(self):
-        self.product_listbox.delete(0, tk.END)
-        for code, p in sorted(self.products.items()):
-            low_stock = " (LOW STOCK)" if p["stock"] < p["low_stock_threshold"] else ""
-            self.product_listbox.insert(tk.END, f"{code} | {p['name']} | {money(p['price'])} | Stock: {p['stock']}{low_stock}")
+        self.filter_products()
+    def search_fields(self, code):
+        p = self.products.get(code)
+        return (p["name"], p["category"]) if p else None
+    def customer_label(self, id_):
+        c = self.customers[id_]
+        return f"{c['name']} ({c['phone']}) [{id_}]" if c["phone"] else f"{c['name']} [{id_}]"
+    def customer_matches(self, query):
+        # Labels carry the ID so that customers sharing a name stay distinct.
+        self.customer_choices = {self.customer_label(id_): id_ for id_ in self.customer_index.search(query)}
+        return list(self.customer_choices)
+    def find_customer(self, text):
+        text = text.strip()
+        if text in self.customer_choices:
+            return self.customer_choices[text]
+        for ids in (self.customer_index.by_name(text), self.customer_index.by_phone(text)):
+            if len(ids) == 1:
+                return ids[0]
+        return text if text in self.customers else None
     def filter_customers(self, event):
-        search = self.customer_var.get().lower()
-        if not search:
-            self.customer_entry['values'] = [c["name"] for c in self.customers.values()]
-        else:
-            filtered = [c["name"] for c in self.customers.values() if search in c["name"].lower()]
-            self.customer_entry['values'] = filtered
+        if event.keysym in ("Up", "Down", "Return", "Escape", "Tab"):
+            return
+        self.customer_entry['values'] = self.customer_matches(self.customer_var.get())
         self.customer_entry.event_generate("<Down>")
+    def customers_changed(self, id_):
+        self.customer_index.update(id_, self.customers[id_])
+        self.customer_entry['values'] = self.customer_matches(self.customer_var.get())
     def add_selected_product(self):
         sel = self.product_listbox.curselection()
         if not sel:
             messagebox.showwarning("Select product", "Please select a product from the list (double-click works).")
             return
-        idx = sel[0]
-        line = self.product_listbox.get(idx)
-        code = line.split("|")[0].strip()
-        prod = self.products.get(code)
-        if not prod:
+        code = self.product_listbox.selected_key()
+        if code not in self.products:
             return
         try:
             qty = int(self.qty_var.get())
@@ -887,26 +1044,44 @@ class BillingApp(tk.Tk):
         if qty <= 0:
             messagebox.showwarning("Quantity", "Enter quantity >= 1")
             return
-        if prod["stock"] < qty:
-            messagebox.showwarning("Stock", f"Only {prod['stock']} units of {prod['name']} available.")
+        error = self.add_to_cart(code, qty)
+        if error:
+            messagebox.showwarning("Stock", error)
             return
-        price = prod["price"]
-        line_total = (price * Decimal(qty)).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-        found = False
-        for item in self.cart:
-            if item["code"] == code:
-                new_qty = item["qty"] + qty
-                if new_qty > prod["stock"]:
-                    messagebox.showwarning("Stock", f"Cannot add {new_qty} units of {prod['name']}. Only {prod['stock']} available.")
-                    return
-                item["qty"] = new_qty
-                item["line_total"] = (item["price"] * Decimal(item["qty"])).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-                found = True
-                break
-        if not found:
-            self.cart.append({"code": code, "name": prod["name"], "price": price, "qty": qty, "line_total": line_total})
         self.refresh_cart()
         self.update_totals()
+    def add_to_cart(self, code, qty):
+        return add_product_to_cart(self.cart, self.products, code, qty)
+    def resolve_scan(self, scanned):
+        code = scanned if scanned in self.products else self.barcodes.get(scanned)
+        return code if code in self.products else None
+    def on_scan(self, event=None):
+        # A scanner types the code and Enter. Scans are only queued here and
+        # applied together once the burst is over, so the cart tree and the
+        # totals are redrawn once per burst instead of once per scan.
+        scanned = self.scan_var.get().strip()
+        self.scan_var.set("")
+        if scanned:
+            self.pending_scans[scanned] = self.pending_scans.get(scanned, 0) + 1
+            if self.scan_job is not None:
+                self.after_cancel(self.scan_job)
+            self.scan_job = self.after(SCAN_BURST_MS, self.flush_scans)
+    def flush_scans(self):
+        self.scan_job = None
+        scans, self.pending_scans = self.pending_scans, {}
+        problems = []
+        for scanned, qty in scans.items():
+            code = self.resolve_scan(scanned)
+            if code is None:
+                problems.append(f"Unknown barcode: {scanned}")
+                continue
+            error = self.add_to_cart(code, qty)
+            if error:
+                problems.append(error)
+        self.refresh_cart()
+        self.update_totals()
+        if problems:
+            messagebox.showwarning("Scan", "\n".join(problems))
     def add_custom_item(self):
         name = simpledialog.askstring("Custom Item", "Enter item name:")
         if not name:
@@ -928,31 +1103,35 @@ class BillingApp(tk.Tk):
             messagebox.showwarning("Invalid Quantity", "Enter a valid positive quantity.")
             return
         code = f"CUSTOM_{uuid.uuid4().hex[:8].upper()}" # Unique code for custom item
-        line_total = (price * Decimal(qty)).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-        self.cart.append({"code": code, "name": name, "price": price, "qty": qty, "line_total": line_total})
+        self.cart.add(code, name, price, qty)
         self.refresh_cart()
         self.update_totals()
     def refresh_cart(self):
-        for i in self.tree.get_children():
-            self.tree.delete(i)
-        for item in self.cart:
-            self.tree.insert("", tk.END, values=(item["code"], item["name"], money(item["price"]), item["qty"], money(item["line_total"])))
+        # Row-level diff against what the tree shows; iids are item codes.
+        shown = set(self.tree.get_children())
+        for index, (code, item) in enumerate(self.cart.items()):
+            values = (code, item["name"], money(item["price"]), item["qty"], money(item["line_total"]))
+            if code in shown:
+                shown.discard(code)
+                if tuple(str(v) for v in self.tree.item(code, "values")) != tuple(str(v) for v in values):
+                    self.tree.item(code, values=values)
+                if self.tree.index(code) != index:
+                    self.tree.move(code, "", index)
+            else:
+                self.tree.insert("", index, iid=code, values=values)
+        if shown:
+            self.tree.delete(*shown)
     def remove_selected(self):
         sel = self.tree.selection()
         if not sel:
             return
-        for s in sel:
-            vals = self.tree.item(s, "values")
-            code = vals[0]
-            for i, it in enumerate(self.cart):
-                if it["code"] == code:
-                    del self.cart[i]
-                    break
+        for code in sel:
+            self.cart.remove(code)
         self.refresh_cart()
         self.update_totals()
     def clear_cart(self):
         if messagebox.askyesno("Clear", "Clear the cart?"):
-            self.cart = []
+            self.cart.clear()
             self.refresh_cart()
             self.update_totals()
     def adjust_quantity(self, delta):
@@ -960,44 +1139,41 @@ class BillingApp(tk.Tk):
         if not sel:
             messagebox.showwarning("Select item", "Please select a cart item to adjust quantity.")
             return
-        vals = self.tree.item(sel[0], "values")
-        code = vals[0]
-        for item in self.cart:
-            if item["code"] == code:
-                new_qty = item["qty"] + delta
-                if new_qty < 1:
-                    messagebox.showwarning("Quantity", "Quantity cannot be less than 1.")
-                    return
-                if 'CUSTOM_' not in code and new_qty > self.products[code]["stock"]:
-                    messagebox.showwarning("Stock", f"Cannot set {new_qty} units of {self.products[code]['name']}. Only {self.products[code]['stock']} available.")
-                    return
-                item["qty"] = new_qty
-                item["line_total"] = (item["price"] * Decimal(new_qty)).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-                break
+        code = sel[0]
+        item = self.cart.get(code)
+        if item:
+            new_qty = item["qty"] + delta
+            if new_qty < 1:
+                messagebox.showwarning("Quantity", "Quantity cannot be less than 1.")
+                return
+            if 'CUSTOM_' not in code and new_qty > self.products[code]["stock"]:
+                messagebox.showwarning("Stock", f"Cannot set {new_qty} units of {self.products[code]['name']}. Only {self.products[code]['stock']} available.")
+                return
+            self.cart.set_qty(code, new_qty)
         self.refresh_cart()
         self.update_totals()
     def update_customer_info(self, event):
-        customer_name = self.customer_var.get().strip()
+        id_ = self.find_customer(self.customer_var.get())
         self.selected_customer_id = None
         self.customer_phone = ""
         self.customer_loyalty_points = 0
         self.phone_label.config(text="")
         self.loyalty_label.config(text="")
-        for id_, c in self.customers.items():
-            if c["name"] == customer_name:
-                self.selected_customer_id = id_
-                self.customer_phone = c["phone"]
-                self.customer_loyalty_points = c["loyalty_points"]
-                self.phone_label.config(text=self.customer_phone)
-                self.loyalty_label.config(text=str(self.customer_loyalty_points))
-                break
+        if id_ is not None:
+            c = self.customers[id_]
+            self.selected_customer_id = id_
+            self.customer_phone = c["phone"]
+            self.customer_loyalty_points = c["loyalty_points"]
+            self.customer_var.set(c["name"])
+            self.phone_label.config(text=self.customer_phone)
+            self.loyalty_label.config(text=str(self.customer_loyalty_points))
         self.update_totals()
     def update_totals(self):
-        subtotal = Decimal("0")
-        total_items = 0
-        for it in self.cart:
-            subtotal += it["line_total"]
-            total_items += it["qty"]
+        # Changes only mark the totals stale; the labels are redrawn once when
+        # Tk goes idle, however many cart changes happened before that.
+        if self.totals_job is None:
+            self.totals_job = self.after_idle(self.refresh_totals)
+    def compute_totals(self):
         try:
             gst_percent = Decimal(self.gst_var.get())
             if gst_percent < 0:
@@ -1012,84 +1188,48 @@ class BillingApp(tk.Tk):
         except:
             discount_percent = Decimal("0")
             self.discount_var.set("0")
-        # Loyalty enhancement: 10% discount if points >= 100
-        loyalty_discount = Decimal("0")
-        if hasattr(self, 'customer_loyalty_points') and self.customer_loyalty_points >= 100:
-            loyalty_discount = Decimal("10")
-        total_discount_percent = discount_percent + loyalty_discount
-        discount_amount = (subtotal * total_discount_percent / Decimal("100")).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-        subtotal_after_discount = (subtotal - discount_amount).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-        gst_total = (subtotal_after_discount * gst_percent / Decimal("100")).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-        cgst = (gst_total / 2).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-        sgst = (gst_total - cgst).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-        grand_total = (subtotal_after_discount + gst_total).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-        self.subtotal = subtotal
-        self.discount_amount = discount_amount
-        self.subtotal_after_discount = subtotal_after_discount
-        self.gst_total = gst_total
-        self.cgst = cgst
-        self.sgst = sgst
-        self.grand_total = grand_total
-        self.total_item_count = total_items
-        self.subtotal_label.config(text=f"Subtotal: {money(subtotal)} (Discount: {money(discount_amount)})")
-        self.gst_label.config(text=f"GST ({gst_percent}%): {money(gst_total)} (CGST {money(cgst)} + SGST {money(sgst)})")
-        self.item_count_label.config(text=f"Total Items: {total_items}")
-        self.grand_label.config(text=f"Grand Total: {money(grand_total)}")
+        totals = self.cart.totals(gst_percent, discount_percent + loyalty_discount(getattr(self, "customer_loyalty_points", 0)))
+        for name, value in totals.items():
+            setattr(self, name, value)
+        return gst_percent, discount_percent
+    def refresh_totals(self):
+        self.totals_job = None
+        gst_percent, _ = self.compute_totals()
+        self.subtotal_label.config(text=f"Subtotal: {money(self.subtotal)} (Discount: {money(self.discount_amount)})")
+        self.gst_label.config(text=f"GST ({gst_percent}%): {money(self.gst_total)} (CGST {money(self.cgst)} + SGST {money(self.sgst)})")
+        self.item_count_label.config(text=f"Total Items: {self.total_item_count}")
+        self.grand_label.config(text=f"Grand Total: {money(self.grand_total)}")
     def generate_invoice(self):
         if not self.cart:
             messagebox.showwarning("Empty cart", "Add items before generating an invoice.")
             return
-        inv_num = next_invoice_number()
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        customer_name = self.customer_var.get().strip() or "Anonymous"
-        customer_phone = getattr(self, "customer_phone", "")
-        points_awarded = 0
-        if hasattr(self, "selected_customer_id") and self.selected_customer_id:
-            points_awarded = int(self.grand_total // Decimal(10))
-            self.customers[self.selected_customer_id]["loyalty_points"] += points_awarded
-            self.save_customers()
-            self.loyalty_label.config(text=str(self.customers[self.selected_customer_id]["loyalty_points"]))
-        invoice_data = {
-            "date": now,
-            "customer_name": customer_name,
-            "customer_phone": customer_phone,
-            "items": self.cart,
-            "subtotal": self.subtotal,
-            "discount_percent": Decimal(self.discount_var.get()),
-            "discount_amount": self.discount_amount,
-            "subtotal_after_discount": self.subtotal_after_discount,
-            "gst_percent": Decimal(self.gst_var.get()),
-            "gst_total": self.gst_total,
-            "cgst": self.cgst,
-            "sgst": self.sgst,
-            "grand_total": self.grand_total,
-            "points_awarded": points_awarded,
-            "payment_status": "pending",
-            "total_item_count": self.total_item_count
-        }
-        low_stock_alerts = []
-        for item in self.cart:
-            if "CUSTOM_" in item["code"]:
-                continue # No stock for custom items
-            code = item["code"]
-            self.products[code]["stock"] -= item["qty"]
-            if self.products[code]["stock"] < self.products[code]["low_stock_threshold"]:
-                low_stock_alerts.append(f"{self.products[code]['name']} (Code: {code}) is low on stock: {self.products[code]['stock']} left.")
-        with open(PRODUCTS_CSV, "w", newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"])
-            for c, p in self.products.items():
-                writer.writerow([c, p["name"], str(p["price"]), str(p["cost_price"]), p["stock"], p["low_stock_threshold"], p["category"]])
+        gst_percent, discount_percent = self.compute_totals() # the label refresh may still be pending
+        customer_id = getattr(self, "selected_customer_id", None) or ""
+        try:
+            inv_num, invoice_data, csvfile, levels = checkout(self.cart, self.products, self.customers, customer_id, self.customer_var.get().strip(),
+                                                              gst_percent, discount_percent)
+        except StockConflict as e:
+            for code, qty in e.shortages.items():
+                if code in self.products:
+                    self.products[code]["stock"] = qty
+            self.refresh_product_list()
+            show_stock_conflict(self.products, e)
+            return
+        if customer_id:
+            self.loyalty_label.config(text=str(self.customers[customer_id]["loyalty_points"]))
         self.refresh_product_list()
-        if low_stock_alerts:
-            messagebox.showwarning("Low Stock Alert", "\n".join(low_stock_alerts))
-        csvfile = save_invoice_csv(inv_num, invoice_data)
-        htmlfile = save_invoice_html(inv_num, invoice_data)
-        pdffile = save_invoice_pdf(inv_num, invoice_data)
-        self.latest_invoice = htmlfile
-        messagebox.showinfo("Saved", f"Invoice #{inv_num} saved.\nCSV: {csvfile}\nHTML: {htmlfile}\nPDF: {pdffile}")
-        webbrowser.open_new_tab(os.path.abspath(htmlfile))
-        self.cart = []
+        alerts = low_stock_alerts(self.products, levels)
+        if alerts:
+            messagebox.showwarning("Low Stock Alert", "\n".join(alerts))
+        self.latest_invoice_number = inv_num
+        if LAZY_RENDER:
+            self.latest_invoice = None
+            messagebox.showinfo("Saved", f"Invoice #{inv_num} saved.\nCSV: {csvfile}\nHTML and PDF will be rendered when first opened.")
+        else:
+            invoice_renderer.submit(inv_num, invoice_data, on_done=self.on_invoice_rendered, root=self)
+            self.latest_invoice = os.path.join(INVOICES_DIR, f"invoice_{inv_num}.html")
+            messagebox.showinfo("Saved", f"Invoice #{inv_num} saved.\nCSV: {csvfile}\nHTML and PDF are being rendered in the background.")
+        self.cart.clear()
         self.customer_var.set("")
         self.selected_customer_id = None
         self.customer_phone = ""
@@ -1097,7 +1237,21 @@ class BillingApp(tk.Tk):
         self.loyalty_label.config(text="")
         self.refresh_cart()
         self.update_totals()
+    def on_invoice_rendered(self, job):
+        if job.state == "failed":
+            messagebox.showerror("Render failed", f"Invoice #{job.inv_number} could not be rendered after {job.attempts} attempts: {job.error}")
+            return
+        webbrowser.open_new_tab(os.path.abspath(job.files["html"]))
     def print_invoice(self):
+        if self.latest_invoice_number is not None and invoice_renderer.is_pending(self.latest_invoice_number):
+            messagebox.showinfo("Rendering", f"Invoice #{self.latest_invoice_number} is still being rendered. Try again in a moment.")
+            return
+        if self.latest_invoice_number is not None and not (self.latest_invoice and os.path.exists(self.latest_invoice)):
+            try:
+                self.latest_invoice = invoice_document_path(self.latest_invoice_number)
+            except Exception as e:
+                messagebox.showerror("Error", f"Could not render invoice #{self.latest_invoice_number}: {e}")
+                return
         if not self.latest_invoice or not os.path.exists(self.latest_invoice):
             messagebox.showwarning("No invoice", "Generate an invoice first.")
             return
@@ -1112,31 +1266,40 @@ class BillingApp(tk.Tk):
         with open(path, "w", newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(["code", "name", "price", "qty", "total"])
-            for it in self.cart:
+            for it in self.cart.values():
                 writer.writerow([it["code"], it["name"], money(it["price"]), it["qty"], money(it["line_total"])])
         messagebox.showinfo("Exported", f"Cart exported to {path}")
-    def export_invoice_summary(self):
-        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+    def invoice_scan_pending(self, retry, index=False, facts=False, history=False):
+        # Full scans (first index build, rollup backfill, history compaction)
+        # run in the background behind a progress window; retry() is called
+        # once they are done.
+        scan_index = index and not invoice_index_is_current()
+        scan_facts = facts and not sales_facts_ready()
+        scan_history = history and not history_is_current()
+        if not (scan_index or scan_facts or scan_history):
+            return False
+        products = dict(self.products)
+        customers = dict(self.customers)
+        def work(progress):
+            if scan_facts:
+                backfill_sales_facts(products, progress, customers)
+            if scan_index:
+                sync_invoice_index(progress=progress)
+            if scan_history:
+                compact_sales_history(products, progress)
+        run_with_progress(self, "Reading invoices", work, lambda result: retry())
+        return True
+    def export_invoice_summary(self, path=None, scanned=False):
+        path = path or filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
         if not path:
             return
+        if not scanned and self.invoice_scan_pending(lambda: self.export_invoice_summary(path, scanned=True), index=True):
+            return
         with open(path, "w", newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(["Invoice #", "Date", "Customer", "Total", "Payment Status"])
-            for fname in sorted(os.listdir(INVOICES_DIR)):
-                if fname.startswith("invoice_") and fname.endswith(".csv"):
-                    try:
-                        with open(os.path.join(INVOICES_DIR, fname), newline='', encoding='utf-8') as f_csv:
-                            reader = csv.reader(f_csv)
-                            data = list(reader)
-                            invoice_dict = dict(row for row in data if len(row) == 2 and row[0])
-                            num = fname.split("_")[1].split(".")[0]
-                            date = invoice_dict.get("date", "")
-                            customer = invoice_dict.get("customer_name", "")
-                            total = invoice_dict.get("grand_total", "0")
-                            status = invoice_dict.get("payment_status", "pending")
-                            writer.writerow([num, date, customer, total, status])
-                    except Exception as e:
-                        logging.warning(f"Error reading {fname}: {e}")
+            for num, date, customer, total, status, _, _ in invoice_index_rows(sync=False):
+                writer.writerow([num, date, customer, total or "0", status])
         messagebox.showinfo("Exported", f"Invoice summary exported to {path}")
     def open_invoices_folder(self):
         ensure_invoices_dir()
@@ -1155,12 +1318,13 @@ class BillingApp(tk.Tk):
         try:
             with open(path, newline='', encoding='utf-8') as src:
                 txt = src.read()
-            with open(PRODUCTS_CSV, "w", newline='', encoding='utf-8') as dst:
+            with products_file_lock, atomic_open(PRODUCTS_CSV) as dst:
                 dst.write(txt)
-            self.products = read_products()
+            self.products = catalog_copy()
+            self.barcodes = read_barcodes()
+            self.search_index.rebuild(self.products)
             self.refresh_product_list()
-            categories = ["All"] + sorted(set(p["category"] for p in self.products.values()))
-            self.category_combo['values'] = categories
+            self.category_combo['values'] = ["All"] + self.search_index.category_names()
             messagebox.showinfo("Loaded", f"Products loaded from {path} into {PRODUCTS_CSV}")
         except Exception as e:
             messagebox.showerror("Error", str(e))
@@ -1173,6 +1337,9 @@ class BillingApp(tk.Tk):
                 src = os.path.join(INVOICES_DIR, fname)
                 dst = os.path.join(INVOICES_ARCHIVE_DIR, fname)
                 os.rename(src, dst)
+        clear_invoice_index()
+        clear_sales_facts()
+        reset_invoice_number()
         messagebox.showinfo("Reset", "Invoices archived. Next invoice number is 1.")
     def show_invoice_history(self, for_return=False):
         win = tk.Toplevel(self)
@@ -1186,26 +1353,34 @@ class BillingApp(tk.Tk):
         tree.heading("total", text="Total")
         tree.heading("status", text="Payment Status")
         tree.pack(fill=tk.BOTH, expand=True)
-        invoices = []
-        for fname in os.listdir(INVOICES_DIR):
-            if fname.startswith("invoice_") and fname.endswith(".csv"):
-                try:
-                    with open(os.path.join(INVOICES_DIR, fname), newline='', encoding='utf-8') as f:
-                        reader = csv.reader(f)
-                        data = list(reader)
-                        invoice_dict = dict(row for row in data if len(row) == 2 and row[0])
-                        date = invoice_dict.get("date", "")
-                        customer = invoice_dict.get("customer_name", "")
-                        total = invoice_dict.get("grand_total", "")
-                        status = invoice_dict.get("payment_status", "pending")
-                        num = fname.split("_")[1].split(".")[0]
-                        invoices.append((num, date, customer, total, status, fname))
-                except Exception as e:
-                    logging.warning(f"Error reading {fname}: {e}")
+        files = {}
+        def load(scanned=False):
+            # New or edited invoice files are read in the background, not
+            # here on the Tk thread.
+            if not scanned and self.invoice_scan_pending(lambda: load(scanned=True), index=True):
+                return
+            if not tree.winfo_exists():
+                return
+            tree.delete(*tree.get_children())
+            files.clear()
+            invoices = [(str(num), date, customer, total, status, fname) for num, date, customer, total, status, _, fname in invoice_index_rows(sync=False)]
+            invoices.sort(key=lambda x: x[1] if x[1] else "0")
+            for num, date, customer, total, status, fname in invoices:
+                tree.insert("", tk.END, iid=num, values=(num, date, customer, total, status))
+                files[num] = fname
+        load()
+        def apply_changes(events):
+            # New invoices are the latest, so they go at the end.
+            for _, key, data in events:
+                if data is None: # index cleared, or missed events
+                    load()
                     continue
-        invoices.sort(key=lambda x: x[1] if x[1] else "0")
-        for num, date, customer, total, status, _ in invoices:
-            tree.insert("", tk.END, values=(num, date, customer, total, status))
+                date, customer, total, status, _, files[key] = data
+                if tree.exists(key):
+                    tree.item(key, values=(key, date, customer, total, status))
+                else:
+                    tree.insert("", tk.END, iid=key, values=(key, date, customer, total, status))
+        watch_changes(win, apply_changes, ("invoice",))
         if not for_return:
             tree.bind("<Double-Button-1>", lambda e: self.open_selected_invoice(tree))
         def change_status():
@@ -1220,15 +1395,7 @@ class BillingApp(tk.Tk):
             if new_status:
                 csvfile = os.path.join(INVOICES_DIR, f"invoice_{num}.csv")
                 if os.path.exists(csvfile):
-                    with open(csvfile, newline='', encoding='utf-8') as f:
-                        data = list(csv.reader(f))
-                    for row in data:
-                        if row and row[0] == "payment_status":
-                            row[1] = new_status
-                            break
-                    with open(csvfile, "w", newline='', encoding='utf-8') as f:
-                        writer = csv.writer(f)
-                        writer.writerows(data)
+                    update_invoice_status(csvfile, new_status)
                     messagebox.showinfo("Updated", f"Payment status for Invoice #{num} updated to {new_status}.")
                     tree.item(sel[0], values=(num, vals[1], vals[2], vals[3], new_status))
         tk.Button(win, text="Change Payment Status", command=change_status).pack(pady=5)
@@ -1238,7 +1405,7 @@ class BillingApp(tk.Tk):
                 if sel:
                     vals = tree.item(sel[0], "values")
                     num = vals[0]
-                    fname = next((inv[5] for inv in invoices if inv[0] == num), None)
+                    fname = files.get(num)
                     if fname:
                         self.show_return_items(os.path.join(INVOICES_DIR, fname))
                         win.destroy()
@@ -1248,8 +1415,15 @@ class BillingApp(tk.Tk):
         sel = tree.selection()
         if sel:
             num = tree.item(sel[0], "values")[0]
-            htmlfile = os.path.join(INVOICES_DIR, f"invoice_{num}.html")
-            if os.path.exists(htmlfile):
+            if invoice_renderer.is_pending(int(num)):
+                messagebox.showinfo("Rendering", f"Invoice #{num} is still being rendered. Try again in a moment.")
+                return
+            try:
+                htmlfile = invoice_document_path(num)
+            except Exception as e:
+                messagebox.showerror("Error", f"Could not render invoice #{num}: {e}")
+                return
+            if htmlfile:
                 webbrowser.open_new_tab(os.path.abspath(htmlfile))
     def open_admin_mode(self):
         password = simpledialog.askstring("Admin Login", "Enter password:", show="*")
@@ -1273,13 +1447,12 @@ class BillingApp(tk.Tk):
         # GST Number Management at top left
         gst_frame = tk.LabelFrame(scrollable_frame, text="GST Number Management", font=("Arial", 12, "bold"))
         gst_frame.pack(fill=tk.X, padx=10, pady=5)
-        tk.Label(gst_frame, text=f"Current GST Number: {GST_NUMBER}").pack(anchor="w")
-        gst_var = tk.StringVar(value=GST_NUMBER)
+        tk.Label(gst_frame, text=f"Current GST Number: {checkout_engine.GST_NUMBER}").pack(anchor="w")
+        gst_var = tk.StringVar(value=checkout_engine.GST_NUMBER)
         gst_entry = tk.Entry(gst_frame, textvariable=gst_var, width=50)
         gst_entry.pack(pady=5)
         def save_gst():
-            global GST_NUMBER
-            GST_NUMBER = gst_var.get()
+            checkout_engine.GST_NUMBER = gst_var.get()
             messagebox.showinfo("Success", "GST Number updated.")
         tk.Button(gst_frame, text="Update GST Number", command=save_gst).pack(pady=5)
         # Password Management
@@ -1303,16 +1476,37 @@ class BillingApp(tk.Tk):
             ADMIN_PASSWORD = admin_pw_var.get()
             messagebox.showinfo("Success", "Admin Password updated.")
         tk.Button(pw_frame, text="Update Admin Password", command=save_admin_pw).pack(pady=5)
+        # Invoice Document Rendering
+        render_frame = tk.LabelFrame(scrollable_frame, text="Invoice Documents", font=("Arial", 12, "bold"))
+        render_frame.pack(fill=tk.X, padx=10, pady=5)
+        lazy_var = tk.BooleanVar(value=LAZY_RENDER)
+        def save_render_mode():
+            global LAZY_RENDER
+            LAZY_RENDER = lazy_var.get()
+            messagebox.showinfo("Success", "HTML/PDF will be rendered when first opened." if LAZY_RENDER else "HTML/PDF will be rendered at checkout.")
+        tk.Checkbutton(render_frame, text="Render HTML/PDF only when opened (CSV only at checkout)", variable=lazy_var, command=save_render_mode).pack(anchor="w")
+        # Sales Rollups
+        rollup_frame = tk.LabelFrame(scrollable_frame, text="Sales Reports", font=("Arial", 12, "bold"))
+        rollup_frame.pack(fill=tk.X, padx=10, pady=5)
+        def rebuild_rollups():
+            products, customers = dict(self.products), dict(self.customers)
+            run_with_progress(win, "Rebuilding Sales Rollups", lambda progress: backfill_sales_facts(products, progress, customers),
+                              lambda count: messagebox.showinfo("Success", f"Sales rollups rebuilt from {count} invoice and return files."))
+        tk.Button(rollup_frame, text="Rebuild Sales Rollups from Invoices", command=rebuild_rollups).pack(pady=5)
+        def compact_history():
+            products = dict(self.products)
+            run_with_progress(win, "Compacting Sales History", lambda progress: compact_sales_history(products, progress),
+                              lambda months: messagebox.showinfo("Success", f"Sales history compacted ({len(months)} months rebuilt)."))
+        tk.Button(rollup_frame, text="Compact Sales History", command=compact_history).pack(pady=5)
         # Company Name Management
         company_frame = tk.LabelFrame(scrollable_frame, text="Company Name Management", font=("Arial", 12, "bold"))
         company_frame.pack(fill=tk.X, padx=10, pady=5)
-        tk.Label(company_frame, text=f"Current Company Name: {SHOP_NAME}").pack(anchor="w")
-        company_var = tk.StringVar(value=SHOP_NAME)
+        tk.Label(company_frame, text=f"Current Company Name: {checkout_engine.SHOP_NAME}").pack(anchor="w")
+        company_var = tk.StringVar(value=checkout_engine.SHOP_NAME)
         company_entry = tk.Entry(company_frame, textvariable=company_var, width=50)
         company_entry.pack(pady=5)
         def save_company():
-            global SHOP_NAME
-            SHOP_NAME = company_var.get()
+            checkout_engine.SHOP_NAME = company_var.get()
             messagebox.showinfo("Success", "Company Name updated. It will reflect in new invoices.")
         tk.Button(company_frame, text="Update Company Name", command=save_company).pack(pady=5)
         # Product Management
@@ -1350,14 +1544,10 @@ class BillingApp(tk.Tk):
                     if stock_i < 0 or threshold_i < 0:
                         raise ValueError("Stock and threshold cannot be negative")
                     self.products[code] = {"name": name, "price": price_d, "cost_price": cost_price_d, "stock": stock_i, "low_stock_threshold": threshold_i, "category": category}
-                    with open(PRODUCTS_CSV, "w", newline='', encoding='utf-8') as f:
-                        writer = csv.writer(f)
-                        writer.writerow(["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"])
-                        for c, p in self.products.items():
-                            writer.writerow([c, p["name"], str(p["price"]), str(p["cost_price"]), p["stock"], p["low_stock_threshold"], p["category"]])
+                    self.save_products(set_stock=[code])
+                    self.search_index.update(code, self.products[code])
                     self.refresh_product_list()
-                    categories = ["All"] + sorted(set(p["category"] for p in self.products.values()))
-                    self.category_combo['values'] = categories
+                    self.category_combo['values'] = ["All"] + self.search_index.category_names()
                     messagebox.showinfo("Success", "Product saved")
                 except Exception as e:
                     messagebox.showerror("Error", f"Invalid input: {e}")
@@ -1370,14 +1560,10 @@ class BillingApp(tk.Tk):
             code = delete_code_var.get()
             if code in self.products:
                 del self.products[code]
-                with open(PRODUCTS_CSV, "w", newline='', encoding='utf-8') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"])
-                    for c, p in self.products.items():
-                        writer.writerow([c, p["name"], str(p["price"]), str(p["cost_price"]), p["stock"], p["low_stock_threshold"], p["category"]])
+                self.save_products()
+                self.search_index.remove(code)
                 self.refresh_product_list()
-                categories = ["All"] + sorted(set(p["category"] for p in self.products.values()))
-                self.category_combo['values'] = categories
+                self.category_combo['values'] = ["All"] + self.search_index.category_names()
                 messagebox.showinfo("Deleted", "Product deleted")
             else:
                 messagebox.showerror("Error", "Product not found")
@@ -1407,8 +1593,8 @@ class BillingApp(tk.Tk):
                     if loyalty_i < 0:
                         raise ValueError("Loyalty points cannot be negative")
                     self.customers[id_] = {"name": name, "phone": phone, "loyalty_points": loyalty_i}
-                    self.save_customers()
-                    self.customer_entry['values'] = [c["name"] for c in self.customers.values()]
+                    self.save_customers(set_points=[id_])
+                    self.customers_changed(id_)
                     messagebox.showinfo("Success", "Customer saved")
                 except Exception as e:
                     messagebox.showerror("Error", f"Invalid loyalty points: {e}")
@@ -1426,6 +1612,7 @@ class BillingApp(tk.Tk):
                 if not all(h in reader.fieldnames for h in ["code", "name", "price", "stock"]):
                     messagebox.showerror("Error", "Invalid CSV headers")
                     return
+                imported = []
                 for row in reader:
                     code = row["code"]
                     try:
@@ -1441,11 +1628,14 @@ class BillingApp(tk.Tk):
                             "low_stock_threshold": threshold,
                             "category": row.get("category", "General")
                         }
+                        imported.append(code)
                     except Exception as e:
                         logging.warning(f"Error importing product {code}: {e}")
-            self.save_products()
+            self.save_products(set_stock=imported)
+            for code in imported:
+                self.search_index.update(code, self.products[code])
             self.refresh_product_list()
-            self.category_combo['values'] = ["All"] + sorted(set(p["category"] for p in self.products.values()))
+            self.category_combo['values'] = ["All"] + self.search_index.category_names()
             messagebox.showinfo("Success", f"Products imported from {path}")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to import: {e}")
@@ -1459,12 +1649,8 @@ class BillingApp(tk.Tk):
             for code, p in sorted(self.products.items()):
                 writer.writerow([code, p["name"], str(p["price"]), str(p["cost_price"]), p["stock"], p["low_stock_threshold"], p["category"]])
         messagebox.showinfo("Exported", f"Products exported to {path}")
-    def save_products(self):
-        with open(PRODUCTS_CSV, "w", newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"])
-            for code, p in self.products.items():
-                writer.writerow([code, p["name"], str(p["price"]), str(p["cost_price"]), p["stock"], p["low_stock_threshold"], p["category"]])
+    def save_products(self, set_stock=()):
+        save_product_catalog(self.products, set_stock)
     def add_new_customer(self):
         id_ = simpledialog.askstring("New Customer", "Enter ID:")
         if not id_ or id_ in self.customers:
@@ -1477,16 +1663,12 @@ class BillingApp(tk.Tk):
         points = simpledialog.askinteger("New Customer", "Enter Loyalty Points:", initialvalue=0)
         if points is None:
             return
-        self.customers[id_] = {"name": name, "phone": phone, "loyalty_points": points}
-        self.save_customers()
-        self.customer_entry['values'] = [c["name"] for c in self.customers.values()]
+        self.customers[id_] = {"name": name, "phone": phone or "", "loyalty_points": points}
+        self.save_customers(set_points=[id_])
+        self.customers_changed(id_)
         messagebox.showinfo("Added", "Customer added")
-    def save_customers(self):
-        with open(CUSTOMERS_CSV, "w", newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(["id", "name", "phone", "loyalty_points"])
-            for id_, c in self.customers.items():
-                writer.writerow([id_, c["name"], c["phone"], c["loyalty_points"]])
+    def save_customers(self, set_points=()):
+        save_customer_list(self.customers, set_points)
     def toggle_theme(self):
         self.is_dark = not self.is_dark
         style = ttk.Style()
@@ -1519,70 +1701,89 @@ class BillingApp(tk.Tk):
                         elif isinstance(child, tk.Entry):
                             child.configure(bg="white", fg="black", insertbackground="black")
     def profit_report(self):
-        total_sales = Decimal("0")
-        total_cost = Decimal("0")
-        item_sales = {}
-        for fname in os.listdir(INVOICES_DIR):
-            if fname.startswith("invoice_") and fname.endswith(".csv"):
-                try:
-                    with open(os.path.join(INVOICES_DIR, fname), newline='', encoding='utf-8') as f:
-                        reader = csv.reader(f)
-                        data = list(reader)
-                        invoice_dict = dict(row for row in data if len(row) == 2 and row[0])
-                        grand_total = Decimal(invoice_dict.get("grand_total", "0"))
-                        total_sales += grand_total
-                        items_start = False
-                        for row in data:
-                            if row == ["code", "name", "price", "qty", "total"]:
-                                items_start = True
-                                continue
-                            if items_start:
-                                if len(row) != 5:
-                                    break
-                                code, name, price, qty, _ = row
-                                qty_i = int(qty)
-                                cost = self.products.get(code, {}).get("cost_price", Decimal("0")) * Decimal(qty_i)
-                                total_cost += cost
-                                if code not in item_sales:
-                                    item_sales[code] = {"units": 0, "name": name if "CUSTOM_" in code else self.products.get(code, {}).get("name", "Unknown")}
-                                item_sales[code]["units"] += qty_i
-                except Exception as e:
-                    logging.warning(f"Error processing {fname} for profit: {e}")
-        profit = total_sales - total_cost
-        top_seller_code = max(item_sales, key=lambda c: item_sales[c]["units"]) if item_sales else "N/A"
-        top_seller_name = item_sales[top_seller_code]["name"] if item_sales else "N/A"
-        report = f"Total Sales: {money(total_sales)}\nTotal Cost: {money(total_cost)}\nProfit: {money(profit)}\nTop Seller: {top_seller_name} (Code: {top_seller_code}, Units Sold: {item_sales.get(top_seller_code, {'units': 0})['units']})"
-        messagebox.showinfo("Profit Report", report)
-        self.export_profit_report_pdf(total_sales, total_cost, profit, top_seller_name, top_seller_code, item_sales)
-    def export_profit_report_pdf(self, total_sales, total_cost, profit, top_seller_name, top_seller_code, item_sales):
+        win = tk.Toplevel(self)
+        win.title("Profit Report")
+        win.geometry("900x500")
+        range_frame = tk.Frame(win)
+        range_frame.pack(fill=tk.X, pady=5)
+        tk.Label(range_frame, text="From (YYYY-MM-DD):").pack(side=tk.LEFT)
+        start_var = tk.StringVar()
+        tk.Entry(range_frame, textvariable=start_var, width=12).pack(side=tk.LEFT, padx=5)
+        tk.Label(range_frame, text="To:").pack(side=tk.LEFT)
+        end_var = tk.StringVar()
+        tk.Entry(range_frame, textvariable=end_var, width=12).pack(side=tk.LEFT, padx=5)
+        tk.Label(range_frame, text="Group by:").pack(side=tk.LEFT)
+        groups = {"Item": "code", "Category": "category", "Day": "day"}
+        group_var = tk.StringVar(value="Item")
+        ttk.Combobox(range_frame, textvariable=group_var, values=list(groups), state="readonly", width=10).pack(side=tk.LEFT, padx=5)
+        summary_label = tk.Label(win, text="", justify=tk.LEFT)
+        summary_label.pack(anchor="w", padx=10)
+        cols = ("key", "name", "units", "revenue", "cost", "margin", "margin_pct")
+        tree = ttk.Treeview(win, columns=cols, show="headings")
+        for c, title in zip(cols, ("Code", "Name", "Units", "Revenue", "Cost", "Margin", "Margin %")):
+            tree.heading(c, text=title)
+            tree.column(c, anchor="center", width=110)
+        tree.pack(fill=tk.BOTH, expand=True)
+        report = {}
+        def show(scanned=False):
+            if not scanned and self.invoice_scan_pending(lambda: show(scanned=True), history=True):
+                return
+            if not tree.winfo_exists():
+                return
+            start, end = start_var.get().strip(), end_var.get().strip()
+            group = groups[group_var.get()]
+            names = history_item_names()
+            item_sales = {}
+            total_cost = Decimal("0")
+            for code, units, _, cost in history_group_totals("code", start, end):
+                item_sales[code] = {"units": units, "name": names.get(code, "Unknown") if "CUSTOM_" in code else self.products.get(code, {}).get("name", names.get(code, "Unknown"))}
+                total_cost += cost
+            total_sales = history_sales_total(start, end)
+            profit = total_sales - total_cost
+            top_seller_code = max(item_sales, key=lambda c: item_sales[c]["units"]) if item_sales else "N/A"
+            top_seller_name = item_sales[top_seller_code]["name"] if item_sales else "N/A"
+            period = f"{start or 'start'} to {end or 'today'}"
+            report.update(total_sales=total_sales, total_cost=total_cost, profit=profit, top_seller_name=top_seller_name,
+                          top_seller_code=top_seller_code, item_sales=item_sales, period=period)
+            summary_label.config(text=f"Period: {period}\nTotal Sales: {money(total_sales)}\nTotal Cost: {money(total_cost)}\nProfit: {money(profit)}\nTop Seller: {top_seller_name} (Code: {top_seller_code}, Units Sold: {item_sales.get(top_seller_code, {'units': 0})['units']})")
+            tree.heading("key", text=group_var.get())
+            tree.delete(*tree.get_children())
+            for key, units, revenue, cost in history_group_totals(group, start, end):
+                margin = revenue - cost
+                margin_pct = f"{(margin * 100 / revenue).quantize(Decimal('0.1'), rounding=ROUND_HALF_UP)}%" if revenue else "-"
+                name = item_sales.get(key, {}).get("name", "") if group == "code" else ""
+                tree.insert("", tk.END, values=(key, name, units, money(revenue), money(cost), money(margin), margin_pct))
+        def export():
+            if report:
+                self.export_profit_report_pdf(report["total_sales"], report["total_cost"], report["profit"], report["top_seller_name"],
+                                              report["top_seller_code"], report["item_sales"], period=report["period"])
+        tk.Button(range_frame, text="Apply", command=show).pack(side=tk.LEFT)
+        tk.Button(range_frame, text="Export to PDF", command=export).pack(side=tk.LEFT, padx=5)
+        show()
+    def export_profit_report_pdf(self, total_sales, total_cost, profit, top_seller_name, top_seller_code, item_sales, period=None):
         path = filedialog.asksaveasfilename(defaultextension=".pdf", filetypes=[("PDF files", "*.pdf")])
         if not path:
             return
-        doc = SimpleDocTemplate(path, pagesize=A4)
+        rl = reportlab_kit()
+        doc = rl.SimpleDocTemplate(path, pagesize=rl.A4)
         elements = []
-        styles = getSampleStyleSheet()
-        elements.append(Paragraph(f"Profit Report - {SHOP_NAME}", styles['Title']))
-        elements.append(Spacer(1, 12))
-        elements.append(Paragraph(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
-        elements.append(Spacer(1, 12))
-        elements.append(Paragraph(f"Total Sales: {money(total_sales)}", styles['Normal']))
-        elements.append(Paragraph(f"Total Cost: {money(total_cost)}", styles['Normal']))
-        elements.append(Paragraph(f"Profit: {money(profit)}", styles['Normal']))
-        elements.append(Paragraph(f"Top Seller: {top_seller_name} (Code: {top_seller_code}, Units Sold: {item_sales.get(top_seller_code, {'units': 0})['units']})", styles['Normal']))
-        elements.append(Spacer(1, 12))
+        styles = rl.styles
+        elements.append(rl.Paragraph(f"Profit Report - {checkout_engine.SHOP_NAME}", styles['Title']))
+        elements.append(rl.Spacer(1, 12))
+        elements.append(rl.Paragraph(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
+        if period:
+            elements.append(rl.Paragraph(f"Period: {period}", styles['Normal']))
+        elements.append(rl.Spacer(1, 12))
+        elements.append(rl.Paragraph(f"Total Sales: {money(total_sales)}", styles['Normal']))
+        elements.append(rl.Paragraph(f"Total Cost: {money(total_cost)}", styles['Normal']))
+        elements.append(rl.Paragraph(f"Profit: {money(profit)}", styles['Normal']))
+        elements.append(rl.Paragraph(f"Top Seller: {top_seller_name} (Code: {top_seller_code}, Units Sold: {item_sales.get(top_seller_code, {'units': 0})['units']})", styles['Normal']))
+        elements.append(rl.Spacer(1, 12))
         data = [["Code", "Name", "Units Sold"]]
         for code, d in sorted(item_sales.items(), key=lambda x: x[1]["units"], reverse=True)[:5]:
             data.append([code, d["name"], d["units"]])
-        table = Table(data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
+        table = rl.Table(data)
+        table.setStyle(rl.report_table_style)
         elements.append(table)
         doc.build(elements)
         messagebox.showinfo("Exported", f"Profit report saved to {path}")
@@ -1593,76 +1794,100 @@ class BillingApp(tk.Tk):
         tk.Button(win, text="Sales by Category", command=self.sales_by_category_report).pack(pady=5)
         tk.Button(win, text="Customer Purchase History", command=self.customer_purchase_history_report).pack(pady=5)
         tk.Button(win, text="Low Stock Summary", command=self.low_stock_summary_report).pack(pady=5)
-    def sales_by_category_report(self):
+    def sales_by_category_report(self, scanned=False):
+        if not scanned and self.invoice_scan_pending(lambda: self.sales_by_category_report(scanned=True), facts=True):
+            return
         win = tk.Toplevel(self)
         win.title("Sales by Category")
+        range_frame = tk.Frame(win)
+        range_frame.pack(fill=tk.X, pady=5)
+        tk.Label(range_frame, text="From (YYYY-MM-DD):").pack(side=tk.LEFT)
+        start_var = tk.StringVar()
+        tk.Entry(range_frame, textvariable=start_var, width=12).pack(side=tk.LEFT, padx=5)
+        tk.Label(range_frame, text="To:").pack(side=tk.LEFT)
+        end_var = tk.StringVar()
+        tk.Entry(range_frame, textvariable=end_var, width=12).pack(side=tk.LEFT, padx=5)
         cols = ("category", "total_sales", "units_sold")
         tree = ttk.Treeview(win, columns=cols, show="headings")
         tree.heading("category", text="Category")
         tree.heading("total_sales", text="Total Sales")
         tree.heading("units_sold", text="Units Sold")
         tree.pack(fill=tk.BOTH, expand=True)
-       
-        category_sales = {}
-        for fname in os.listdir(INVOICES_DIR):
-            if fname.startswith("invoice_") and fname.endswith(".csv"):
-                try:
-                    with open(os.path.join(INVOICES_DIR, fname), newline='', encoding='utf-8') as f:
-                        reader = csv.reader(f)
-                        data = list(reader)
-                        items_start = False
-                        for row in data:
-                            if row == ["code", "name", "price", "qty", "total"]:
-                                items_start = True
-                                continue
-                            if items_start and len(row) == 5:
-                                code, _, price, qty, _ = row
-                                if "CUSTOM_" in code:
-                                    category = "Custom"
-                                else:
-                                    category = self.products.get(code, {}).get("category", "Unknown")
-                                qty_i = int(qty)
-                                total = Decimal(price) * qty_i
-                                if category not in category_sales:
-                                    category_sales[category] = {"total": Decimal("0"), "units": 0}
-                                category_sales[category]["total"] += total
-                                category_sales[category]["units"] += qty_i
-                except Exception as e:
-                    logging.warning(f"Error processing {fname}: {e}")
-        for cat, data in sorted(category_sales.items()):
-            tree.insert("", tk.END, values=(cat, money(data["total"]), data["units"]))
+        def show(scanned=False):
+            # All-time totals come from the rollups; a date range needs the
+            # line-level history.
+            start, end = start_var.get().strip(), end_var.get().strip()
+            if start or end:
+                if not scanned and self.invoice_scan_pending(lambda: show(scanned=True), history=True):
+                    return
+                rows = history_group_totals("category", start, end)
+            else:
+                rows = category_sales()
+            if not tree.winfo_exists():
+                return
+            tree.delete(*tree.get_children())
+            for cat, units, total, _ in rows:
+                tree.insert("", tk.END, values=(cat, money(total), units))
+        tk.Button(range_frame, text="Apply", command=show).pack(side=tk.LEFT)
+        show()
+        # The all-time totals are a cheap rollup query; re-run it as sales and
+        # returns come in. Date ranges are left alone until Apply is pressed.
+        watch_changes(win, lambda events: show() if not (start_var.get().strip() or end_var.get().strip()) else None, ("sale",))
         tk.Button(win, text="Export to PDF", command=lambda: self.export_report_to_pdf(tree, "Sales by Category")).pack(pady=5)
-    def customer_purchase_history_report(self):
+    def customer_purchase_history_report(self, scanned=False):
+        if not scanned and self.invoice_scan_pending(lambda: self.customer_purchase_history_report(scanned=True), facts=True):
+            return
         win = tk.Toplevel(self)
         win.title("Customer Purchase History")
         tk.Label(win, text="Select Customer:").pack()
         customer_var = tk.StringVar()
-        customer_combo = ttk.Combobox(win, textvariable=customer_var, values=[c["name"] for c in self.customers.values()])
+        choices = {}
+        def filter_history_customers(event=None):
+            choices.clear()
+            choices.update((self.customer_label(id_), id_) for id_ in self.customer_index.search(customer_var.get()))
+            customer_combo['values'] = list(choices)
+        customer_combo = ttk.Combobox(win, textvariable=customer_var, width=40)
+        customer_combo.bind("<KeyRelease>", filter_history_customers)
         customer_combo.pack()
+        filter_history_customers()
+        summary_label = tk.Label(win, text="")
+        summary_label.pack(pady=5)
+        cols = ("invoice_number", "type", "date", "total", "points")
+        tree = ttk.Treeview(win, columns=cols, show="headings")
+        for c, heading in zip(cols, ("Invoice #", "Type", "Date", "Total", "Points")):
+            tree.heading(c, text=heading)
+        tree.pack(fill=tk.BOTH, expand=True)
         def show_history():
-            customer_name = customer_var.get()
-            if not customer_name:
+            id_ = choices.get(customer_var.get().strip())
+            if id_ is None:
+                ids = self.customer_index.by_name(customer_var.get())
+                if len(ids) != 1:
+                    messagebox.showwarning("Customer", "Select a customer from the list.")
+                    return
+                id_ = ids[0]
+            tree.delete(*tree.get_children())
+            for kind, number, day, total, points in customer_ledger(id_):
+                tree.insert("", tk.END, values=(number, kind.capitalize(), day, money(total), points))
+            invoices, spend, points = customer_lifetime(id_)
+            summary_label.config(text=f"Invoices: {invoices}   Lifetime value: {money(spend)}   Points earned: {points}   "
+                                      f"Balance: {self.customers[id_]['loyalty_points']}")
+        def show_points_log():
+            id_ = choices.get(customer_var.get().strip())
+            if id_ is None:
+                messagebox.showwarning("Customer", "Select a customer from the list.")
                 return
-            cols = ("invoice_number", "date", "total")
-            tree = ttk.Treeview(win, columns=cols, show="headings")
-            tree.heading("invoice_number", text="Invoice #")
-            tree.heading("date", text="Date")
-            tree.heading("total", text="Total")
-            tree.pack(fill=tk.BOTH, expand=True)
-            for fname in os.listdir(INVOICES_DIR):
-                if fname.startswith("invoice_") and fname.endswith(".csv"):
-                    try:
-                        with open(os.path.join(INVOICES_DIR, fname), newline='', encoding='utf-8') as f:
-                            reader = csv.reader(f)
-                            data = list(reader)
-                            invoice_dict = dict(row for row in data if len(row) == 2 and row[0])
-                            if invoice_dict.get("customer_name") == customer_name:
-                                num = fname.split("_")[1].split(".")[0]
-                                tree.insert("", tk.END, values=(num, invoice_dict.get("date", ""), money(Decimal(invoice_dict.get("grand_total", "0")))))
-                    except Exception as e:
-                        logging.warning(f"Error reading {fname}: {e}")
-            tk.Button(win, text="Export to PDF", command=lambda: self.export_report_to_pdf(tree, "Customer Purchase History")).pack(pady=5)
+            log_win = tk.Toplevel(win)
+            log_win.title(f"Loyalty Points - {self.customers[id_]['name']}")
+            log_cols = ("date", "change", "reason", "invoice")
+            log_tree = ttk.Treeview(log_win, columns=log_cols, show="headings")
+            for c in log_cols:
+                log_tree.heading(c, text=c.capitalize())
+            log_tree.pack(fill=tk.BOTH, expand=True)
+            for created, delta, reason, ref in loyalty_history(id_):
+                log_tree.insert("", tk.END, values=(created, f"{delta:+d}", reason.capitalize(), ref or ""))
         tk.Button(win, text="Show History", command=show_history).pack(pady=5)
+        tk.Button(win, text="Points Log", command=show_points_log).pack(pady=5)
+        tk.Button(win, text="Export to PDF", command=lambda: self.export_report_to_pdf(tree, "Customer Purchase History")).pack(pady=5)
     def low_stock_summary_report(self):
         win = tk.Toplevel(self)
         win.title("Low Stock Summary")
@@ -1675,54 +1900,52 @@ class BillingApp(tk.Tk):
         tree.pack(fill=tk.BOTH, expand=True)
         for code, p in sorted(self.products.items()):
             if p["stock"] < p["low_stock_threshold"]:
-                tree.insert("", tk.END, values=(code, p["name"], p["stock"], p["low_stock_threshold"]))
+                tree.insert("", tk.END, iid=code, values=(code, p["name"], p["stock"], p["low_stock_threshold"]))
+        def apply_changes(events):
+            # self.products is already up to date: BillingApp follows the feed
+            # first. Only the codes in the events are looked at again.
+            if any(kind in ("catalog", "reload") for kind, _, _ in events):
+                codes = set(self.products) | set(tree.get_children())
+            else:
+                codes = {key for kind, key, _ in events if kind in ("stock", "product")}
+            for code in codes:
+                p = self.products.get(code)
+                if p is None or p["stock"] >= p["low_stock_threshold"]:
+                    if tree.exists(code):
+                        tree.delete(code)
+                elif tree.exists(code):
+                    tree.item(code, values=(code, p["name"], p["stock"], p["low_stock_threshold"]))
+                else:
+                    tree.insert("", bisect.bisect(tree.get_children(), code), iid=code, values=(code, p["name"], p["stock"], p["low_stock_threshold"]))
+        watch_changes(win, apply_changes, ("stock", "product", "catalog"))
         tk.Button(win, text="Export to PDF", command=lambda: self.export_report_to_pdf(tree, "Low Stock Summary")).pack(pady=5)
     def export_report_to_pdf(self, tree, title):
         path = filedialog.asksaveasfilename(defaultextension=".pdf", filetypes=[("PDF files", "*.pdf")])
         if not path:
             return
-        doc = SimpleDocTemplate(path, pagesize=A4)
+        rl = reportlab_kit()
+        doc = rl.SimpleDocTemplate(path, pagesize=rl.A4)
         elements = []
-        styles = getSampleStyleSheet()
-        elements.append(Paragraph(f"{title} - {SHOP_NAME}", styles['Title']))
-        elements.append(Spacer(1, 12))
-        elements.append(Paragraph(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
-        elements.append(Spacer(1, 12))
+        styles = rl.styles
+        elements.append(rl.Paragraph(f"{title} - {checkout_engine.SHOP_NAME}", styles['Title']))
+        elements.append(rl.Spacer(1, 12))
+        elements.append(rl.Paragraph(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
+        elements.append(rl.Spacer(1, 12))
         data = [tree.heading(c)['text'] for c in tree['columns']]
         data = [data]
         for child in tree.get_children():
             data.append(tree.item(child, "values"))
-        table = Table(data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
+        table = rl.Table(data)
+        table.setStyle(rl.report_table_style)
         elements.append(table)
         doc.build(elements)
         messagebox.showinfo("Exported", f"Report saved to {path}")
     def process_return(self):
         self.show_invoice_history(for_return=True)
     def show_return_items(self, invoice_path):
-        with open(invoice_path, newline='', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            data = list(reader)
-            invoice_data = dict(row for row in data if len(row) == 2 and row[0])
-            items = []
-            items_start = False
-            for row in data:
-                if row == ["code", "name", "price", "qty", "total"]:
-                    items_start = True
-                    continue
-                if items_start:
-                    if len(row) != 5:
-                        break
-                    code, name, price, qty, total = row
-                    items.append({"code": code, "name": name, "price": Decimal(price), "qty": int(qty), "line_total": Decimal(total)})
+        record = read_invoice(invoice_path)
+        invoice_data = record.fields
+        items = record.items
         win = tk.Toplevel(self)
         win.title("Select Items to Return")
         win.geometry("600x300")
@@ -1738,8 +1961,7 @@ class BillingApp(tk.Tk):
         tree.bind("<Double-Button-1>", lambda e: self.edit_return_qty(tree, items))
         def confirm_return():
             return_items = []
-            points_deducted = 0
-            for child in tree.get_children():
+            for child, item in zip(tree.get_children(), items):
                 vals = tree.item(child, "values")
                 return_qty = int(vals[4])
                 if return_qty > 0:
@@ -1750,91 +1972,15 @@ class BillingApp(tk.Tk):
                         return
                     price = Decimal(vals[2])
                     line_total = price * Decimal(return_qty)
-                    return_items.append({"code": code, "name": vals[1], "price": price, "qty": -return_qty, "line_total": -line_total})
-                    if "CUSTOM_" not in code:
-                        self.products[code]["stock"] += return_qty
+                    cost_price = item["cost_price"] if item["cost_price"] is not None else self.products.get(code, {}).get("cost_price", Decimal("0"))
+                    return_items.append({"code": code, "name": vals[1], "price": price, "qty": -return_qty, "line_total": -line_total, "cost_price": cost_price})
             if not return_items:
                 messagebox.showinfo("No Items", "No items selected for return.")
                 win.destroy()
                 return
-            subtotal = sum(item["line_total"] for item in return_items)
-            discount_percent = Decimal(invoice_data["discount_percent"])
-            discount_amount = (subtotal * discount_percent / Decimal("100")).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-            subtotal_after_discount = (subtotal - discount_amount).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-            gst_percent = Decimal(invoice_data["gst_percent"])
-            gst_total = (subtotal_after_discount * gst_percent / Decimal("100")).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-            cgst = (gst_total / 2).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-            sgst = (gst_total - cgst).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-            grand_total = (subtotal_after_discount + gst_total).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            return_num = next_invoice_number()
-            return_data = {
-                "date": now,
-                "customer_name": invoice_data["customer_name"],
-                "customer_phone": invoice_data["customer_phone"],
-                "items": return_items,
-                "subtotal": subtotal,
-                "discount_percent": discount_percent,
-                "discount_amount": discount_amount,
-                "subtotal_after_discount": subtotal_after_discount,
-                "gst_percent": gst_percent,
-                "gst_total": gst_total,
-                "cgst": cgst,
-                "sgst": sgst,
-                "grand_total": grand_total,
-                "points_awarded": points_deducted,
-                "payment_status": "refunded",
-                "original_invoice": invoice_data["invoice_number"]
-            }
-            if invoice_data.get("customer_name") != "Anonymous":
-                for id_, c in self.customers.items():
-                    if c["name"] == invoice_data["customer_name"]:
-                        points_deducted = -int(abs(grand_total) // Decimal(10))
-                        c["loyalty_points"] += points_deducted
-                        self.save_customers()
-                        break
-            return_csv = os.path.join(INVOICES_DIR, f"return_{return_num}.csv")
-            with open(return_csv, "w", newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(["shop_name", SHOP_NAME])
-                writer.writerow(["return_number", return_num])
-                writer.writerow(["original_invoice", invoice_data["invoice_number"]])
-                writer.writerow(["date", return_data["date"]])
-                writer.writerow(["customer_name", return_data["customer_name"]])
-                writer.writerow(["customer_phone", return_data["customer_phone"]])
-                writer.writerow([])
-                writer.writerow(["code", "name", "price", "qty", "total"])
-                for row in return_data["items"]:
-                    writer.writerow([row["code"], row["name"], money(row["price"]), row["qty"], money(row["line_total"])])
-                writer.writerow([])
-                writer.writerow(["subtotal", money(return_data["subtotal"])])
-                writer.writerow(["discount_percent", str(return_data["discount_percent"])])
-                writer.writerow(["discount_amount", money(return_data["discount_amount"])])
-                writer.writerow(["subtotal_after_discount", money(return_data["subtotal_after_discount"])])
-                writer.writerow(["gst_percent", str(return_data["gst_percent"])])
-                writer.writerow(["gst_total", money(return_data["gst_total"])])
-                writer.writerow(["cgst", money(return_data["cgst"])])
-                writer.writerow(["sgst", money(return_data["sgst"])])
-                writer.writerow(["grand_total", money(return_data["grand_total"])])
-                writer.writerow(["points_deducted", points_deducted])
-                writer.writerow(["payment_status", return_data["payment_status"]])
-            orig_csv = invoice_path
-            with open(orig_csv, newline='', encoding='utf-8') as f:
-                orig_data = list(csv.reader(f))
-            for row in orig_data:
-                if row and row[0] == "payment_status":
-                    row[1] = "partial/refunded"
-                    break
-            with open(orig_csv, "w", newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerows(orig_data)
-            with open(PRODUCTS_CSV, "w", newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"])
-                for c, p in self.products.items():
-                    writer.writerow([c, p["name"], str(p["price"]), str(p["cost_price"]), p["stock"], p["low_stock_threshold"], p["category"]])
+            return_num, return_data, _ = commit_return(invoice_path, invoice_data, return_items, self.products, self.customers, self.customer_index)
             self.refresh_product_list()
-            messagebox.showinfo("Return Processed", f"Return #{return_num} saved. Stock updated. Points deducted: {points_deducted}")
+            messagebox.showinfo("Return Processed", f"Return #{return_num} saved. Stock updated. Points deducted: {return_data['points_deducted']}")
             win.destroy()
     def edit_return_qty(self, tree, items):
         sel = tree.selection()
@@ -1960,5 +2106,20 @@ class BillingApp(tk.Tk):
         landing = LandingPage()
         landing.mainloop()
 if __name__ == "__main__":
+    if "--backfill-sales" in sys.argv[1:]:
+        recover_sale_journal()
+        print(f"Rebuilt sales rollups from {backfill_sales_facts()} invoice and return files.")
+        sys.exit(0)
+    if "--compact-history" in sys.argv[1:]:
+        recover_sale_journal()
+        print(f"Rebuilt {len(compact_sales_history())} months of sales history.")
+        sys.exit(0)
+    startup_marks = [("imports", time.perf_counter())]
     landing = LandingPage()
+    startup_marks.append(("landing page", time.perf_counter()))
+    # Recovery only replays sales left unfinished a while ago, so it can wait
+    # until the landing screen is up.
+    landing.after_idle(recover_sale_journal)
+    if startup_profile:
+        landing.after_idle(report_startup, landing, startup_marks)
     landing.mainloop()
@@ -0,0 +1,2290 @@
+import csv
+import os
+import sys
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+from datetime import datetime, timedelta
+import uuid
+import logging
+import sqlite3
+import threading
+import time
+import atexit
+import hashlib
+import json
+import re
+import bisect
+import mmap
+import shutil
+from array import array
+from contextlib import contextmanager
+from types import SimpleNamespace
+# ReportLab, NumPy and multiprocessing are imported on first use (see
+# reportlab_kit() and numpy_module()): together they are most of the
+# start-up time on slow machines.
+# Storage, pricing and checkout for the billing app, with no Tk dependency so
+# sales can also be run from scripts and the command line (see main()). The Tk
+# app imports everything from here; settings it changes at runtime must be
+# assigned on this module, e.g. checkout_engine.SHOP_NAME = "...".
+# ---------- Config ----------
+PRODUCTS_CSV = "products.csv"
+CUSTOMERS_CSV = "customers.csv"
+BARCODES_CSV = "barcodes.csv" # optional alternate barcodes: barcode,code
+INVOICES_DIR = "invoices"
+INVOICES_ARCHIVE_DIR = os.path.join(INVOICES_DIR, "archive")
+RENDER_CACHE_DIR = os.path.join(INVOICES_DIR, "cache")
+RENDER_CACHE_MAX_BYTES = 200 * 1024 * 1024
+TEMPLATE_VERSION = "1" # bump whenever the HTML/PDF invoice layout changes
+HISTORY_DIR = "history"
+BILLING_DB = "billing.db"
+DB_WAL = True # lets tills read while another writes; set False if billing.db is on a network share
+JOURNAL_RECOVER_AFTER = 60 # seconds; newer unfinished sales may still be in progress on another till
+STOCK_COMPACT_EVERY = 500 # stock changes between background snapshots of products.csv
+LOYALTY_COMPACT_EVERY = 200 # loyalty changes between background snapshots of customers.csv
+EVENTS_KEEP = 20000 # newest change events kept; readers further behind reload everything
+GST_DEFAULT = Decimal("18.0") # percent
+CURRENCY_QUANT = Decimal("0.01")
+SHOP_NAME = "Serenia Ltd."
+GST_NUMBER = "GSTIN: 27ABCDE1234F1Z5" # Default GST Number
+LOYALTY_DISCOUNT_POINTS = 100 # customers with at least this many points get LOYALTY_DISCOUNT_PERCENT off
+LOYALTY_DISCOUNT_PERCENT = Decimal("10")
+SCAN_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+SCAN_CHUNK_SIZE = 200 # invoice files parsed per worker task
+SCAN_PARALLEL_MIN = 2000 # smaller folders are parsed in-process
+INGEST_BATCH_SIZE = 500 # orders committed together by ingest_orders
+CUSTOMER_RESULTS_MAX = 50 # customer matches returned by CustomerIndex.search
+# ----------------------------
+PRODUCT_FIELDS = ["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"]
+INVOICE_ITEM_HEADER = ["code", "name", "price", "qty", "total", "cost"]
+LEGACY_ITEM_HEADER = ["code", "name", "price", "qty", "total"] # files written before unit costs were recorded
+def notify(title, message, error=False):
+    # Problems with the data files are reported through here. The Tk app
+    # replaces it with a dialog; headless runs only log them.
+    (logging.error if error else logging.warning)(f"{title}: {message}")
+def is_pool_worker():
+    # True in the processes scan_invoices() spawns: they import this module
+    # (and the caller's main script) but must not run its exit hooks, which
+    # would rewrite the shop's files under the parent. multiprocessing is
+    # always loaded in a worker, and only loaded in the parent once it has
+    # started a pool. A spawned worker is named before it re-imports the main
+    # script, while parent_process() is only set after.
+    mp = sys.modules.get("multiprocessing")
+    return mp is not None and mp.current_process().name != "MainProcess"
+def money(d: Decimal) -> str:
+    return f"{d.quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)}"
+def _money_or_blank(d):
+    return "" if d is None else money(d)
+@contextmanager
+def atomic_open(path, newline='', durable=True):
+    # Writes go to a temporary file in the same folder, which is fsynced and
+    # renamed over the target, so readers see either the old or the new file.
+    # With durable=False the fsyncs are left to the caller (see fsync_files).
+    folder = os.path.dirname(os.path.abspath(path))
+    tmp = os.path.join(folder, f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp, "w", newline=newline, encoding='utf-8') as f:
+            yield f
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if durable:
+        _fsync_folder(folder)
+def _fsync_folder(folder):
+    if os.name == "posix":
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+def fsync_files(paths):
+    # Flushes files written with atomic_open(durable=False), then each folder
+    # once, so a batch of files costs one folder sync instead of one per file.
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for folder in {os.path.dirname(os.path.abspath(path)) for path in paths}:
+        _fsync_folder(folder)
+def read_products(path=PRODUCTS_CSV):
+    products = {}
+    if not os.path.exists(path):
+        with open(path, "w", newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"])
+            writer.writerow(["P001", "Sample Product 1", "10.00", "5.00", "100", "10", "General"])
+            writer.writerow(["P002", "Sample Product 2", "20.00", "10.00", "50", "10", "General"])
+            writer.writerow(["P003", "Sample Product 3", "15.75", "7.00", "75", "10", "General"])
+        notify("Created", f"Sample {path} created. Please edit it and reload.")
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        expected_headers = ["code", "name", "price", "cost_price", "stock", "low_stock_threshold", "category"]
+        if not all(h in reader.fieldnames for h in ["code", "name", "price", "stock"]):
+            notify("Error", f"Invalid headers in {path}. Expected at least: code, name, price, stock", error=True)
+            return {}
+        for r in reader:
+            code = r.get("code") or r.get("id") or r.get("sku")
+            name = r.get("name") or r.get("product") or ""
+            price = r.get("price") or "0"
+            cost_price = r.get("cost_price") or "0"
+            stock = r.get("stock") or "0"
+            low_threshold = r.get("low_stock_threshold") or "10"
+            category = r.get("category") or "General"
+            if not code:
+                continue
+            try:
+                price_d = Decimal(price)
+                cost_price_d = Decimal(cost_price)
+                stock_i = int(stock)
+                threshold_i = int(low_threshold)
+            except:
+                price_d = Decimal("0")
+                cost_price_d = Decimal("0")
+                stock_i = 0
+                threshold_i = 10
+            products[code] = {"name": name, "price": price_d, "cost_price": cost_price_d, "stock": stock_i, "low_stock_threshold": threshold_i, "category": category}
+    if os.path.abspath(path) == os.path.abspath(PRODUCTS_CSV):
+        overlay_stock_levels(products)
+    return products
+def read_barcodes(path=BARCODES_CSV):
+    barcodes = {}
+    if not os.path.exists(path):
+        return barcodes
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or not all(h in reader.fieldnames for h in ["barcode", "code"]):
+            logging.warning(f"Ignoring {path}: expected headers barcode, code")
+            return barcodes
+        for r in reader:
+            barcode = (r.get("barcode") or "").strip()
+            code = (r.get("code") or "").strip()
+            if barcode and code:
+                barcodes[barcode] = code
+    return barcodes
+def read_customers(path=CUSTOMERS_CSV):
+    customers = {}
+    if not os.path.exists(path):
+        with open(path, "w", newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "name", "phone", "loyalty_points"])
+            writer.writerow(["C001", "Sample Customer", "1234567890", "0"])
+        notify("Created", f"Sample {path} created. Please edit it and reload.")
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        if not all(h in reader.fieldnames for h in ["id", "name", "phone"]):
+            notify("Error", f"Invalid headers in {path}. Expected: id, name, phone", error=True)
+            return {}
+        for r in reader:
+            id_ = r.get("id")
+            name = r.get("name") or ""
+            phone = r.get("phone") or ""
+            points = r.get("loyalty_points") or "0"
+            if not id_:
+                continue
+            try:
+                points_i = int(points)
+            except:
+                points_i = 0
+            customers[id_] = {"name": name, "phone": phone, "loyalty_points": points_i}
+    if os.path.abspath(path) == os.path.abspath(CUSTOMERS_CSV):
+        overlay_loyalty_points(customers)
+    return customers
+def write_customers_csv(customers, path=CUSTOMERS_CSV):
+    with atomic_open(path) as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "phone", "loyalty_points"])
+        for id_, c in customers.items():
+            writer.writerow([id_, c["name"], c["phone"], c["loyalty_points"]])
+def ensure_invoices_dir():
+    os.makedirs(INVOICES_DIR, exist_ok=True)
+    os.makedirs(INVOICES_ARCHIVE_DIR, exist_ok=True)
+# ---------- Local database ----------
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS invoice_index (
+    number INTEGER PRIMARY KEY,
+    date TEXT,
+    customer_name TEXT,
+    grand_total TEXT,
+    payment_status TEXT,
+    item_count INTEGER,
+    fname TEXT,
+    mtime_ns INTEGER,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS invoice_index_customer ON invoice_index (customer_name);
+CREATE INDEX IF NOT EXISTS invoice_index_date ON invoice_index (date);
+CREATE TABLE IF NOT EXISTS stock (code TEXT PRIMARY KEY, qty INTEGER NOT NULL, version INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS loyalty (customer_id TEXT PRIMARY KEY, points INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS loyalty_txn (id INTEGER PRIMARY KEY, customer_id TEXT NOT NULL, delta INTEGER NOT NULL, reason TEXT NOT NULL, ref INTEGER, created TEXT);
+CREATE INDEX IF NOT EXISTS loyalty_txn_customer ON loyalty_txn (customer_id, id);
+CREATE TABLE IF NOT EXISTS ingested_orders (order_id TEXT PRIMARY KEY, inv_number INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS sale_journal (id INTEGER PRIMARY KEY, inv_number INTEGER, state TEXT NOT NULL, payload TEXT NOT NULL, created TEXT);
+CREATE TABLE IF NOT EXISTS sales_recorded (kind TEXT NOT NULL, number INTEGER NOT NULL, PRIMARY KEY (kind, number));
+CREATE TABLE IF NOT EXISTS sales_daily (
+    day TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    invoices INTEGER NOT NULL,
+    units INTEGER NOT NULL,
+    revenue INTEGER NOT NULL,
+    cost INTEGER NOT NULL,
+    PRIMARY KEY (day, kind)
+);
+CREATE TABLE IF NOT EXISTS sales_sku (
+    code TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT,
+    category TEXT,
+    units INTEGER NOT NULL,
+    revenue INTEGER NOT NULL,
+    cost INTEGER NOT NULL,
+    PRIMARY KEY (code, kind)
+);
+CREATE TABLE IF NOT EXISTS sales_category (
+    category TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    units INTEGER NOT NULL,
+    revenue INTEGER NOT NULL,
+    cost INTEGER NOT NULL,
+    PRIMARY KEY (category, kind)
+);
+CREATE TABLE IF NOT EXISTS customer_ledger (
+    customer_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    day TEXT,
+    total INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    PRIMARY KEY (kind, number)
+);
+CREATE INDEX IF NOT EXISTS customer_ledger_customer ON customer_ledger (customer_id, day);
+CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, key TEXT NOT NULL, data TEXT);
+"""
+_db_local = threading.local()
+def get_db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(BILLING_DB, timeout=30)
+        if DB_WAL:
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(DB_SCHEMA)
+        _db_local.conn = conn
+    return conn
+@contextmanager
+def db_transaction(conn=None):
+    # BEGIN IMMEDIATE takes SQLite's write lock up front, so read-modify-write
+    # sequences are serialized across every till sharing the database file.
+    conn = conn or get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+def meta_get(conn, key, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+def meta_set(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+# ---------- Change feed ----------
+# Writers add an event in the same transaction as the change itself, so every
+# process sharing billing.db reads one ordered feed of what changed:
+#   stock      code -> qty
+#   product    code -> product fields, or None once deleted
+#   catalog    products.csv was replaced or edited by hand; reload it
+#   points     customer id -> loyalty balance
+#   customer   customer id -> customer fields
+#   customers  customers.csv was edited by hand; reload it
+#   invoice    invoice number -> its invoice_index fields, or key "" once the
+#              index was cleared
+#   sale       invoice or return number -> {"kind", "day", "total" in paise,
+#              "customer"}, or key "" once the rollups were cleared or rebuilt
+# Only the newest EVENTS_KEEP events are kept. Open windows follow the feed
+# with an EventFeed instead of re-reading the CSVs.
+def _publish(conn, kind, key, data=None):
+    cur = conn.execute("INSERT INTO events (kind, key, data) VALUES (?, ?, ?)", (kind, str(key), json.dumps(data)))
+    if cur.lastrowid % EVENTS_KEEP == 0:
+        conn.execute("DELETE FROM events WHERE id <= ?", (cur.lastrowid - EVENTS_KEEP,))
+def _last_event_id(conn):
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+def product_fields(p):
+    return {"name": p["name"], "price": str(p["price"]), "cost_price": str(p["cost_price"]), "stock": p["stock"],
+            "low_stock_threshold": p["low_stock_threshold"], "category": p["category"]}
+def product_from_fields(data):
+    return dict(data, price=Decimal(data["price"]), cost_price=Decimal(data["cost_price"]))
+def apply_product_events(products, events, catalog=None):
+    # Applies stock, product, catalog and reload events to products in place.
+    # Returns (whether it was reloaded, codes changed otherwise). A reload
+    # copies catalog if given, else reads the current catalog.
+    reloaded = False
+    touched = set()
+    for kind, key, data in events:
+        if kind == "stock":
+            if key in products:
+                products[key]["stock"] = data
+                touched.add(key)
+        elif kind == "product":
+            if data is None:
+                products.pop(key, None)
+            else:
+                products[key] = product_from_fields(data)
+            touched.add(key)
+        elif kind in ("catalog", "reload"):
+            products.clear()
+            products.update(catalog if catalog is not None else catalog_copy())
+            reloaded = True
+    return reloaded, touched
+def apply_customer_events(customers, events, customer_list=None):
+    # Same for points, customer, customers and reload events. The ids returned
+    # are those whose name or phone may have changed.
+    reloaded = False
+    touched = set()
+    for kind, key, data in events:
+        if kind == "points":
+            if key in customers:
+                customers[key]["loyalty_points"] = data
+        elif kind == "customer":
+            customers[key] = data
+            touched.add(key)
+        elif kind in ("customers", "reload"):
+            customers.clear()
+            customers.update(customer_list if customer_list is not None else read_customers())
+            reloaded = True
+    return reloaded, touched
+class EventFeed:
+    # Reads the feed from where it last stopped. Each subscriber gets the new
+    # events of the kinds it asked for as one list of (kind, key, data) per
+    # poll. A reader that fell behind the pruned part of the feed has missed
+    # changes; its subscribers get [("reload", None, None)] instead.
+    def __init__(self, last=None):
+        # last: id of the last event already accounted for; default: now.
+        self.last = last if last is not None else _last_event_id(get_db())
+        self.subscribers = []
+    def subscribe(self, callback, kinds=None):
+        self.subscribers.append((callback, set(kinds) if kinds else None))
+    def unsubscribe(self, callback):
+        self.subscribers = [(cb, kinds) for cb, kinds in self.subscribers if cb != callback]
+    def poll(self):
+        rows = get_db().execute("SELECT id, kind, key, data FROM events WHERE id > ? ORDER BY id", (self.last,)).fetchall()
+        if not rows:
+            return
+        missed = rows[0][0] > self.last + 1
+        self.last = rows[-1][0]
+        events = [(kind, key, json.loads(data)) for _, kind, key, data in rows]
+        for callback, kinds in list(self.subscribers):
+            wanted = [("reload", None, None)] if missed else [e for e in events if kinds is None or e[0] in kinds]
+            if not wanted:
+                continue
+            try:
+                callback(wanted)
+            except Exception:
+                logging.exception("Change feed subscriber failed")
+# ---------- Stock store ----------
+# products.csv holds the catalog; live stock levels are kept per SKU in the
+# stock table so a sale only touches the rows it sells. The CSV is refreshed
+# from the table in the background every STOCK_COMPACT_EVERY changes and at
+# exit. If products.csv is edited by hand, its stock column wins again.
+# Several tills may share the store. Sales decrement a row only if enough is
+# left, raising StockConflict otherwise. Every stock transaction stamps the
+# rows it touches with a new version number and publishes their new levels
+# on the change feed.
+products_file_lock = threading.Lock()
+_compaction_thread = None
+def _products_csv_signature():
+    st = os.stat(PRODUCTS_CSV)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+def write_products_csv(products, path=PRODUCTS_CSV):
+    with atomic_open(path) as f:
+        writer = csv.writer(f)
+        writer.writerow(PRODUCT_FIELDS)
+        for c, p in products.items():
+            writer.writerow([c, p["name"], str(p["price"]), str(p["cost_price"]), p["stock"], p["low_stock_threshold"], p["category"]])
+def overlay_stock_levels(products):
+    with db_transaction() as conn:
+        if meta_get(conn, "products_csv_signature") == _products_csv_signature():
+            known = set()
+            for code, qty in conn.execute("SELECT code, qty FROM stock"):
+                known.add(code)
+                if code in products:
+                    products[code]["stock"] = qty
+            missing = [(code, p["stock"]) for code, p in products.items() if code not in known]
+            if missing:
+                version = _next_stock_version(conn)
+                conn.executemany("INSERT INTO stock (code, qty, version) VALUES (?, ?, ?)", [(code, qty, version) for code, qty in missing])
+        else:
+            version = _next_stock_version(conn)
+            _publish(conn, "catalog", "")
+            conn.execute("DELETE FROM stock")
+            conn.executemany("INSERT INTO stock (code, qty, version) VALUES (?, ?, ?)", [(code, p["stock"], version) for code, p in products.items()])
+            meta_set(conn, "products_csv_signature", _products_csv_signature())
+            meta_set(conn, "stock_changes", 0)
+class StockConflict(ValueError):
+    # A sale needed more units than are left, typically because another till
+    # sold them first. shortages maps each such code to the units available.
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__("Not enough stock left for " + ", ".join(f"{code} ({qty} available)" for code, qty in shortages.items()))
+def _next_stock_version(conn):
+    value = meta_get(conn, "stock_version")
+    version = (int(value) if value is not None else conn.execute("SELECT COALESCE(MAX(version), 0) FROM stock").fetchone()[0]) + 1
+    meta_set(conn, "stock_version", version)
+    return version
+def _apply_stock_rows(conn, deltas, check=False):
+    # With check, decrements that would leave a row below zero, or that have
+    # no row left to come out of, are refused and StockConflict is raised,
+    # which rolls back the caller's transaction.
+    version = _next_stock_version(conn)
+    levels = {}
+    shortages = {}
+    for code, delta in deltas.items():
+        if check and delta < 0:
+            cur = conn.execute("UPDATE stock SET qty = qty + ?, version = ? WHERE code = ? AND qty + ? >= 0", (delta, version, code, delta))
+        else:
+            cur = conn.execute("UPDATE stock SET qty = qty + ?, version = ? WHERE code = ?", (delta, version, code))
+        row = conn.execute("SELECT qty FROM stock WHERE code = ?", (code,)).fetchone()
+        if row is None:
+            if check and delta < 0:
+                # The product was deleted, most likely by another till.
+                shortages[code] = 0
+                continue
+            logging.warning(f"Stock change for unknown product {code} ignored")
+            continue
+        if cur.rowcount == 0:
+            shortages[code] = row[0]
+            continue
+        levels[code] = row[0]
+        _publish(conn, "stock", code, row[0])
+    if shortages:
+        raise StockConflict(shortages)
+    changes = int(meta_get(conn, "stock_changes", 0)) + len(levels)
+    meta_set(conn, "stock_changes", changes)
+    return levels, changes
+def refresh_stock_levels(products):
+    # Brings products up to date with sales made by other tills.
+    for code, qty in get_db().execute("SELECT code, qty FROM stock"):
+        if code in products:
+            products[code]["stock"] = qty
+def apply_stock_changes(deltas):
+    # deltas: {code: +restocked / -sold}. Returns the new level of each code.
+    with db_transaction() as conn:
+        levels, changes = _apply_stock_rows(conn, deltas)
+    if changes >= STOCK_COMPACT_EVERY:
+        schedule_products_compaction()
+    return levels
+def save_product_catalog(products, set_stock=()):
+    # Catalog edits rewrite products.csv. Stock for existing products is taken
+    # from the store (it may have moved since products was loaded) unless the
+    # code is listed in set_stock, i.e. the user typed a new level. Products
+    # in set_stock, new ones and deleted ones are published as changed.
+    with products_file_lock, db_transaction() as conn:
+        current = dict(conn.execute("SELECT code, qty FROM stock"))
+        version = _next_stock_version(conn)
+        for code, p in products.items():
+            if code in set_stock or code not in current:
+                conn.execute("INSERT OR REPLACE INTO stock (code, qty, version) VALUES (?, ?, ?)", (code, p["stock"], version))
+                _publish(conn, "product", code, product_fields(p))
+            else:
+                p["stock"] = current[code]
+        for code in current:
+            if code not in products:
+                conn.execute("DELETE FROM stock WHERE code = ?", (code,))
+                _publish(conn, "product", code)
+        write_products_csv(products)
+        meta_set(conn, "products_csv_signature", _products_csv_signature())
+        meta_set(conn, "stock_changes", 0)
+        last = _last_event_id(conn)
+    _catalog_cache.replace(products, last)
+def compact_products():
+    with products_file_lock:
+        if not os.path.exists(PRODUCTS_CSV):
+            return
+        products = catalog_copy()
+        with db_transaction() as conn:
+            if meta_get(conn, "products_csv_signature") != _products_csv_signature():
+                return
+            for code, qty in conn.execute("SELECT code, qty FROM stock"):
+                if code in products:
+                    products[code]["stock"] = qty
+            write_products_csv(products)
+            meta_set(conn, "products_csv_signature", _products_csv_signature())
+            meta_set(conn, "stock_changes", 0)
+            last = _last_event_id(conn)
+        _catalog_cache.replace(products, last)
+def _run_compaction():
+    try:
+        compact_products()
+    except Exception as e:
+        logging.warning(f"Background products.csv compaction failed: {e}")
+def schedule_products_compaction():
+    global _compaction_thread
+    if _compaction_thread is not None and _compaction_thread.is_alive():
+        return
+    _compaction_thread = threading.Thread(target=_run_compaction, name="products-compaction", daemon=True)
+    _compaction_thread.start()
+def compact_products_at_exit():
+    if _compaction_thread is not None:
+        _compaction_thread.join()
+    if os.path.exists(BILLING_DB) and int(meta_get(get_db(), "stock_changes", 0)):
+        _run_compaction()
+if not is_pool_worker():
+    atexit.register(compact_products_at_exit)
+# ---------- Catalog cache ----------
+# read_products() parses products.csv and converts every price to Decimal.
+# The cache keeps one parse for the whole process and follows the change
+# feed, so opening another screen costs a stat and a feed query. A snapshot
+# is never changed once handed out: new stock levels or product edits make a
+# new snapshot that shares every unchanged row. Callers that change their
+# products dict (checkout() updates stock in place) take catalog_copy().
+class CatalogCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.products = None
+        self.signature = None
+        self.feed = None
+        self.events = []
+    def _follow(self, last=None):
+        self.events = []
+        self.feed = EventFeed(last)
+        self.feed.subscribe(self.events.extend, ("stock", "product"))
+    def _load(self):
+        self._follow()
+        self.products = read_products()
+        self.signature = _products_csv_signature()
+    def snapshot(self):
+        with self.lock:
+            signature = _products_csv_signature() if os.path.exists(PRODUCTS_CSV) else None
+            if self.products is None or signature != self.signature:
+                self._load()
+                return self.products
+            self.feed.poll()
+            if not self.events:
+                return self.products
+            events, self.events[:] = list(self.events), []
+            products = dict(self.products)
+            for kind, key, data in events:
+                if kind == "reload":
+                    self._load()
+                    return self.products
+                if kind == "stock":
+                    if key in products:
+                        products[key] = dict(products[key], stock=data)
+                elif data is None:
+                    products.pop(key, None)
+                else:
+                    products[key] = product_from_fields(data)
+            self.products = products
+            return products
+    def replace(self, products, last):
+        # products.csv was just rewritten from products, which include every
+        # event up to id last.
+        with self.lock:
+            self._follow(last)
+            self.products = {code: dict(p) for code, p in products.items()}
+            self.signature = _products_csv_signature()
+_catalog_cache = CatalogCache()
+def catalog_snapshot():
+    # The current catalog, shared with every other caller: do not change it.
+    return _catalog_cache.snapshot()
+def catalog_copy():
+    return {code: dict(p) for code, p in _catalog_cache.snapshot().items()}
+# ---------- Loyalty store ----------
+# customers.csv holds the customer list. Live points balances are kept in the
+# loyalty table and every change is appended to loyalty_txn with its reason,
+# so a balance is always the sum of its transactions. The CSV's points column
+# is refreshed in the background every LOYALTY_COMPACT_EVERY changes and at
+# exit. If customers.csv is edited by hand, its points win and the difference
+# is logged as an adjustment.
+customers_file_lock = threading.Lock()
+_loyalty_compaction_thread = None
+def _customers_csv_signature():
+    st = os.stat(CUSTOMERS_CSV)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+def _log_loyalty(conn, id_, delta, reason, ref=None):
+    conn.execute("INSERT INTO loyalty_txn (customer_id, delta, reason, ref, created) VALUES (?, ?, ?, ?, ?)",
+                 (id_, delta, reason, ref, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    conn.execute("INSERT INTO loyalty VALUES (?, ?) ON CONFLICT (customer_id) DO UPDATE SET points = points + excluded.points", (id_, delta))
+def overlay_loyalty_points(customers):
+    with db_transaction() as conn:
+        trusted = meta_get(conn, "customers_csv_signature") == _customers_csv_signature()
+        current = dict(conn.execute("SELECT customer_id, points FROM loyalty"))
+        for id_, c in customers.items():
+            points = current.get(id_, 0)
+            if trusted and id_ in current:
+                c["loyalty_points"] = points
+            elif c["loyalty_points"] != points:
+                _log_loyalty(conn, id_, c["loyalty_points"] - points, "adjustment" if id_ in current else "opening")
+        if not trusted:
+            _publish(conn, "customers", "")
+            meta_set(conn, "customers_csv_signature", _customers_csv_signature())
+            meta_set(conn, "loyalty_changes", 0)
+def _apply_loyalty_rows(conn, deltas, reason, ref=None):
+    balances = {}
+    for id_, delta in deltas.items():
+        _log_loyalty(conn, id_, delta, reason, ref)
+        balances[id_] = conn.execute("SELECT points FROM loyalty WHERE customer_id = ?", (id_,)).fetchone()[0]
+        _publish(conn, "points", id_, balances[id_])
+    changes = int(meta_get(conn, "loyalty_changes", 0)) + len(balances)
+    meta_set(conn, "loyalty_changes", changes)
+    return balances, changes
+def save_customer_list(customers, set_points=()):
+    # Customer edits rewrite customers.csv. Points for existing customers are
+    # taken from the store unless the id is listed in set_points, i.e. the
+    # user typed a new balance; that change is logged as a manual adjustment.
+    with customers_file_lock, db_transaction() as conn:
+        current = dict(conn.execute("SELECT customer_id, points FROM loyalty"))
+        for id_, c in customers.items():
+            points = current.get(id_, 0)
+            if id_ in set_points or id_ not in current:
+                if c["loyalty_points"] != points:
+                    _log_loyalty(conn, id_, c["loyalty_points"] - points, "manual")
+                _publish(conn, "customer", id_, {"name": c["name"], "phone": c["phone"], "loyalty_points": c["loyalty_points"]})
+            else:
+                c["loyalty_points"] = points
+        write_customers_csv(customers)
+        meta_set(conn, "customers_csv_signature", _customers_csv_signature())
+        meta_set(conn, "loyalty_changes", 0)
+def refresh_loyalty_points(customers):
+    for id_, points in get_db().execute("SELECT customer_id, points FROM loyalty"):
+        if id_ in customers:
+            customers[id_]["loyalty_points"] = points
+def loyalty_history(customer_id):
+    return get_db().execute("SELECT created, delta, reason, ref FROM loyalty_txn WHERE customer_id = ? ORDER BY id", (customer_id,)).fetchall()
+def compact_customers():
+    with customers_file_lock:
+        if not os.path.exists(CUSTOMERS_CSV):
+            return
+        customers = read_customers()
+        with db_transaction() as conn:
+            if meta_get(conn, "customers_csv_signature") != _customers_csv_signature():
+                return
+            for id_, points in conn.execute("SELECT customer_id, points FROM loyalty"):
+                if id_ in customers:
+                    customers[id_]["loyalty_points"] = points
+            write_customers_csv(customers)
+            meta_set(conn, "customers_csv_signature", _customers_csv_signature())
+            meta_set(conn, "loyalty_changes", 0)
+def _run_loyalty_compaction():
+    try:
+        compact_customers()
+    except Exception as e:
+        logging.warning(f"Background customers.csv compaction failed: {e}")
+def schedule_loyalty_compaction():
+    global _loyalty_compaction_thread
+    if _loyalty_compaction_thread is not None and _loyalty_compaction_thread.is_alive():
+        return
+    _loyalty_compaction_thread = threading.Thread(target=_run_loyalty_compaction, name="customers-compaction", daemon=True)
+    _loyalty_compaction_thread.start()
+def compact_customers_at_exit():
+    if _loyalty_compaction_thread is not None:
+        _loyalty_compaction_thread.join()
+    if os.path.exists(BILLING_DB) and int(meta_get(get_db(), "loyalty_changes", 0)):
+        _run_loyalty_compaction()
+if not is_pool_worker():
+    atexit.register(compact_customers_at_exit)
+# ---------- Sale journal ----------
+# A sale touches the invoice CSV, stock and loyalty balances. Its intent is
+# journaled first, in the same transaction that takes the sold units out of
+# the shared stock table, so two tills cannot sell the same last unit; the CSV
+# is the commit point. On startup a pending entry whose CSV exists is rolled
+# forward, one without a CSV is rolled back and its stock put back. Entries
+# younger than JOURNAL_RECOVER_AFTER seconds may belong to another till that
+# is still running and are left alone.
+def _apply_loyalty_balances(balances, customers=None):
+    # Entries journaled before the loyalty store carry absolute balances that
+    # go straight to customers.csv; the store picks them up as an adjustment.
+    if not balances:
+        return
+    if customers is None:
+        if not os.path.exists(CUSTOMERS_CSV):
+            return
+        customers = read_customers()
+    for id_, balance in balances.items():
+        if id_ in customers:
+            customers[id_]["loyalty_points"] = balance
+    write_customers_csv(customers)
+def _finish_journal_entry(conn, entry_id, payload, customers=None):
+    for path, status in payload.get("status_updates", {}).items():
+        if os.path.exists(path):
+            update_invoice_status(path, status)
+    _apply_loyalty_balances(payload.get("loyalty", {}), customers)
+    with db_transaction(conn):
+        conn.execute("DELETE FROM sale_journal WHERE id = ?", (entry_id,))
+def commit_sale(inv_number, invoice_data, stock_deltas, loyalty=None, customers=None, write_record=None, status_updates=None, products=None):
+    # loyalty: {customer_id: points delta}. customers, when given, is the
+    # caller's in-memory customer dict; its balances are updated in place and
+    # unknown ids are dropped. products gives the cost and category recorded
+    # in the sales rollups. With inv_number None the number is allocated once
+    # the stock is reserved, so a sale that loses a race for stock does not
+    # leave a gap in the invoice series. Returns (invoice number, record path,
+    # {code: new stock level}).
+    write_record = write_record or save_invoice_csv
+    points = {id_: delta for id_, delta in (loyalty or {}).items() if delta and (customers is None or id_ in customers)}
+    # Raises StockConflict, with nothing committed, if another till has sold
+    # the stock this sale needs.
+    conn = get_db()
+    payload = {"stock": stock_deltas, "reserved": True, "points": points, "status_updates": status_updates or {},
+               "facts": invoice_sales_facts(inv_number, invoice_data, products if products is not None else catalog_snapshot())}
+    allocated = inv_number is None
+    with db_transaction(conn):
+        levels, changes = _apply_stock_rows(conn, stock_deltas, check=True)
+        if allocated:
+            inv_number = payload["facts"]["number"] = _allocate_invoice_numbers(conn, 1)[0]
+        cur = conn.execute("INSERT INTO sale_journal (inv_number, state, payload, created) VALUES (?, 'pending', ?, ?)",
+                           (inv_number, json.dumps(payload), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        entry_id = cur.lastrowid
+    try:
+        record = write_record(inv_number, invoice_data)
+    except Exception:
+        with db_transaction(conn):
+            _apply_stock_rows(conn, {code: -delta for code, delta in stock_deltas.items()})
+            conn.execute("DELETE FROM sale_journal WHERE id = ?", (entry_id,))
+            if allocated:
+                _release_invoice_numbers(conn, [inv_number])
+        raise
+    payload["record"] = record
+    with db_transaction(conn):
+        balances, loyalty_changes = _apply_loyalty_rows(conn, points, payload["facts"]["kind"], inv_number)
+        _apply_sales_facts(conn, payload["facts"])
+        conn.execute("UPDATE sale_journal SET state = 'applied', payload = ? WHERE id = ?", (json.dumps(payload), entry_id))
+    if customers is not None:
+        for id_, balance in balances.items():
+            customers[id_]["loyalty_points"] = balance
+    _finish_journal_entry(conn, entry_id, payload, customers)
+    if changes >= STOCK_COMPACT_EVERY:
+        schedule_products_compaction()
+    if loyalty_changes >= LOYALTY_COMPACT_EVERY:
+        schedule_loyalty_compaction()
+    return inv_number, record, levels
+def _apply_sale_batch(conn, payload):
+    levels, changes = ({}, 0) if payload.get("reserved") else _apply_stock_rows(conn, payload["stock"])
+    balances = {}
+    loyalty_changes = 0
+    for sale in payload["sales"]:
+        points, loyalty_changes = _apply_loyalty_rows(conn, sale["points"], "sale", sale["number"])
+        balances.update(points)
+        _apply_sales_facts(conn, sale["facts"])
+    conn.executemany("INSERT OR IGNORE INTO ingested_orders VALUES (?, ?)", payload["order_ids"])
+    if payload["checkpoint"]:
+        key, value = payload["checkpoint"]
+        meta_set(conn, key, value)
+    return levels, changes, balances, loyalty_changes
+def commit_sale_batch(orders, checkpoint, customers=None, products=None):
+    # orders: [(invoice_data, {customer_id: points delta}, order_id or None)].
+    # One journal entry covers the batch: every invoice CSV is written and
+    # flushed, then all stock, loyalty, rollup and index changes are applied
+    # in one transaction together with checkpoint, a (meta key, value) pair
+    # recording how far the source has been consumed, if there is one
+    # (checkpoint=None for sources that are not re-read). Stock is reserved up
+    # front as in commit_sale; StockConflict means no order was committed.
+    # Invoice numbers are allocated once the stock is reserved, in the same
+    # transaction, so a conflict leaves no gap in the series.
+    if products is None:
+        products = catalog_snapshot()
+    stock = {}
+    sales = []
+    for invoice_data, loyalty, order_id in orders:
+        for item in invoice_data["items"]:
+            if "CUSTOM_" not in item["code"]:
+                stock[item["code"]] = stock.get(item["code"], 0) - item["qty"]
+        sales.append({"number": None, "points": {id_: delta for id_, delta in loyalty.items() if delta},
+                      "facts": invoice_sales_facts(None, invoice_data, products)})
+    conn = get_db()
+    with db_transaction(conn):
+        levels, changes = _apply_stock_rows(conn, stock, check=True)
+        numbers = _allocate_invoice_numbers(conn, len(orders))
+        for num, sale in zip(numbers, sales):
+            sale["number"] = sale["facts"]["number"] = num
+        records = [os.path.join(INVOICES_DIR, f"invoice_{num}.csv") for num in numbers]
+        order_ids = [(order_id, num) for num, (_, _, order_id) in zip(numbers, orders) if order_id is not None]
+        payload = {"stock": stock, "reserved": True, "sales": sales, "records": records, "order_ids": order_ids, "checkpoint": list(checkpoint) if checkpoint else None}
+        cur = conn.execute("INSERT INTO sale_journal (inv_number, state, payload, created) VALUES (?, 'pending', ?, ?)",
+                           (numbers[0], json.dumps(payload), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        entry_id = cur.lastrowid
+    try:
+        for num, path, (invoice_data, _, _) in zip(numbers, records, orders):
+            _write_invoice_csv(path, num, invoice_data, durable=False)
+        fsync_files(records)
+    except Exception:
+        for path in records:
+            if os.path.exists(path):
+                os.remove(path)
+        with db_transaction(conn):
+            _apply_stock_rows(conn, {code: -delta for code, delta in stock.items()})
+            conn.execute("DELETE FROM sale_journal WHERE id = ?", (entry_id,))
+            _release_invoice_numbers(conn, numbers)
+        raise
+    with db_transaction(conn):
+        _, _, balances, loyalty_changes = _apply_sale_batch(conn, payload)
+        for num, path, (invoice_data, _, _) in zip(numbers, records, orders):
+            st = os.stat(path)
+            _store_index_row(conn, num, os.path.basename(path), _invoice_index_fields(invoice_data), st.st_mtime_ns, st.st_size)
+        conn.execute("UPDATE sale_journal SET state = 'applied' WHERE id = ?", (entry_id,))
+    _finish_journal_entry(conn, entry_id, payload, customers)
+    if customers is not None:
+        for id_, balance in balances.items():
+            if id_ in customers:
+                customers[id_]["loyalty_points"] = balance
+    if changes >= STOCK_COMPACT_EVERY:
+        schedule_products_compaction()
+    if loyalty_changes >= LOYALTY_COMPACT_EVERY:
+        schedule_loyalty_compaction()
+    return numbers, levels
+def _recover_sale_batch(conn, entry_id, state, payload):
+    # A batch is rolled forward only if every one of its invoices was written;
+    # otherwise the files it did write are removed and the source is read
+    # again from the previous checkpoint. Index rows are left to the next sync.
+    records = payload["records"]
+    if state == "pending":
+        if not all(os.path.exists(path) for path in records):
+            logging.warning(f"Rolling back unfinished batch of {len(records)} invoices")
+            for path in records:
+                if os.path.exists(path):
+                    os.remove(path)
+            with db_transaction(conn):
+                _release_reserved_stock(conn, payload)
+                conn.execute("DELETE FROM sale_journal WHERE id = ?", (entry_id,))
+            return False
+        with db_transaction(conn):
+            _apply_sale_batch(conn, payload)
+            conn.execute("UPDATE sale_journal SET state = 'applied' WHERE id = ?", (entry_id,))
+    logging.warning(f"Completing interrupted batch of {len(records)} invoices")
+    _finish_journal_entry(conn, entry_id, payload)
+    return True
+def _release_reserved_stock(conn, payload):
+    if payload.get("reserved"):
+        _apply_stock_rows(conn, {code: -delta for code, delta in payload["stock"].items()})
+def recover_sale_journal():
+    if not os.path.exists(BILLING_DB):
+        return 0
+    conn = get_db()
+    recovered = 0
+    cutoff = (datetime.now() - timedelta(seconds=JOURNAL_RECOVER_AFTER)).strftime("%Y-%m-%d %H:%M:%S")
+    for entry_id, inv_number, state, raw in conn.execute("SELECT id, inv_number, state, payload FROM sale_journal WHERE COALESCE(created, '') < ? ORDER BY id", (cutoff,)).fetchall():
+        payload = json.loads(raw)
+        if "sales" in payload:
+            recovered += _recover_sale_batch(conn, entry_id, state, payload)
+            continue
+        if state == "pending":
+            record = payload.get("record")
+            if record is None:
+                record = os.path.join(INVOICES_DIR, f"invoice_{inv_number}.csv")
+                if not os.path.exists(record):
+                    record = os.path.join(INVOICES_DIR, f"return_{inv_number}.csv")
+            if not os.path.exists(record):
+                logging.warning(f"Rolling back unfinished sale #{inv_number}: no invoice file was written")
+                with db_transaction(conn):
+                    _release_reserved_stock(conn, payload)
+                    conn.execute("DELETE FROM sale_journal WHERE id = ?", (entry_id,))
+                continue
+            with db_transaction(conn):
+                if not payload.get("reserved"):
+                    _apply_stock_rows(conn, payload.get("stock", {}))
+                if "points" in payload:
+                    _apply_loyalty_rows(conn, payload["points"], payload["facts"]["kind"], inv_number)
+                if "facts" in payload:
+                    _apply_sales_facts(conn, payload["facts"])
+                conn.execute("UPDATE sale_journal SET state = 'applied' WHERE id = ?", (entry_id,))
+        logging.warning(f"Completing interrupted sale #{inv_number}")
+        _finish_journal_entry(conn, entry_id, payload)
+        recovered += 1
+    return recovered
+# ---------- Invoice header index ----------
+def invoice_number_from_fname(fname, prefix="invoice_"):
+    if fname.startswith(prefix) and fname.endswith(".csv"):
+        try:
+            return int(fname[len(prefix):-len(".csv")])
+        except ValueError:
+            logging.warning(f"Invalid invoice filename: {fname}")
+    return None
+class InvoiceRecord:
+    # One invoice or return file. The key/value rows above and below the item
+    # table stay strings in fields; item rows are kept as read and only typed
+    # when items is first used, so header-only readers never pay for them.
+    __slots__ = ("path", "fname", "kind", "number", "mtime_ns", "size", "fields", "_rows", "_items")
+    def __init__(self, path, fields, rows):
+        self.path = path
+        self.fname = os.path.basename(path)
+        self.kind = "return" if self.fname.startswith("return_") else "sale"
+        self.number = invoice_number_from_fname(self.fname, prefix="return_" if self.kind == "return" else "invoice_")
+        self.mtime_ns = None
+        self.size = None
+        self.fields = fields
+        self._rows = rows
+        self._items = None
+    @property
+    def items(self):
+        if self._items is None:
+            # cost_price is the unit cost at the time of sale; None in legacy
+            # files and for lines written without one.
+            self._items = [{"code": row[0], "name": row[1], "price": Decimal(row[2]), "qty": int(row[3]), "line_total": Decimal(row[4]),
+                            "cost_price": Decimal(row[5]) if len(row) > 5 and row[5] else None}
+                           for row in self._rows]
+            self._rows = None
+        return self._items
+    def invoice_data(self):
+        fields = self.fields
+        data = {
+            "shop_name": fields.get("shop_name", SHOP_NAME),
+            "gst_number": fields.get("gst_number", GST_NUMBER),
+            "date": fields.get("date", ""),
+            "customer_name": fields.get("customer_name", ""),
+            "customer_phone": fields.get("customer_phone", ""),
+            "customer_id": fields.get("customer_id", ""),
+            "items": self.items,
+            "points_awarded": int(fields.get("points_awarded") or 0),
+            "payment_status": fields.get("payment_status", "pending"),
+            "total_item_count": int(fields.get("total_item_count") or sum(it["qty"] for it in self.items))
+        }
+        for key in ("subtotal", "discount_percent", "discount_amount", "subtotal_after_discount", "gst_percent", "gst_total", "cgst", "sgst", "grand_total"):
+            data[key] = Decimal(fields.get(key) or "0")
+        return data
+def read_invoice(path):
+    # The one parser for the invoice/return CSV layout: key/value rows, then
+    # the item table, then more key/value rows. Rows are streamed, not listed.
+    fields = {}
+    rows = []
+    width = 0
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if row == INVOICE_ITEM_HEADER or row == LEGACY_ITEM_HEADER:
+                width = len(row)
+                continue
+            if width:
+                if len(row) == width:
+                    rows.append(row)
+                    continue
+                width = 0
+            if len(row) == 2 and row[0]:
+                fields[row[0]] = row[1]
+    return InvoiceRecord(path, fields, rows)
+def _store_index_row(conn, num, fname, fields, mtime_ns, size, publish=True):
+    # Folder scans pass publish=False: the files they find were published by
+    # whoever wrote them.
+    try:
+        item_count = int(fields.get("total_item_count") or 0)
+    except ValueError:
+        item_count = 0
+    row = (num, fields.get("date", ""), fields.get("customer_name", ""), fields.get("grand_total", ""),
+           fields.get("payment_status", "pending"), item_count, fname)
+    conn.execute("INSERT OR REPLACE INTO invoice_index VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row + (mtime_ns, size))
+    if publish:
+        _publish(conn, "invoice", num, row[1:])
+def _invoice_dir_signature():
+    return str(os.stat(INVOICES_DIR).st_mtime_ns)
+def _invoice_index_changes(conn):
+    # One stat per invoice file, no parsing: the files whose (mtime_ns, size)
+    # differ from their index row, and the rows whose file is gone. Files
+    # edited in place leave the folder's mtime alone, so it is not enough.
+    known = {fname: (mtime_ns, size) for fname, mtime_ns, size in conn.execute("SELECT fname, mtime_ns, size FROM invoice_index")}
+    seen = set()
+    def changed(fname, st):
+        seen.add(fname)
+        return known.get(fname) != (st.st_mtime_ns, st.st_size)
+    files = list_invoice_files(prefixes=("invoice_",), only=changed)
+    return files, set(known) - seen
+def invoice_index_is_current(conn=None):
+    ensure_invoices_dir()
+    files, vanished = _invoice_index_changes(conn or get_db())
+    return not files and not vanished
+def sync_invoice_index(conn=None, progress=None):
+    # Every file is stat'ed; only new or modified invoice files are parsed and
+    # rows for vanished files are dropped.
+    ensure_invoices_dir()
+    conn = conn or get_db()
+    files, vanished = _invoice_index_changes(conn)
+    if not files and not vanished:
+        return
+    with conn:
+        for record in scan_invoice_files(files, progress=progress):
+            _store_index_row(conn, record.number, record.fname, record.fields, record.mtime_ns, record.size, publish=False)
+        for fname in vanished:
+            conn.execute("DELETE FROM invoice_index WHERE fname = ?", (fname,))
+def index_invoice_file(inv_number, filename, fields):
+    if os.path.dirname(os.path.abspath(filename)) != os.path.abspath(INVOICES_DIR):
+        return
+    conn = get_db()
+    with conn:
+        st = os.stat(filename)
+        _store_index_row(conn, int(inv_number), os.path.basename(filename), fields, st.st_mtime_ns, st.st_size)
+def update_invoice_status(csvfile, new_status):
+    with open(csvfile, newline='', encoding='utf-8') as f:
+        data = list(csv.reader(f))
+    for row in data:
+        if row and row[0] == "payment_status":
+            row[1] = new_status
+            break
+    with atomic_open(csvfile) as f:
+        writer = csv.writer(f)
+        writer.writerows(data)
+    num = invoice_number_from_fname(os.path.basename(csvfile))
+    if num is not None:
+        index_invoice_file(num, csvfile, dict(row for row in data if len(row) == 2 and row[0]))
+def clear_invoice_index():
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM invoice_index")
+        _publish(conn, "invoice", "")
+def invoice_index_rows(sync=True):
+    # sync=False for callers that have just synced, e.g. in the background.
+    conn = get_db()
+    if sync:
+        sync_invoice_index(conn)
+    return conn.execute("SELECT number, date, customer_name, grand_total, payment_status, item_count, fname FROM invoice_index ORDER BY number").fetchall()
+# ---------- Bulk invoice scanning ----------
+def _parse_invoice_chunk(chunk):
+    # Runs in a worker process; errors are returned so one bad file does not
+    # lose the rest of the chunk.
+    records = []
+    errors = []
+    for path, mtime_ns, size in chunk:
+        try:
+            record = read_invoice(path)
+        except Exception as e:
+            errors.append((os.path.basename(path), str(e)))
+            continue
+        record.mtime_ns = mtime_ns
+        record.size = size
+        records.append(record)
+    return records, errors
+def list_invoice_files(prefixes=("invoice_", "return_"), only=None):
+    files = []
+    with os.scandir(INVOICES_DIR) as entries:
+        for entry in entries:
+            for prefix in prefixes:
+                number = invoice_number_from_fname(entry.name, prefix=prefix)
+                if number is None or not entry.is_file():
+                    continue
+                st = entry.stat()
+                if only is None or only(entry.name, st):
+                    files.append((prefix, number, entry.path, st.st_mtime_ns, st.st_size))
+                break
+    files.sort()
+    return [(path, mtime_ns, size) for _, _, path, mtime_ns, size in files]
+def scan_invoices(prefixes=("invoice_", "return_"), only=None, progress=None, workers=SCAN_WORKERS, chunk_size=SCAN_CHUNK_SIZE):
+    # Yields an InvoiceRecord, with mtime_ns and size set, for every readable
+    # invoice file; items stay unparsed until used. only(fname, stat) can
+    # skip files before they are read. Large folders are parsed by a process
+    # pool a chunk at a time; progress(done, total) is called per chunk.
+    ensure_invoices_dir()
+    return scan_invoice_files(list_invoice_files(prefixes, only), progress, workers, chunk_size)
+def scan_invoice_files(files, progress=None, workers=SCAN_WORKERS, chunk_size=SCAN_CHUNK_SIZE):
+    # scan_invoices() for a list of (path, mtime_ns, size) already taken.
+    total = len(files)
+    chunks = [files[i:i + chunk_size] for i in range(0, total, chunk_size)]
+    if progress:
+        progress(0, total)
+    if workers > 1 and total >= SCAN_PARALLEL_MIN:
+        # spawn, not fork: the parent has Tk and render threads running.
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        results = pool.map(_parse_invoice_chunk, chunks)
+    else:
+        pool = None
+        results = map(_parse_invoice_chunk, chunks)
+    try:
+        done = 0
+        for records, errors in results:
+            for fname, error in errors:
+                logging.warning(f"Error reading {fname}: {error}")
+            yield from records
+            done += len(records) + len(errors)
+            if progress:
+                progress(done, total)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+# ---------- Sales rollups ----------
+# Daily, per-SKU and per-category totals of units, revenue and cost, updated
+# in the same transaction that applies a sale's stock changes. Amounts are
+# integer paise so SQLite can sum them exactly. kind is "sale" or "return";
+# return rows carry the negative quantities and totals of the return file.
+# Sales to a known customer also get a row in that customer's ledger.
+SALES_FACTS_VERSION = "2" # bumped when a rebuild is needed to fill new tables
+def _cents(value):
+    return int(Decimal(value).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP) * 100)
+def sales_facts(kind, number, date, grand_total, items, products, customer="", points=0):
+    lines = []
+    for it in items:
+        code, qty = it["code"], it["qty"]
+        prod = products.get(code, {})
+        category = "Custom" if "CUSTOM_" in code else prod.get("category", "Unknown")
+        # The unit cost recorded with the sale; the catalog's current cost is
+        # only a fallback for files written before costs were recorded.
+        unit_cost = it.get("cost_price")
+        if unit_cost is None:
+            unit_cost = prod.get("cost_price", Decimal("0"))
+        cost = unit_cost * Decimal(qty)
+        lines.append([code, it["name"], category, qty, _cents(it["price"]) * qty, _cents(cost)])
+    return {"kind": kind, "number": number, "day": date[:10], "total": _cents(grand_total), "lines": lines,
+            "customer": customer, "points": points}
+def invoice_sales_facts(number, invoice_data, products):
+    kind = "return" if "original_invoice" in invoice_data else "sale"
+    points = invoice_data.get("points_deducted" if kind == "return" else "points_awarded", 0)
+    return sales_facts(kind, number, invoice_data["date"], invoice_data["grand_total"], invoice_data["items"], products,
+                       invoice_data.get("customer_id", ""), int(points or 0))
+def _apply_sales_facts(conn, facts, publish=True):
+    # Recording the same invoice twice (journal recovery) is a no-op.
+    kind = facts["kind"]
+    if conn.execute("INSERT OR IGNORE INTO sales_recorded VALUES (?, ?)", (kind, facts["number"])).rowcount == 0:
+        return
+    if publish:
+        _publish(conn, "sale", facts["number"], {"kind": kind, "day": facts["day"], "total": facts["total"], "customer": facts.get("customer", "")})
+    lines = facts["lines"]
+    conn.execute(
+        "INSERT INTO sales_daily VALUES (?, ?, 1, ?, ?, ?) ON CONFLICT (day, kind) DO UPDATE SET "
+        "invoices = invoices + 1, units = units + excluded.units, revenue = revenue + excluded.revenue, cost = cost + excluded.cost",
+        (facts["day"], kind, sum(line[3] for line in lines), facts["total"], sum(line[5] for line in lines))
+    )
+    for code, name, category, units, revenue, cost in lines:
+        conn.execute(
+            "INSERT INTO sales_sku VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (code, kind) DO UPDATE SET "
+            "name = excluded.name, category = excluded.category, units = units + excluded.units, "
+            "revenue = revenue + excluded.revenue, cost = cost + excluded.cost",
+            (code, kind, name, category, units, revenue, cost)
+        )
+        conn.execute(
+            "INSERT INTO sales_category VALUES (?, ?, ?, ?, ?) ON CONFLICT (category, kind) DO UPDATE SET "
+            "units = units + excluded.units, revenue = revenue + excluded.revenue, cost = cost + excluded.cost",
+            (category, kind, units, revenue, cost)
+        )
+    if facts.get("customer"):
+        conn.execute("INSERT INTO customer_ledger VALUES (?, ?, ?, ?, ?, ?)",
+                     (facts["customer"], kind, facts["number"], facts["day"], facts["total"], facts.get("points", 0)))
+def _clear_sales_facts(conn):
+    for table in ("sales_recorded", "sales_daily", "sales_sku", "sales_category", "customer_ledger"):
+        conn.execute(f"DELETE FROM {table}")
+    _publish(conn, "sale", "")
+def clear_sales_facts():
+    with db_transaction() as conn:
+        _clear_sales_facts(conn)
+        meta_set(conn, "sales_facts_ready", SALES_FACTS_VERSION)
+def backfill_sales_facts(products=None, progress=None, customers=None):
+    # Rebuilds every rollup and customer ledger from the invoice and return
+    # files on disk. Files written before customer IDs were recorded are
+    # matched to a customer by name, but only when the name is unique.
+    if products is None:
+        products = catalog_snapshot()
+    if customers is None:
+        customers = read_customers() if os.path.exists(CUSTOMERS_CSV) else {}
+    name_ids = {}
+    for id_, c in customers.items():
+        name_ids.setdefault(c["name"], []).append(id_)
+    facts = []
+    for record in scan_invoices(progress=progress):
+        fields = record.fields
+        customer = fields.get("customer_id", "")
+        if "customer_id" not in fields and len(name_ids.get(fields.get("customer_name", ""), ())) == 1:
+            customer = name_ids[fields["customer_name"]][0]
+        try:
+            points = int(fields.get("points_deducted" if record.kind == "return" else "points_awarded") or 0)
+            facts.append(sales_facts(record.kind, record.number, fields.get("date", ""), fields.get("grand_total") or "0", record.items, products,
+                                     customer, points))
+        except Exception as e:
+            logging.warning(f"Error processing {record.fname} for sales rollups: {e}")
+    with db_transaction() as conn:
+        _clear_sales_facts(conn)
+        for f in facts:
+            _apply_sales_facts(conn, f, publish=False)
+        meta_set(conn, "sales_facts_ready", SALES_FACTS_VERSION)
+    return len(facts)
+def sales_facts_ready():
+    return meta_get(get_db(), "sales_facts_ready") == SALES_FACTS_VERSION
+def ensure_sales_facts(products=None):
+    # Installs that predate the rollups get them built on first use.
+    if not sales_facts_ready():
+        backfill_sales_facts(products)
+def category_sales(kind="sale"):
+    ensure_sales_facts()
+    return [(category, units, Decimal(revenue).scaleb(-2), Decimal(cost).scaleb(-2)) for category, units, revenue, cost in get_db().execute(
+        "SELECT category, units, revenue, cost FROM sales_category WHERE kind = ? ORDER BY category", (kind,))]
+def daily_sales_totals(start_date, end_date, kind="sale"):
+    ensure_sales_facts()
+    return [(day, Decimal(revenue).scaleb(-2)) for day, revenue in get_db().execute(
+        "SELECT day, revenue FROM sales_daily WHERE kind = ? AND day BETWEEN ? AND ? ORDER BY day",
+        (kind, start_date, end_date))]
+def customer_ledger(customer_id):
+    ensure_sales_facts()
+    return [(kind, number, day, Decimal(total).scaleb(-2), points) for kind, number, day, total, points in get_db().execute(
+        "SELECT kind, number, day, total, points FROM customer_ledger WHERE customer_id = ? ORDER BY day, number", (customer_id,))]
+def customer_lifetime(customer_id):
+    # (invoices, net spend after returns, net points earned)
+    ensure_sales_facts()
+    invoices, total, points = get_db().execute(
+        "SELECT COUNT(CASE WHEN kind = 'sale' THEN 1 END), COALESCE(SUM(total), 0), COALESCE(SUM(points), 0) FROM customer_ledger WHERE customer_id = ?",
+        (customer_id,)).fetchone()
+    return invoices, Decimal(total).scaleb(-2), points
+# ---------- Columnar sales history ----------
+# Invoices and returns compacted into one folder per month under HISTORY_DIR.
+# Every column is a flat file of fixed-width integers (amounts in paise,
+# days as YYYYMMDD, strings as ids into the partition's dictionaries), so a
+# report can memory-map just the columns it needs and aggregate them with
+# NumPy, or with plain loops when NumPy is not installed.
+HISTORY_INVOICE_COLUMNS = {"number": "q", "kind": "b", "day": "i", "grand_total": "q", "item_count": "i", "customer": "i"}
+HISTORY_LINE_COLUMNS = {"number": "q", "kind": "b", "day": "i", "code": "i", "category": "i", "qty": "q", "revenue": "q", "cost": "q"}
+HISTORY_KINDS = {"sale": 0, "return": 1}
+HISTORY_FORMAT = 2 # bump when the partition layout changes; old months are rebuilt
+def _history_day(date):
+    try:
+        return int(date[:10].replace("-", ""))
+    except ValueError:
+        return 0
+def _history_month(date):
+    day = _history_day(date)
+    return f"{day // 10000:04d}-{day // 100 % 100:02d}"
+def history_months():
+    if not os.path.isdir(HISTORY_DIR):
+        return []
+    return sorted(name for name in os.listdir(HISTORY_DIR)
+                  if len(name) == 7 and name[4] == "-" and os.path.isdir(os.path.join(HISTORY_DIR, name)))
+def _read_history_json(month, name="meta.json"):
+    with open(os.path.join(HISTORY_DIR, month, name), encoding='utf-8') as f:
+        return json.load(f)
+def _write_history_partition(month, records, products):
+    dicts = {"customer": {}, "code": {}, "category": {}}
+    def intern(name, value):
+        ids = dicts[name]
+        return ids.setdefault(value, len(ids))
+    invoices = {name: array(typecode) for name, typecode in HISTORY_INVOICE_COLUMNS.items()}
+    lines = {name: array(typecode) for name, typecode in HISTORY_LINE_COLUMNS.items()}
+    files = {}
+    item_names = {}
+    for record in sorted(records, key=lambda r: (r.kind, r.number)):
+        fields = record.fields
+        facts = sales_facts(record.kind, record.number, fields.get("date", ""), fields.get("grand_total") or "0", record.items, products)
+        kind = HISTORY_KINDS[record.kind]
+        day = _history_day(facts["day"])
+        for name, value in (("number", record.number), ("kind", kind), ("day", day), ("grand_total", facts["total"]),
+                            ("item_count", sum(line[3] for line in facts["lines"])), ("customer", intern("customer", fields.get("customer_name", "")))):
+            invoices[name].append(value)
+        for code, item_name, category, qty, revenue, cost in facts["lines"]:
+            item_names[code] = item_name
+            for name, value in (("number", record.number), ("kind", kind), ("day", day), ("code", intern("code", code)),
+                                ("category", intern("category", category)), ("qty", qty), ("revenue", revenue), ("cost", cost)):
+                lines[name].append(value)
+        files[record.fname] = [record.mtime_ns, record.size]
+    # Build next to the live partition and swap it in, so readers never see
+    # a half-written month.
+    tmp = os.path.join(HISTORY_DIR, f".{month}.{uuid.uuid4().hex}.tmp")
+    os.makedirs(tmp)
+    for table, columns in (("invoices", invoices), ("lines", lines)):
+        for name, values in columns.items():
+            with open(os.path.join(tmp, f"{table}.{name}.bin"), "wb") as f:
+                values.tofile(f)
+    # The source file list is only needed by compaction, so it is kept out of
+    # meta.json, which every report reads.
+    meta = {"format": HISTORY_FORMAT, "byteorder": sys.byteorder, "rows": {"invoices": len(invoices["number"]), "lines": len(lines["number"])},
+            "dicts": {name: list(ids) for name, ids in dicts.items()}, "names": [item_names[code] for code in dicts["code"]]}
+    with atomic_open(os.path.join(tmp, "files.json")) as f:
+        json.dump(files, f)
+    with atomic_open(os.path.join(tmp, "meta.json")) as f:
+        json.dump(meta, f)
+    target = os.path.join(HISTORY_DIR, month)
+    if os.path.exists(target):
+        old = f"{target}.{uuid.uuid4().hex}.old"
+        os.rename(target, old)
+        os.rename(tmp, target)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.rename(tmp, target)
+def history_is_current():
+    ensure_invoices_dir()
+    return meta_get(get_db(), "history_dir_signature") == _invoice_dir_signature()
+def compact_sales_history(products=None, progress=None):
+    # Only months with an added, changed or removed invoice or return file are
+    # rebuilt; a month is identified by the dates inside its files, so new
+    # and changed files are read once to place them.
+    ensure_invoices_dir()
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    signature = _invoice_dir_signature()
+    known = {}
+    dirty = set()
+    for month in history_months():
+        try:
+            meta = _read_history_json(month)
+            files = _read_history_json(month, "files.json")
+        except (OSError, ValueError):
+            meta = None
+        if not meta or meta.get("format") != HISTORY_FORMAT or meta.get("byteorder") != sys.byteorder:
+            dirty.add(month)
+            continue
+        for fname, (mtime_ns, size) in files.items():
+            known[fname] = (month, mtime_ns, size)
+    listed = set()
+    def changed(fname, st):
+        listed.add(fname)
+        old = known.get(fname)
+        return old is None or old[1:] != (st.st_mtime_ns, st.st_size)
+    fresh = list(scan_invoices(only=changed, progress=progress))
+    for record in fresh:
+        dirty.add(_history_month(record.fields.get("date", "")))
+        if record.fname in known:
+            dirty.add(known[record.fname][0])
+    for fname, (month, _, _) in known.items():
+        if fname not in listed:
+            dirty.add(month)
+    fresh_names = {record.fname for record in fresh}
+    keep = {fname for fname, (month, _, _) in known.items() if month in dirty and fname in listed and fname not in fresh_names}
+    records = fresh + (list(scan_invoices(only=lambda fname, st: fname in keep, progress=progress)) if keep else [])
+    by_month = {}
+    for record in records:
+        by_month.setdefault(_history_month(record.fields.get("date", "")), []).append(record)
+    if dirty and products is None:
+        products = catalog_snapshot()
+    for month in sorted(dirty):
+        if by_month.get(month):
+            _write_history_partition(month, by_month[month], products)
+        elif os.path.isdir(os.path.join(HISTORY_DIR, month)):
+            shutil.rmtree(os.path.join(HISTORY_DIR, month), ignore_errors=True)
+    with db_transaction() as conn:
+        meta_set(conn, "history_dir_signature", signature)
+    return sorted(dirty)
+_numpy = False
+def numpy_module():
+    # NumPy, or None when it is not installed.
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+def load_history_columns(month, table, names):
+    # Memory-maps the requested columns: NumPy arrays when NumPy is available,
+    # otherwise typed memoryviews over mmap.
+    np = numpy_module()
+    types = HISTORY_INVOICE_COLUMNS if table == "invoices" else HISTORY_LINE_COLUMNS
+    columns = {}
+    for name in names:
+        typecode = types[name]
+        path = os.path.join(HISTORY_DIR, month, f"{table}.{name}.bin")
+        if os.path.getsize(path) == 0:
+            columns[name] = np.zeros(0, dtype=typecode) if np is not None else array(typecode)
+        elif np is not None:
+            columns[name] = np.memmap(path, dtype=typecode, mode="r")
+        else:
+            with open(path, "rb") as f:
+                columns[name] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+    return columns
+def _history_day_label(day):
+    return f"{day // 10000:04d}-{day // 100 % 100:02d}-{day % 100:02d}"
+def _history_months_in(start_date, end_date):
+    return [month for month in history_months() if start_date[:7] <= month <= (end_date[:7] or "9999-12")]
+def _history_range(start_date, end_date):
+    return (_history_day(start_date) if start_date else 0), (_history_day(end_date) if end_date else 99991231)
+def _history_group_sums(month, group, start_day, end_day, kind):
+    # {group key: [units, revenue, cost]} for the month's lines in the range.
+    # Keys are dictionary ids for code and category, YYYYMMDD ints for day.
+    cols = load_history_columns(month, "lines", ("kind", "day", group, "qty", "revenue", "cost"))
+    np = numpy_module()
+    if np is not None:
+        mask = (cols["kind"] == kind) & (cols["day"] >= start_day) & (cols["day"] <= end_day)
+        ids = cols[group][mask]
+        if not len(ids):
+            return {}
+        keys, ids = np.unique(ids, return_inverse=True)
+        # bincount sums in float64, which is exact for integers below 2**53.
+        sums = [np.bincount(ids, weights=cols[name][mask]) for name in ("qty", "revenue", "cost")]
+        return {int(key): [int(round(column[i])) for column in sums] for i, key in enumerate(keys)}
+    sums = {}
+    for k, day, key, qty, revenue, cost in zip(cols["kind"], cols["day"], cols[group], cols["qty"], cols["revenue"], cols["cost"]):
+        if k == kind and start_day <= day <= end_day:
+            total = sums.get(key)
+            if total is None:
+                total = sums[key] = [0, 0, 0]
+            total[0] += qty
+            total[1] += revenue
+            total[2] += cost
+    return sums
+def history_group_totals(group, start_date="", end_date="", kind="sale"):
+    # Units, revenue and cost per code, category or day over a date range,
+    # read from the compacted history. Call compact_sales_history first.
+    start_day, end_day = _history_range(start_date, end_date)
+    totals = {}
+    for month in _history_months_in(start_date, end_date):
+        names = _read_history_json(month)["dicts"][group] if group != "day" else None
+        for key, (units, revenue, cost) in _history_group_sums(month, group, start_day, end_day, HISTORY_KINDS[kind]).items():
+            total = totals.setdefault(names[key] if names else _history_day_label(key), [0, 0, 0])
+            total[0] += units
+            total[1] += revenue
+            total[2] += cost
+    return [(name, units, Decimal(revenue).scaleb(-2), Decimal(cost).scaleb(-2)) for name, (units, revenue, cost) in sorted(totals.items())]
+def history_sales_total(start_date="", end_date="", kind="sale"):
+    # Sum of invoice grand totals (after discount and GST) over a date range.
+    start_day, end_day = _history_range(start_date, end_date)
+    total = 0
+    for month in _history_months_in(start_date, end_date):
+        cols = load_history_columns(month, "invoices", ("kind", "day", "grand_total"))
+        if numpy_module() is not None:
+            mask = (cols["kind"] == HISTORY_KINDS[kind]) & (cols["day"] >= start_day) & (cols["day"] <= end_day)
+            total += int(cols["grand_total"][mask].sum())
+        else:
+            total += sum(amount for k, day, amount in zip(cols["kind"], cols["day"], cols["grand_total"])
+                         if k == HISTORY_KINDS[kind] and start_day <= day <= end_day)
+    return Decimal(total).scaleb(-2)
+def history_item_names():
+    # Item names as last written on an invoice, for codes no longer (or never)
+    # in the catalog such as custom items.
+    names = {}
+    for month in history_months():
+        meta = _read_history_json(month)
+        names.update(zip(meta["dicts"]["code"], meta["names"]))
+    return names
+def scan_next_invoice_number():
+    nums = []
+    for fname in os.listdir(INVOICES_DIR):
+        n = invoice_number_from_fname(fname)
+        if n is None:
+            n = invoice_number_from_fname(fname, prefix="return_")
+        if n is not None:
+            nums.append(n)
+    return max(nums + [0]) + 1
+def _invoice_number_taken(num):
+    return (os.path.exists(os.path.join(INVOICES_DIR, f"invoice_{num}.csv"))
+            or os.path.exists(os.path.join(INVOICES_DIR, f"return_{num}.csv")))
+def _allocate_invoice_numbers(conn, count):
+    # Consumes count consecutive numbers from a durable counter, inside the
+    # caller's transaction. The folder is only scanned once, to seed the
+    # counter for existing installs.
+    ensure_invoices_dir()
+    value = meta_get(conn, "next_invoice_number")
+    num = int(value) if value is not None else scan_next_invoice_number()
+    taken = [n for n in range(num, num + count) if _invoice_number_taken(n)]
+    while taken:
+        num = taken[-1] + 1
+        taken = [n for n in range(num, num + count) if _invoice_number_taken(n)]
+    meta_set(conn, "next_invoice_number", num + count)
+    return list(range(num, num + count))
+def _release_invoice_numbers(conn, numbers):
+    # Hands back numbers that were never used, if nobody has allocated any
+    # after them, so the series stays consecutive.
+    if meta_get(conn, "next_invoice_number") == str(numbers[-1] + 1):
+        meta_set(conn, "next_invoice_number", numbers[0])
+def next_invoice_numbers(count):
+    with db_transaction() as conn:
+        return _allocate_invoice_numbers(conn, count)
+def next_invoice_number():
+    return next_invoice_numbers(1)[0]
+def reset_invoice_number():
+    with db_transaction() as conn:
+        meta_set(conn, "next_invoice_number", 1)
+def _invoice_index_fields(invoice_data):
+    return {
+        "date": invoice_data["date"],
+        "customer_name": invoice_data.get("customer_name", ""),
+        "grand_total": money(invoice_data["grand_total"]),
+        "payment_status": invoice_data.get("payment_status", "pending"),
+        "total_item_count": invoice_data["total_item_count"]
+    }
+def save_invoice_csv(inv_number, invoice_data, filename=None):
+    ensure_invoices_dir()
+    if filename is None:
+        filename = os.path.join(INVOICES_DIR, f"invoice_{inv_number}.csv")
+    _write_invoice_csv(filename, inv_number, invoice_data)
+    index_invoice_file(inv_number, filename, _invoice_index_fields(invoice_data))
+    return filename
+def _write_invoice_csv(filename, inv_number, invoice_data, durable=True):
+    with atomic_open(filename, durable=durable) as f:
+        writer = csv.writer(f)
+        writer.writerow(["shop_name", SHOP_NAME])
+        writer.writerow(["gst_number", GST_NUMBER])
+        writer.writerow(["invoice_number", inv_number])
+        writer.writerow(["date", invoice_data["date"]])
+        writer.writerow(["customer_name", invoice_data.get("customer_name", "")])
+        writer.writerow(["customer_phone", invoice_data.get("customer_phone", "")])
+        writer.writerow(["customer_id", invoice_data.get("customer_id", "")])
+        writer.writerow(["total_item_count", invoice_data["total_item_count"]])
+        writer.writerow([])
+        writer.writerow(INVOICE_ITEM_HEADER)
+        for row in invoice_data["items"]:
+            writer.writerow([row["code"], row["name"], money(row["price"]), row["qty"], money(row["line_total"]), _money_or_blank(row.get("cost_price"))])
+        writer.writerow([])
+        writer.writerow(["subtotal", money(invoice_data["subtotal"])])
+        writer.writerow(["discount_percent", str(invoice_data["discount_percent"])])
+        writer.writerow(["discount_amount", money(invoice_data["discount_amount"])])
+        writer.writerow(["subtotal_after_discount", money(invoice_data["subtotal_after_discount"])])
+        writer.writerow(["gst_percent", str(invoice_data["gst_percent"])])
+        writer.writerow(["gst_total", money(invoice_data["gst_total"])])
+        writer.writerow(["cgst", money(invoice_data["cgst"])])
+        writer.writerow(["sgst", money(invoice_data["sgst"])])
+        writer.writerow(["grand_total", money(invoice_data["grand_total"])])
+        writer.writerow(["points_awarded", invoice_data.get("points_awarded", 0)])
+        writer.writerow(["payment_status", invoice_data.get("payment_status", "pending")])
+def save_return_csv(return_num, return_data, filename=None):
+    ensure_invoices_dir()
+    if filename is None:
+        filename = os.path.join(INVOICES_DIR, f"return_{return_num}.csv")
+    with atomic_open(filename) as f:
+        writer = csv.writer(f)
+        writer.writerow(["shop_name", SHOP_NAME])
+        writer.writerow(["return_number", return_num])
+        writer.writerow(["original_invoice", return_data["original_invoice"]])
+        writer.writerow(["date", return_data["date"]])
+        writer.writerow(["customer_name", return_data["customer_name"]])
+        writer.writerow(["customer_phone", return_data["customer_phone"]])
+        writer.writerow(["customer_id", return_data.get("customer_id", "")])
+        writer.writerow([])
+        writer.writerow(INVOICE_ITEM_HEADER)
+        for row in return_data["items"]:
+            writer.writerow([row["code"], row["name"], money(row["price"]), row["qty"], money(row["line_total"]), _money_or_blank(row.get("cost_price"))])
+        writer.writerow([])
+        writer.writerow(["subtotal", money(return_data["subtotal"])])
+        writer.writerow(["discount_percent", str(return_data["discount_percent"])])
+        writer.writerow(["discount_amount", money(return_data["discount_amount"])])
+        writer.writerow(["subtotal_after_discount", money(return_data["subtotal_after_discount"])])
+        writer.writerow(["gst_percent", str(return_data["gst_percent"])])
+        writer.writerow(["gst_total", money(return_data["gst_total"])])
+        writer.writerow(["cgst", money(return_data["cgst"])])
+        writer.writerow(["sgst", money(return_data["sgst"])])
+        writer.writerow(["grand_total", money(return_data["grand_total"])])
+        writer.writerow(["points_deducted", return_data["points_deducted"]])
+        writer.writerow(["payment_status", return_data["payment_status"]])
+    return filename
+def save_invoice_html(inv_number, invoice_data, filename=None):
+    ensure_invoices_dir()
+    if filename is None:
+        filename = os.path.join(INVOICES_DIR, f"invoice_{inv_number}.html")
+    rows_html = ""
+    for row in invoice_data["items"]:
+        rows_html += f"<tr><td>{row['code']}</td><td>{row['name']}</td><td align='right'>{money(row['price'])}</td><td align='center'>{row['qty']}</td><td align='right'>{money(row['line_total'])}</td></tr>\n"
+    html = f"""
+    <html>
+    <head><meta charset="utf-8"><title>Invoice {inv_number}</title></head>
+    <body>
+    <h1>{invoice_data.get('shop_name', SHOP_NAME)}</h1>
+    <p>GST Number: {invoice_data.get('gst_number', GST_NUMBER)}</p>
+    <h2>Invoice #{inv_number}</h2>
+    <p>Date: {invoice_data['date']}</p>
+    <p>Customer: {invoice_data.get('customer_name', '-')} ({invoice_data.get('customer_phone', '-')})</p>
+    <p>Total Item Count: {invoice_data['total_item_count']}</p>
+    <p>Payment Status: {invoice_data.get('payment_status', 'pending').capitalize()}</p>
+    <table border="1" cellspacing="0" cellpadding="6" width="80%">
+      <thead>
+        <tr><th>Code</th><th>Item</th><th>Price</th><th>Qty</th><th>Line Total</th></tr>
+      </thead>
+      <tbody>
+      {rows_html}
+      </tbody>
+    </table>
+    <p>Subtotal: <b>{money(invoice_data['subtotal'])}</b></p>
+    <p>Discount ({invoice_data['discount_percent']}%): <b>{money(invoice_data['discount_amount'])}</b></p>
+    <p>Subtotal after discount: <b>{money(invoice_data['subtotal_after_discount'])}</b></p>
+    <p>GST ({invoice_data['gst_percent']}%): <b>{money(invoice_data['gst_total'])}</b> (CGST {money(invoice_data['cgst'])} + SGST {money(invoice_data['sgst'])})</p>
+    <h3>Grand Total: {money(invoice_data['grand_total'])}</h3>
+    <p>Points Awarded: {invoice_data.get('points_awarded', 0)}</p>
+    <hr>
+    <p>Thank you for your business!</p>
+    </body>
+    </html>
+    """
+    with open(filename, "w", encoding='utf-8') as f:
+        f.write(html)
+    return filename
+_reportlab = None
+_reportlab_lock = threading.Lock()
+def reportlab_kit():
+    # ReportLab's platypus classes plus the stylesheet and table styles every
+    # PDF uses, imported and built once on the first PDF. They are only read
+    # while rendering, so render threads share them.
+    global _reportlab
+    with _reportlab_lock:
+        if _reportlab is None:
+            from reportlab.lib.pagesizes import A4
+            from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+            from reportlab.lib import colors
+            from reportlab.lib.styles import getSampleStyleSheet
+            header = [
+                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ]
+            body = [
+                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+                ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black)
+            ]
+            _reportlab = SimpleNamespace(
+                A4=A4, SimpleDocTemplate=SimpleDocTemplate, Table=Table, Paragraph=Paragraph, Spacer=Spacer,
+                styles=getSampleStyleSheet(),
+                invoice_table_style=TableStyle(header + [('FONTSIZE', (0, 0), (-1, 0), 12)] + body),
+                report_table_style=TableStyle(header + body),
+            )
+    return _reportlab
+def save_invoice_pdf(inv_number, invoice_data, filename=None):
+    ensure_invoices_dir()
+    if filename is None:
+        filename = os.path.join(INVOICES_DIR, f"invoice_{inv_number}.pdf")
+    rl = reportlab_kit()
+    doc = rl.SimpleDocTemplate(filename, pagesize=rl.A4)
+    elements = []
+    styles = rl.styles
+   
+    elements.append(rl.Paragraph(invoice_data.get('shop_name', SHOP_NAME), styles['Title']))
+    elements.append(rl.Paragraph(f"GST Number: {invoice_data.get('gst_number', GST_NUMBER)}", styles['Normal']))
+    elements.append(rl.Paragraph(f"Invoice #{inv_number}", styles['Heading2']))
+    elements.append(rl.Paragraph(f"Date: {invoice_data['date']}", styles['Normal']))
+    elements.append(rl.Paragraph(f"Customer: {invoice_data.get('customer_name', '-')} ({invoice_data.get('customer_phone', '-')})", styles['Normal']))
+    elements.append(rl.Paragraph(f"Total Item Count: {invoice_data['total_item_count']}", styles['Normal']))
+    elements.append(rl.Paragraph(f"Payment Status: {invoice_data.get('payment_status', 'pending').capitalize()}", styles['Normal']))
+    elements.append(rl.Spacer(1, 12))
+   
+    data = [["Code", "Item", "Price", "Qty", "Line Total"]]
+    for row in invoice_data["items"]:
+        data.append([row["code"], row["name"], money(row["price"]), str(row["qty"]), money(row["line_total"])])
+   
+    table = rl.Table(data)
+    table.setStyle(rl.invoice_table_style)
+    elements.append(table)
+    elements.append(rl.Spacer(1, 12))
+   
+    elements.append(rl.Paragraph(f"Subtotal: {money(invoice_data['subtotal'])}", styles['Normal']))
+    elements.append(rl.Paragraph(f"Discount ({invoice_data['discount_percent']}%): {money(invoice_data['discount_amount'])}", styles['Normal']))
+    elements.append(rl.Paragraph(f"Subtotal after discount: {money(invoice_data['subtotal_after_discount'])}", styles['Normal']))
+    elements.append(rl.Paragraph(f"GST ({invoice_data['gst_percent']}%): {money(invoice_data['gst_total'])} (CGST {money(invoice_data['cgst'])} + SGST {money(invoice_data['sgst'])})", styles['Normal']))
+    elements.append(rl.Paragraph(f"<b>Grand Total: {money(invoice_data['grand_total'])}</b>", styles['Heading3']))
+    elements.append(rl.Paragraph(f"Points Awarded: {invoice_data.get('points_awarded', 0)}", styles['Normal']))
+    elements.append(rl.Spacer(1, 12))
+    elements.append(rl.Paragraph("Thank you for your business!", styles['Normal']))
+   
+    doc.build(elements)
+    return filename
+# ---------- On-demand rendering ----------
+def _evict_render_cache(keep=None):
+    entries = []
+    total = 0
+    with os.scandir(RENDER_CACHE_DIR) as it:
+        for entry in it:
+            if entry.is_file():
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= RENDER_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            logging.warning(f"Could not evict {path}: {e}")
+def render_invoice_cached(inv_number, fmt="html"):
+    # Renders from the invoice CSV into a cache keyed by the CSV bytes and the
+    # template version, so an edited invoice (e.g. new payment status) or a new
+    # layout gets a fresh document. Least recently opened files are evicted
+    # once the cache grows past RENDER_CACHE_MAX_BYTES.
+    csvfile = os.path.join(INVOICES_DIR, f"invoice_{inv_number}.csv")
+    if not os.path.exists(csvfile):
+        return None
+    with open(csvfile, "rb") as f:
+        digest = hashlib.sha256(f.read() + f"|{TEMPLATE_VERSION}|{fmt}".encode()).hexdigest()
+    os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+    path = os.path.join(RENDER_CACHE_DIR, f"{digest}.{fmt}")
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    render = save_invoice_pdf if fmt == "pdf" else save_invoice_html
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        render(inv_number, read_invoice(csvfile).invoice_data(), filename=tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    _evict_render_cache(keep=path)
+    return path
+def invoice_document_path(inv_number, fmt="html"):
+    path = os.path.join(INVOICES_DIR, f"invoice_{inv_number}.{fmt}")
+    if os.path.exists(path):
+        return path
+    return render_invoice_cached(inv_number, fmt)
+# ---------- Product search ----------
+class ProductSearchIndex:
+    # Substring search over product code and name. Every 1-3 character slice
+    # of "\x01" + code and "\x02" + name has a posting array of product ids,
+    # so queries of up to three characters are a single lookup and longer ones
+    # intersect trigram postings before a final substring check. The markers
+    # also give the ranking for free: "\x01ab" lists codes starting with "ab",
+    # "\x02ab" names starting with it and " ab" names with a word starting
+    # with it. Results are ranked in that order, then any other match, each
+    # group in code order.
+    cache_size = 64
+    def __init__(self, products=None):
+        self.rebuild(products or {})
+    def rebuild(self, products):
+        self.order = sorted(products)
+        self.codes = list(self.order)
+        self.ids = {code: i for i, code in enumerate(self.codes)}
+        self.position = [float(i) for i in range(len(self.codes))]
+        self.fields = {}
+        self.postings = {}
+        self.categories = {}
+        for i, code in enumerate(self.codes):
+            self._index(i, code, products[code])
+        self._invalidate()
+    def _invalidate(self):
+        self.cache = {}
+    @staticmethod
+    def _grams(code_l, name_l):
+        grams = set()
+        for text in ("\x01" + code_l, "\x02" + name_l):
+            for n in (1, 2, 3):
+                grams.update(text[i:i + n] for i in range(len(text) - n + 1))
+        return grams
+    def _index(self, i, code, p):
+        code_l, name_l, category = code.lower(), p["name"].lower(), p["category"]
+        self.fields[i] = (code_l, name_l, category)
+        for gram in self._grams(code_l, name_l):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array("i")
+            posting.append(i)
+        self.categories.setdefault(category, set()).add(i)
+    def _unindex(self, i):
+        code_l, name_l, category = self.fields.pop(i)
+        for gram in self._grams(code_l, name_l):
+            posting = self.postings[gram]
+            posting.remove(i)
+            if not posting:
+                del self.postings[gram]
+        bucket = self.categories[category]
+        bucket.discard(i)
+        if not bucket:
+            del self.categories[category]
+    def remove(self, code):
+        i = self.ids.pop(code, None)
+        if i is None:
+            return
+        self._unindex(i)
+        del self.order[bisect.bisect_left(self.order, code)]
+        self._invalidate()
+    def update(self, code, p):
+        i = self.ids.get(code)
+        if i is not None:
+            if self.fields[i] == (code.lower(), p["name"].lower(), p["category"]):
+                return
+            self._unindex(i)
+        else:
+            i = len(self.codes)
+            self.codes.append(code)
+            self.ids[code] = i
+            at = bisect.bisect_left(self.order, code)
+            self.order.insert(at, code)
+            before = self.position[self.ids[self.order[at - 1]]] if at > 0 else -1.0
+            after = self.position[self.ids[self.order[at + 1]]] if at + 1 < len(self.order) else before + 2.0
+            self.position.append((before + after) / 2)
+            if not before < self.position[i] < after:
+                for rank, c in enumerate(self.order):
+                    self.position[self.ids[c]] = float(rank)
+        self._index(i, code, p)
+        self._invalidate()
+    def category_names(self):
+        return sorted(self.categories)
+    def _candidates(self, q):
+        if len(q) <= 3:
+            return set(self.postings.get(q, ()))
+        postings = [self.postings.get(q[i:i + 3]) for i in range(len(q) - 2)]
+        if any(posting is None for posting in postings):
+            return set()
+        postings.sort(key=len)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            found.intersection_update(posting)
+        fields = self.fields
+        return {i for i in found if q in fields[i][0] or q in fields[i][1]}
+    def _ranked(self, q, found):
+        if len(q) <= 2:
+            groups = [found.intersection(self.postings.get(marker + q, ())) for marker in ("\x01", "\x02", " ")]
+        else:
+            fields = self.fields
+            groups = [{i for i in found if fields[i][0].startswith(q)},
+                      {i for i in found if fields[i][1].startswith(q)},
+                      {i for i in found if f" {q}" in fields[i][1]}]
+        result = []
+        seen = set()
+        for group in groups + [found]:
+            group -= seen
+            seen |= group
+            result.extend(sorted(group, key=self.position.__getitem__))
+        return result
+    def search(self, query="", category="All"):
+        q = query.strip().lower()
+        key = (q, category)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        if not q and category == "All":
+            result = self.order
+        else:
+            found = self._candidates(q) if q else set(self.categories.get(category, ()))
+            if category != "All":
+                found &= self.categories.get(category, set())
+            codes = self.codes
+            result = [codes[i] for i in self._ranked(q, found)] if q else [codes[i] for i in sorted(found, key=self.position.__getitem__)]
+        if len(self.cache) >= self.cache_size:
+            self.cache.pop(next(iter(self.cache)))
+        self.cache[key] = result
+        return result
+# ---------- Customer search ----------
+class CustomerIndex:
+    # Sorted (key, id) lists searched with bisect stand in for a prefix trie
+    # over full names, name words and phone digits; exact names and phones
+    # also have hash lookups. Results are ranked exact id, exact phone, exact
+    # name, name prefix, word prefix, phone prefix, each group in key order.
+    def __init__(self, customers=None):
+        self.rebuild(customers or {})
+    @staticmethod
+    def _digits(phone):
+        return re.sub(r"\D", "", phone)
+    def rebuild(self, customers):
+        self.entries = {}
+        self.names = []
+        self.words = []
+        self.phones = []
+        self.name_ids = {}
+        self.phone_ids = {}
+        self.ids = {}
+        for id_, c in customers.items():
+            self._add(id_, c)
+        self.names.sort()
+        self.words.sort()
+        self.phones.sort()
+    def _add(self, id_, c, insert=list.append):
+        name_l = c["name"].strip().lower()
+        digits = self._digits(c["phone"] or "")
+        words = set(name_l.split()[1:])
+        self.entries[id_] = (name_l, digits, words)
+        self.ids[id_.lower()] = id_
+        insert(self.names, (name_l, id_))
+        for word in words:
+            insert(self.words, (word, id_))
+        if digits:
+            insert(self.phones, (digits, id_))
+            self.phone_ids.setdefault(digits, set()).add(id_)
+        self.name_ids.setdefault(name_l, set()).add(id_)
+    @staticmethod
+    def _discard(keys, key):
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+    def remove(self, id_):
+        entry = self.entries.pop(id_, None)
+        if entry is None:
+            return
+        self.ids.pop(id_.lower(), None)
+        name_l, digits, words = entry
+        self._discard(self.names, (name_l, id_))
+        for word in words:
+            self._discard(self.words, (word, id_))
+        if digits:
+            self._discard(self.phones, (digits, id_))
+            self.phone_ids[digits].discard(id_)
+            if not self.phone_ids[digits]:
+                del self.phone_ids[digits]
+        self.name_ids[name_l].discard(id_)
+        if not self.name_ids[name_l]:
+            del self.name_ids[name_l]
+    def update(self, id_, c):
+        self.remove(id_)
+        self._add(id_, c, insert=bisect.insort)
+    def by_name(self, name):
+        return sorted(self.name_ids.get(name.strip().lower(), ()))
+    def by_phone(self, phone):
+        return sorted(self.phone_ids.get(self._digits(phone), ()))
+    @staticmethod
+    def _prefixed(keys, prefix, limit):
+        found = []
+        i = bisect.bisect_left(keys, (prefix,))
+        while i < len(keys) and keys[i][0].startswith(prefix) and len(found) < limit:
+            found.append(keys[i][1])
+            i += 1
+        return found
+    def search(self, query="", limit=None):
+        limit = limit or CUSTOMER_RESULTS_MAX
+        q = query.strip().lower()
+        if not q:
+            return [id_ for _, id_ in self.names[:limit]]
+        digits = self._digits(q) if re.fullmatch(r"[\d\s+-]+", q) else ""
+        groups = [
+            [self.ids[q]] if q in self.ids else [],
+            sorted(self.phone_ids.get(digits, ())) if digits else [],
+            self.by_name(q),
+            self._prefixed(self.names, q, limit),
+            self._prefixed(self.words, q, limit),
+            self._prefixed(self.phones, digits, limit) if digits else [],
+        ]
+        result = []
+        seen = set()
+        for group in groups:
+            for id_ in group:
+                if id_ not in seen:
+                    seen.add(id_)
+                    result.append(id_)
+                    if len(result) >= limit:
+                        return result
+        return result
+# ---------- Cart ----------
+def line_total(price, qty):
+    return (price * Decimal(qty)).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+class Cart:
+    # Cart lines keyed by code, in the order they were first added. The
+    # subtotal and item count are kept up to date as lines change, so the
+    # totals never need a pass over the whole cart. Line totals are already
+    # quantized, so the running sum is exact and equals a fresh sum.
+    def __init__(self):
+        self.lines = {}
+        self.subtotal = Decimal("0")
+        self.item_count = 0
+    def __len__(self):
+        return len(self.lines)
+    def __contains__(self, code):
+        return code in self.lines
+    def get(self, code):
+        return self.lines.get(code)
+    def items(self):
+        return self.lines.items()
+    def values(self):
+        return self.lines.values()
+    def add(self, code, name, price, qty, cost_price=Decimal("0")):
+        item = self.lines.get(code)
+        if item:
+            self.set_qty(code, item["qty"] + qty)
+            return item
+        item = self.lines[code] = {"code": code, "name": name, "price": price, "qty": qty, "line_total": line_total(price, qty), "cost_price": cost_price}
+        self.subtotal += item["line_total"]
+        self.item_count += qty
+        return item
+    def set_qty(self, code, qty):
+        item = self.lines[code]
+        new_total = line_total(item["price"], qty)
+        self.subtotal += new_total - item["line_total"]
+        self.item_count += qty - item["qty"]
+        item["qty"] = qty
+        item["line_total"] = new_total
+    def remove(self, code):
+        item = self.lines.pop(code, None)
+        if item:
+            self.subtotal -= item["line_total"]
+            self.item_count -= item["qty"]
+    def clear(self):
+        self.lines = {}
+        self.subtotal = Decimal("0")
+        self.item_count = 0
+    def totals(self, gst_percent, discount_percent):
+        subtotal = self.subtotal
+        discount_amount = (subtotal * discount_percent / Decimal("100")).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+        subtotal_after_discount = (subtotal - discount_amount).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+        gst_total = (subtotal_after_discount * gst_percent / Decimal("100")).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+        cgst = (gst_total / 2).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+        sgst = (gst_total - cgst).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+        grand_total = (subtotal_after_discount + gst_total).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+        return {
+            "subtotal": subtotal,
+            "discount_amount": discount_amount,
+            "subtotal_after_discount": subtotal_after_discount,
+            "gst_total": gst_total,
+            "cgst": cgst,
+            "sgst": sgst,
+            "grand_total": grand_total,
+            "total_item_count": self.item_count
+        }
+# ---------- Checkout ----------
+def loyalty_discount(points):
+    return LOYALTY_DISCOUNT_PERCENT if points >= LOYALTY_DISCOUNT_POINTS else Decimal("0")
+def add_product_to_cart(cart, products, code, qty):
+    # Merges qty into the cart line for code; returns a message instead of
+    # changing anything when stock would be exceeded.
+    prod = products[code]
+    item = cart.get(code)
+    new_qty = qty + (item["qty"] if item else 0)
+    if new_qty > prod["stock"]:
+        if not item:
+            return f"Only {prod['stock']} units of {prod['name']} available."
+        return f"Cannot add {new_qty} units of {prod['name']}. Only {prod['stock']} available."
+    cart.add(code, prod["name"], prod["price"], qty, prod["cost_price"])
+    return None
+def build_invoice(cart, gst_percent=GST_DEFAULT, discount_percent=Decimal("0"), customer=None, customer_id="", customer_name="", payment_status="pending", date=None):
+    # customer is the customers.csv record for customer_id, or None for a
+    # walk-in sale, which gets no loyalty discount and earns no points.
+    totals = cart.totals(gst_percent, discount_percent + loyalty_discount(customer["loyalty_points"] if customer else 0))
+    invoice_data = {
+        "date": date or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "customer_name": customer_name or (customer["name"] if customer else "Anonymous"),
+        "customer_phone": customer["phone"] if customer else "",
+        "customer_id": customer_id if customer else "",
+        "items": list(cart.values()),
+        "discount_percent": discount_percent,
+        "gst_percent": gst_percent,
+        "points_awarded": int(totals["grand_total"] // Decimal(10)) if customer else 0,
+        "payment_status": payment_status
+    }
+    invoice_data.update(totals)
+    return invoice_data
+def checkout(cart, products, customers=None, customer_id="", customer_name="", gst_percent=GST_DEFAULT, discount_percent=Decimal("0"), payment_status="pending", date=None):
+    # Prices the cart and commits it as one invoice. products and customers
+    # are the caller's in-memory dicts; their stock levels and points balances
+    # are updated. Returns (invoice number, invoice_data, CSV path, {code: new
+    # stock level}).
+    customer = customers.get(customer_id) if customer_id and customers else None
+    invoice_data = build_invoice(cart, gst_percent, discount_percent, customer, customer_id, customer_name, payment_status, date)
+    deltas = {code: -item["qty"] for code, item in cart.items() if "CUSTOM_" not in code} # no stock for custom items
+    loyalty = {customer_id: invoice_data["points_awarded"]} if customer else {}
+    inv_num, csvfile, levels = commit_sale(None, invoice_data, deltas, loyalty, customers, products=products)
+    for code, qty in levels.items():
+        if code in products:
+            products[code]["stock"] = qty
+    return inv_num, invoice_data, csvfile, levels
+def low_stock_alerts(products, levels):
+    return [f"{products[code]['name']} (Code: {code}) is low on stock: {qty} left."
+            for code, qty in levels.items() if code in products and qty < products[code]["low_stock_threshold"]]
+def commit_return(invoice_path, invoice_data, return_items, products, customers=None, customer_index=None):
+    # Commits a return against the invoice at invoice_path. return_items have
+    # negative qty and line_total; the original invoice's discount and GST are
+    # applied to them and loyalty points are taken back. Returns (return
+    # number, return_data, {code: new stock level}).
+    customers = customers if customers is not None else {}
+    restocked = {}
+    for item in return_items:
+        if "CUSTOM_" not in item["code"]:
+            restocked[item["code"]] = restocked.get(item["code"], 0) - item["qty"]
+    subtotal = sum(item["line_total"] for item in return_items)
+    discount_percent = Decimal(invoice_data["discount_percent"])
+    discount_amount = (subtotal * discount_percent / Decimal("100")).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+    subtotal_after_discount = (subtotal - discount_amount).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+    gst_percent = Decimal(invoice_data["gst_percent"])
+    gst_total = (subtotal_after_discount * gst_percent / Decimal("100")).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+    cgst = (gst_total / 2).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+    sgst = (gst_total - cgst).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+    grand_total = (subtotal_after_discount + gst_total).quantize(CURRENCY_QUANT, rounding=ROUND_HALF_UP)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    points_deducted = 0
+    return_data = {
+        "date": now,
+        "customer_name": invoice_data.get("customer_name", ""),
+        "customer_phone": invoice_data.get("customer_phone", ""),
+        "customer_id": invoice_data.get("customer_id", ""),
+        "items": return_items,
+        "subtotal": subtotal,
+        "discount_percent": discount_percent,
+        "discount_amount": discount_amount,
+        "subtotal_after_discount": subtotal_after_discount,
+        "gst_percent": gst_percent,
+        "gst_total": gst_total,
+        "cgst": cgst,
+        "sgst": sgst,
+        "grand_total": grand_total,
+        "points_awarded": points_deducted,
+        "payment_status": "refunded",
+        "original_invoice": invoice_data["invoice_number"]
+    }
+    loyalty = {}
+    # Invoices written before customer IDs were recorded fall back to a
+    # name lookup, which is only trusted when the name is unique.
+    id_ = invoice_data.get("customer_id", "")
+    if not id_ and invoice_data.get("customer_name") != "Anonymous":
+        ids = (customer_index or CustomerIndex(customers)).by_name(invoice_data.get("customer_name", ""))
+        id_ = ids[0] if len(ids) == 1 else ""
+    if id_ in customers:
+        points_deducted = -int(abs(grand_total) // Decimal(10))
+        loyalty[id_] = points_deducted
+    return_data["points_deducted"] = points_deducted
+    return_num, _, levels = commit_sale(None, return_data, restocked, loyalty, customers,
+                                        write_record=save_return_csv, status_updates={invoice_path: "partial/refunded"}, products=products)
+    for code, qty in levels.items():
+        if code in products:
+            products[code]["stock"] = qty
+    return return_num, return_data, levels
+# ---------- Order replay ----------
+# Orders are JSON objects, one per line:
+#   {"items": [{"code": "P001", "qty": 2}, ...], "customer_id": "C001",
+#    "customer_name": "...", "gst_percent": "18", "discount_percent": "5",
+#    "payment_status": "paid", "date": "2026-01-31 18:00:00"}
+# Only items is required. Replayed orders default to paid.
+def _order_percent(order, key, default):
+    try:
+        value = Decimal(str(order.get(key, default)))
+    except InvalidOperation:
+        raise ValueError(f"invalid {key} {order[key]!r}")
+    if not value.is_finite() or not 0 <= value <= 100:
+        raise ValueError(f"{key} {value} is out of range")
+    return value
+def _order_text(order, key):
+    # Orders come from JSON, so any field may hold any JSON type.
+    value = order.get(key)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"invalid {key} {value!r}")
+    return value
+def order_cart(order, products):
+    if not isinstance(order, dict) or not isinstance(order.get("items"), list) or not order["items"]:
+        raise ValueError("not an order: expected an object with a non-empty items list")
+    cart = Cart()
+    for line in order["items"]:
+        if not isinstance(line, dict):
+            raise ValueError(f"invalid item {line!r}")
+        code, qty = line.get("code"), line.get("qty", 1)
+        if not isinstance(code, str) or code not in products:
+            raise ValueError(f"unknown product {code!r}")
+        if not isinstance(qty, int) or isinstance(qty, bool) or qty <= 0:
+            raise ValueError(f"invalid quantity {qty!r} for {code}")
+        error = add_product_to_cart(cart, products, code, qty)
+        if error:
+            raise ValueError(error)
+    return cart
+def order_terms(order, customers):
+    # The checkout() arguments of an order other than its cart.
+    customer_id = _order_text(order, "customer_id") or ""
+    if customer_id and customer_id not in customers:
+        raise ValueError(f"unknown customer {customer_id!r}")
+    date = _order_text(order, "date")
+    if date is not None:
+        datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+    return {"customer_id": customer_id, "customer_name": _order_text(order, "customer_name") or "",
+            "gst_percent": _order_percent(order, "gst_percent", GST_DEFAULT),
+            "discount_percent": _order_percent(order, "discount_percent", 0),
+            "payment_status": _order_text(order, "payment_status") or "paid", "date": date}
+def replay_order(order, products, customers):
+    cart = order_cart(order, products)
+    return checkout(cart, products, customers, **order_terms(order, customers))
+def replay_orders(path, products=None, customers=None):
+    # Commits the orders in file order, one invoice each. Lines that are not
+    # valid orders are logged with their line number and skipped. Returns
+    # (committed invoice numbers, number of rejected lines).
+    products = catalog_copy() if products is None else products
+    customers = read_customers() if customers is None else customers
+    committed = []
+    rejected = 0
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                inv_num, _, _, _ = replay_order(json.loads(line), products, customers)
+            except ValueError as e:
+                rejected += 1
+                logging.warning(f"{path}:{lineno}: order rejected: {e}")
+                continue
+            committed.append(inv_num)
+    return committed, rejected
+# ---------- Order ingestion ----------
+# Streams a JSONL order file (the replay format, plus an optional order_id)
+# in batches of INGEST_BATCH_SIZE, each committed by commit_sale_batch. The
+# byte offset reached is stored with every batch, so a later run - after a
+# crash, or once more orders were appended - continues from there. Orders
+# whose order_id was already ingested are skipped. A last line without its
+# newline is treated as still being written and left for the next run.
+def _ingest_checkpoint_key(path):
+    return "ingest_offset:" + os.path.abspath(path)
+def ingest_orders(path, batch_size=None, products=None, customers=None):
+    # Returns (committed invoice numbers, rejected lines, duplicate orders).
+    # Stock and points are reserved in products and customers as orders are
+    # accepted, so later orders in the same batch see them; if a batch fails
+    # to commit, both dicts must be reloaded. A batch that lost a race for
+    # stock with another till is re-read from its start against fresh levels.
+    batch_size = batch_size or INGEST_BATCH_SIZE
+    products = catalog_copy() if products is None else products
+    customers = read_customers() if customers is None else customers
+    conn = get_db()
+    key = _ingest_checkpoint_key(path)
+    offset = int(meta_get(conn, key, 0))
+    if offset > os.path.getsize(path):
+        logging.warning(f"{path} is shorter than its ingestion checkpoint; reading it from the start")
+        offset = 0
+    committed = []
+    rejected = duplicates = 0
+    batch = []
+    seen = set()
+    saved = offset
+    saved_counts = (rejected, duplicates)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            raw = f.readline()
+            if raw.endswith(b"\n"):
+                line_start = offset
+                offset += len(raw)
+                if raw.strip():
+                    try:
+                        order = json.loads(raw)
+                        order_id = order.get("order_id") if isinstance(order, dict) else None
+                        if order_id is not None:
+                            order_id = str(order_id)
+                            if order_id in seen or conn.execute("SELECT 1 FROM ingested_orders WHERE order_id = ?", (order_id,)).fetchone():
+                                duplicates += 1
+                                order = None
+                        if order is not None:
+                            cart = order_cart(order, products)
+                            terms = order_terms(order, customers)
+                            customer = customers.get(terms["customer_id"])
+                            invoice_data = build_invoice(cart, terms["gst_percent"], terms["discount_percent"], customer, terms["customer_id"],
+                                                         terms["customer_name"], terms["payment_status"], terms["date"])
+                    except ValueError as e:
+                        rejected += 1
+                        logging.warning(f"{path}: order at byte {line_start} rejected: {e}")
+                        order = None
+                    if order is not None:
+                        for code, item in cart.items():
+                            products[code]["stock"] -= item["qty"]
+                        loyalty = {}
+                        if customer:
+                            customer["loyalty_points"] += invoice_data["points_awarded"]
+                            loyalty[terms["customer_id"]] = invoice_data["points_awarded"]
+                        batch.append((invoice_data, loyalty, order_id))
+                        if order_id is not None:
+                            seen.add(order_id)
+                if len(batch) < batch_size:
+                    continue
+            if batch:
+                try:
+                    numbers, levels = commit_sale_batch(batch, (key, offset), customers, products)
+                except StockConflict as e:
+                    logging.warning(f"{path}: stock changed by another till ({e}); retrying orders from byte {saved}")
+                    refresh_stock_levels(products)
+                    refresh_loyalty_points(customers)
+                    f.seek(saved)
+                    offset = saved
+                    rejected, duplicates = saved_counts
+                    batch = []
+                    seen = set()
+                    continue
+                for code, qty in levels.items():
+                    if code in products:
+                        products[code]["stock"] = qty
+                committed.extend(numbers)
+                batch = []
+            elif offset != saved:
+                with db_transaction(conn):
+                    meta_set(conn, key, offset)
+            saved = offset
+            saved_counts = (rejected, duplicates)
+            if not raw.endswith(b"\n"):
+                break
+    return committed, rejected, duplicates
+def main(argv):
+    logging.basicConfig(filename='billing.log', level=logging.WARNING)
+    if len(argv) != 2 or argv[0] not in ("--replay", "--ingest"):
+        print("usage: python checkout_engine.py --replay ORDERS.jsonl\n"
+              "       python checkout_engine.py --ingest ORDERS.jsonl", file=sys.stderr)
+        return 2
+    recover_sale_journal()
+    start = time.perf_counter()
+    if argv[0] == "--replay":
+        committed, rejected = replay_orders(argv[1])
+        duplicates = 0
+    else:
+        committed, rejected, duplicates = ingest_orders(argv[1])
+    elapsed = time.perf_counter() - start
+    print(f"Committed {len(committed)} invoices in {elapsed:.2f}s ({len(committed) / elapsed if elapsed else 0:.0f}/s); "
+          f"{rejected} lines rejected, {duplicates} duplicate orders skipped.")
+    if rejected:
+        print("Rejected lines are listed in billing.log.")
+    return 0 if committed or not rejected else 1
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
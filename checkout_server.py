@@ -0,0 +1,406 @@
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from urllib.parse import urlsplit, parse_qs, unquote
+from checkout_engine import *
+# Optional HTTP/JSON front end to checkout_engine, so handheld scanners and
+# thin tills can share one process that keeps the product and customer
+# indexes in memory. Storage calls run on a small thread pool; each thread
+# keeps its own billing.db connection, so the pool doubles as the connection
+# pool. Checkouts that arrive while a commit is running are committed together
+# as the next batch, so concurrent tills share the fsyncs instead of queueing
+# behind each other's. Start it with: python checkout_server.py [--host HOST] [--port PORT]
+#
+#   GET  /products?q=&category=&limit=   product search
+#   GET  /products/CODE                  one product
+#   GET  /barcodes/BARCODE               product for a scanned barcode
+#   GET  /customers?q=&limit=            customer search
+#   GET  /customers/ID/ledger            invoices, returns and lifetime totals
+#   POST /price                          price an order without committing it
+#   POST /checkout                       commit an order as an invoice
+#   GET  /reports/daily?start=&end=&kind=
+#   GET  /reports/categories?kind=
+#   GET  /metrics                        request latencies per route
+#
+# Orders use the replay format (see Order replay in checkout_engine). Errors
+# come back as {"error": ...} with status 400, 404, or 409 when another till
+# sold the stock first (with "shortages": {code: units left}).
+# ---------- Config ----------
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_WORKERS = 8 # storage threads, i.e. billing.db connections
+SERVER_BATCH_MAX = 200 # checkouts committed together by one commit_sale_batch
+SERVER_MAX_BODY = 1024 * 1024
+SERVER_IDLE_TIMEOUT = 30 # seconds a keep-alive connection may sit idle
+SERVER_EVENT_POLL = 0.5 # seconds between reads of the change feed (stock sold by other tills, catalog edits)
+SERVER_LATENCY_SAMPLES = 4096 # recent latencies kept per route for /metrics
+SEARCH_RESULTS_MAX = 100
+# ----------------------------
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+class LatencyStats:
+    # Keeps the last SERVER_LATENCY_SAMPLES latencies of each route, plus
+    # totals since start.
+    def __init__(self):
+        self.samples = {}
+        self.counts = {}
+        self.errors = {}
+    def record(self, route, seconds, failed=False):
+        samples = self.samples.get(route)
+        if samples is None:
+            samples = self.samples[route] = deque(maxlen=SERVER_LATENCY_SAMPLES)
+        samples.append(seconds)
+        self.counts[route] = self.counts.get(route, 0) + 1
+        if failed:
+            self.errors[route] = self.errors.get(route, 0) + 1
+    def summary(self):
+        result = {}
+        for route, samples in self.samples.items():
+            ordered = sorted(samples)
+            def pick(q):
+                return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+            result[route] = {"requests": self.counts[route], "errors": self.errors.get(route, 0),
+                             "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+                             "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": pick(1)}
+        return result
+def product_json(code, p):
+    return {"code": code, "name": p["name"], "price": money(p["price"]), "stock": p["stock"], "category": p["category"]}
+def invoice_json(inv_num, invoice_data):
+    result = {key: money(value) if isinstance(value, Decimal) else value for key, value in invoice_data.items() if key != "items"}
+    result["discount_percent"] = str(invoice_data["discount_percent"])
+    result["gst_percent"] = str(invoice_data["gst_percent"])
+    result["items"] = [{"code": item["code"], "name": item["name"], "price": money(item["price"]), "qty": item["qty"],
+                        "line_total": money(item["line_total"])} for item in invoice_data["items"]]
+    if inv_num is not None:
+        result["invoice_number"] = inv_num
+    return result
+class CheckoutServer:
+    def __init__(self):
+        recover_sale_journal()
+        self.products = catalog_copy()
+        self.barcodes = read_barcodes()
+        self.customers = read_customers()
+        self.search_index = ProductSearchIndex(self.products)
+        self.customer_index = CustomerIndex(self.customers)
+        self.changes = EventFeed()
+        self.new_events = []
+        self.changes.subscribe(self.new_events.extend)
+        self.storage = ThreadPoolExecutor(max_workers=SERVER_WORKERS, thread_name_prefix="storage")
+        self.stats = LatencyStats()
+        self.in_flight = 0
+        self.queued = [] # [(invoice_data, loyalty, future)] waiting for the committer
+        self.reserved = {} # units of each code held by queued or committing checkouts
+        self.queue_ready = None
+        self.routes = [
+            ("GET", "/products", self.search_products),
+            ("GET", "/products/{code}", self.get_product),
+            ("GET", "/barcodes/{barcode}", self.get_barcode),
+            ("GET", "/customers", self.search_customers),
+            ("GET", "/customers/{customer_id}/ledger", self.get_ledger),
+            ("POST", "/price", self.price),
+            ("POST", "/checkout", self.checkout),
+            ("GET", "/reports/daily", self.daily_report),
+            ("GET", "/reports/categories", self.category_report),
+            ("GET", "/metrics", self.metrics),
+        ]
+        # "{name}" matches one path segment, passed to the handler as name.
+        self.patterns = [re.compile(re.sub(r"\{(\w+)\}", r"(?P<\1>[^/]+)", path)) for _, path, _ in self.routes]
+    async def run_storage(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.storage, func, *args)
+    # Lookups and pricing only touch the in-memory indexes and run on the
+    # event loop; anything that reads or writes billing.db goes to storage.
+    async def search_products(self, query):
+        limit = _int_param(query, "limit", SEARCH_RESULTS_MAX)
+        codes = self.search_index.search(query.get("q", ""), query.get("category", "All"))
+        return [product_json(code, self.products[code]) for code in codes[:limit]]
+    async def get_product(self, query, code):
+        if code not in self.products:
+            raise HTTPError(404, f"unknown product {code!r}")
+        return product_json(code, self.products[code])
+    async def get_barcode(self, query, barcode):
+        code = barcode if barcode in self.products else self.barcodes.get(barcode)
+        if code not in self.products:
+            raise HTTPError(404, f"unknown barcode {barcode!r}")
+        return product_json(code, self.products[code])
+    async def search_customers(self, query):
+        ids = self.customer_index.search(query.get("q", ""), _int_param(query, "limit", CUSTOMER_RESULTS_MAX))
+        return [{"id": id_, "name": self.customers[id_]["name"], "phone": self.customers[id_]["phone"],
+                 "loyalty_points": self.customers[id_]["loyalty_points"]} for id_ in ids]
+    async def get_ledger(self, query, customer_id):
+        if customer_id not in self.customers:
+            raise HTTPError(404, f"unknown customer {customer_id!r}")
+        def work():
+            return customer_ledger(customer_id), customer_lifetime(customer_id)
+        ledger, (invoices, total, points) = await self.run_storage(work)
+        return {"invoices": invoices, "total": money(total), "points": points,
+                "entries": [{"kind": kind, "number": number, "date": day, "total": money(amount), "points": earned}
+                            for kind, number, day, amount, earned in ledger]}
+    async def price(self, query, order):
+        cart = order_cart(order, self.products)
+        terms = order_terms(order, self.customers)
+        customer = self.customers.get(terms["customer_id"])
+        invoice_data = build_invoice(cart, terms["gst_percent"], terms["discount_percent"], customer, terms["customer_id"],
+                                     terms["customer_name"], terms["payment_status"], terms["date"])
+        return invoice_json(None, invoice_data)
+    async def checkout(self, query, order):
+        # Priced and checked against the in-memory stock here; the units are
+        # held in self.reserved until the committer has written the sale.
+        cart = order_cart(order, self.products)
+        terms = order_terms(order, self.customers)
+        customer = self.customers.get(terms["customer_id"])
+        invoice_data = build_invoice(cart, terms["gst_percent"], terms["discount_percent"], customer, terms["customer_id"],
+                                     terms["customer_name"], terms["payment_status"], terms["date"])
+        deltas = {code: item["qty"] for code, item in cart.items()}
+        self._hold(deltas, 1)
+        future = asyncio.get_running_loop().create_future()
+        self.queued.append((invoice_data, {terms["customer_id"]: invoice_data["points_awarded"]} if customer else {}, future))
+        self.queue_ready.set()
+        inv_num, levels = await future
+        result = invoice_json(inv_num, invoice_data)
+        result["low_stock"] = low_stock_alerts(self.products, levels)
+        return result
+    def _hold(self, deltas, sign):
+        for code, qty in deltas.items():
+            self.reserved[code] = self.reserved.get(code, 0) + sign * qty
+            self.products[code]["stock"] -= sign * qty
+            if not self.reserved[code]:
+                del self.reserved[code]
+    def _set_stock(self, levels):
+        for code, qty in levels.items():
+            if code in self.products:
+                self.products[code]["stock"] = qty - self.reserved.get(code, 0)
+    def _commit(self, orders):
+        # Runs in storage, so it must not touch self.products or
+        # self.customers: the new balances reach self.customers through the
+        # points events in the feed, and the stock levels are applied by
+        # commit_queued.
+        return commit_sale_batch([(invoice_data, loyalty, None) for invoice_data, loyalty, _ in orders], None)
+    def _commit_batch(self, batch, codes):
+        # Runs in storage. Returns a (number, levels) pair or an exception for
+        # each order, and the stock levels of codes once the batch is done.
+        try:
+            numbers, levels = self._commit(batch)
+            results = [(num, levels) for num in numbers]
+        except StockConflict:
+            # Another till won a race for stock: retry the orders one by one
+            # so only the short ones fail.
+            results = []
+            for order in batch:
+                try:
+                    numbers, levels = self._commit([order])
+                    results.append((numbers[0], levels))
+                except Exception as e:
+                    results.append(e)
+        except Exception as e:
+            logging.exception("Checkout batch failed")
+            results = [e] * len(batch)
+        try:
+            return results, _stock_levels(codes)
+        except sqlite3.Error as e:
+            logging.warning(f"Stock refresh failed: {e}")
+            return results, {}
+    async def commit_queued(self):
+        while True:
+            await self.queue_ready.wait()
+            self.queue_ready.clear()
+            while self.queued:
+                batch, self.queued = self.queued[:SERVER_BATCH_MAX], self.queued[SERVER_BATCH_MAX:]
+                holds = [{item["code"]: item["qty"] for item in invoice_data["items"]} for invoice_data, _, _ in batch]
+                results, levels = await self.run_storage(self._commit_batch, batch, {code for deltas in holds for code in deltas})
+                for deltas in holds:
+                    self._hold(deltas, -1)
+                self._set_stock(levels)
+                for (_, _, future), result in zip(batch, results):
+                    if future.cancelled():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+    async def daily_report(self, query):
+        rows = await self.run_storage(daily_sales_totals, query.get("start", ""), query.get("end", "9999"), query.get("kind", "sale"))
+        return [{"date": day, "revenue": money(revenue)} for day, revenue in rows]
+    async def category_report(self, query):
+        rows = await self.run_storage(category_sales, query.get("kind", "sale"))
+        return [{"category": category, "units": units, "revenue": money(revenue), "cost": money(cost)}
+                for category, units, revenue, cost in rows]
+    async def metrics(self, query):
+        return {"in_flight": self.in_flight, "routes": self.stats.summary()}
+    def route(self, method, path):
+        allowed = False
+        for (route_method, name, handler), pattern in zip(self.routes, self.patterns):
+            match = pattern.fullmatch(path)
+            if match:
+                if route_method == method:
+                    return name, handler, {key: unquote(value) for key, value in match.groupdict().items()}
+                allowed = True
+        if allowed:
+            raise HTTPError(405, f"{method} not allowed on {path}")
+        raise HTTPError(404, f"no route for {path}")
+    async def dispatch(self, method, target, body):
+        # Returns (route name for the metrics, status, JSON-able result).
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        name = "unrouted"
+        try:
+            name, handler, params = self.route(method, url.path)
+            if method == "POST":
+                try:
+                    order = json.loads(body or b"null")
+                except ValueError:
+                    raise HTTPError(400, "request body is not valid JSON")
+                return name, 200, await handler(query, order, **params)
+            return name, 200, await handler(query, **params)
+        except HTTPError as e:
+            return name, e.status, {"error": str(e)}
+        except StockConflict as e:
+            return name, 409, {"error": str(e), "shortages": e.shortages}
+        except ValueError as e:
+            return name, 400, {"error": str(e)}
+        except Exception as e:
+            logging.exception(f"{method} {target} failed")
+            return name, 500, {"error": f"internal error: {e}"}
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), SERVER_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                start = time.perf_counter()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.decode("latin-1").split()
+                keep_alive = len(parts) == 3 and parts[2] == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                try:
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    length = -1
+                if len(parts) != 3 or length < 0:
+                    route, status, result = "unrouted", 400, {"error": "malformed request"}
+                    keep_alive = False
+                elif length > SERVER_MAX_BODY:
+                    route, status, result = "unrouted", 413, {"error": f"request body over {SERVER_MAX_BODY} bytes"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    self.in_flight += 1
+                    try:
+                        route, status, result = await self.dispatch(parts[0], parts[1], body)
+                    finally:
+                        self.in_flight -= 1
+                payload = json.dumps(result).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload)
+                await writer.drain()
+                self.stats.record(route, time.perf_counter() - start, failed=status >= 500)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    def fetch_changes(self):
+        # Runs in storage: reads the new events and, when they call for a
+        # reload, the files to reload from, so that apply_changes only has
+        # in-memory work left for the event loop.
+        self.changes.poll()
+        events, self.new_events[:] = list(self.new_events), []
+        kinds = {kind for kind, _, _ in events}
+        catalog = barcodes = customers = None
+        if kinds & {"catalog", "reload"}:
+            catalog, barcodes = catalog_copy(), read_barcodes()
+        if kinds & {"customers", "reload"}:
+            customers = read_customers()
+        return events, catalog, barcodes, customers
+    def apply_changes(self, events, catalog=None, barcodes=None, customers=None):
+        # Keeps the in-memory catalog and customers in step with Tk tills and
+        # other servers sharing billing.db (and with this server's own sales).
+        reloaded, touched = apply_product_events(self.products, events, catalog)
+        if reloaded:
+            self.barcodes = barcodes if barcodes is not None else read_barcodes()
+            self.search_index.rebuild(self.products)
+            touched = set(self.products)
+        for code in touched:
+            if code in self.products:
+                self.products[code]["stock"] -= self.reserved.get(code, 0)
+                self.search_index.update(code, self.products[code])
+            else:
+                self.search_index.remove(code)
+        reloaded, touched = apply_customer_events(self.customers, events, customers)
+        if reloaded:
+            self.customer_index.rebuild(self.customers)
+        for id_ in touched:
+            self.customer_index.update(id_, self.customers[id_])
+    async def poll_changes(self):
+        while True:
+            await asyncio.sleep(SERVER_EVENT_POLL)
+            try:
+                events, catalog, barcodes, customers = await self.run_storage(self.fetch_changes)
+            except (sqlite3.Error, OSError) as e:
+                logging.warning(f"Change feed poll failed: {e}")
+                continue
+            if events:
+                try:
+                    self.apply_changes(events, catalog, barcodes, customers)
+                except Exception:
+                    logging.exception("Applying change feed events failed")
+    async def serve(self, host=SERVER_HOST, port=SERVER_PORT, ready=None):
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        self.queue_ready = asyncio.Event()
+        tasks = [asyncio.create_task(self.poll_changes()), asyncio.create_task(self.commit_queued())]
+        if ready is not None:
+            ready(server)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.storage.shutdown(wait=True)
+def _stock_levels(codes):
+    conn = get_db()
+    return {code: row[0] for code in codes for row in conn.execute("SELECT qty FROM stock WHERE code = ?", (code,))}
+def _int_param(query, key, default):
+    try:
+        value = int(query.get(key, default))
+    except ValueError:
+        raise HTTPError(400, f"{key} must be a whole number")
+    if value <= 0:
+        raise HTTPError(400, f"{key} must be positive")
+    return value
+def main(argv):
+    logging.basicConfig(filename='billing.log', level=logging.WARNING)
+    options = {"--host": SERVER_HOST, "--port": str(SERVER_PORT)}
+    if len(argv) % 2 or any(flag not in options for flag in argv[::2]) or not dict(zip(argv[::2], argv[1::2])).get("--port", "0").isdigit():
+        print("usage: python checkout_server.py [--host HOST] [--port PORT]", file=sys.stderr)
+        return 2
+    options.update(zip(argv[::2], argv[1::2]))
+    host, port = options["--host"], int(options["--port"])
+    server = CheckoutServer()
+    print(f"Serving {len(server.products)} products on http://{host}:{port}/ (Ctrl+C to stop)")
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,26 @@
+import os
+import sys
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import checkout_engine
+PRODUCTS = """code,name,price,cost_price,stock,low_stock_threshold,category
+F001,Grilled Sandwich,120,60,19,10,Food
+F003,Vegetable Pizza,200,100,5,10,Food
+"""
+CUSTOMERS = """id,name,phone,loyalty_points
+C001,Sample Customer,1234567890,50
+"""
+@pytest.fixture
+def shop(tmp_path, monkeypatch):
+    # A fresh shop folder: every engine path is relative to the working
+    # directory, and the per-thread connection and catalog cache are reset.
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / checkout_engine.PRODUCTS_CSV).write_text(PRODUCTS)
+    (tmp_path / checkout_engine.CUSTOMERS_CSV).write_text(CUSTOMERS)
+    monkeypatch.setattr(checkout_engine, "_catalog_cache", checkout_engine.CatalogCache())
+    checkout_engine._db_local.conn = None
+    yield tmp_path
+    conn = getattr(checkout_engine._db_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        checkout_engine._db_local.conn = None
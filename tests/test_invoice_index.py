@@ -0,0 +1,18 @@
+import os
+from decimal import Decimal
+import checkout_engine as engine
+def test_index_picks_up_invoice_edited_in_place(shop):
+    cart = engine.Cart()
+    cart.add("F001", "Grilled Sandwich", Decimal("120"), 1, Decimal("60"))
+    num, _, path, _ = engine.checkout(cart, engine.catalog_copy(), customer_name="Walk-in", payment_status="paid")
+    assert [row[2] for row in engine.invoice_index_rows()] == ["Walk-in"]
+    folder = os.stat(engine.INVOICES_DIR)
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    # Fixed by hand: rewritten in place, so the folder's mtime does not move.
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text.replace("customer_name,Walk-in", "customer_name,Asha Rao").replace("payment_status,paid", "payment_status,pending"))
+    os.utime(engine.INVOICES_DIR, ns=(folder.st_atime_ns, folder.st_mtime_ns))
+    assert not engine.invoice_index_is_current()
+    assert [row[1:5] for row in engine.invoice_index_rows()] == [(engine.read_invoice(path).fields["date"], "Asha Rao", "141.60", "pending")]
+    assert engine.invoice_index_is_current()
@@ -0,0 +1,31 @@
+import json
+import checkout_engine as engine
+GOOD = {"items": [{"code": "F001", "qty": 1}], "customer_id": "C001", "date": "2026-01-31 18:00:00"}
+BAD = [
+    {"items": [{"code": "F001", "qty": 1}], "date": 20260131},
+    {"items": [{"code": "F001", "qty": "2"}]},
+    {"items": [{"code": "F001", "qty": True}]},
+    {"items": [{"code": ["F001"], "qty": 1}]},
+    {"items": [{"code": {"a": 1}, "qty": 1}]},
+    {"items": [{"code": "F001", "qty": 1}], "customer_id": ["C001"]},
+    {"items": [{"code": "F001", "qty": 1}], "customer_name": {"first": "A"}},
+    {"items": [{"code": "F001", "qty": 1}], "gst_percent": "NaN"},
+    {"items": [{"code": "F001", "qty": 1}], "payment_status": 1},
+    ["not", "an", "order"],
+]
+def write_orders(path, orders):
+    with open(path, "w", encoding="utf-8") as f:
+        for order in orders:
+            f.write(json.dumps(order) + "\n")
+def test_ingest_rejects_badly_typed_fields(shop):
+    write_orders("orders.jsonl", [GOOD] + BAD + [GOOD])
+    committed, rejected, duplicates = engine.ingest_orders("orders.jsonl", batch_size=4)
+    assert len(committed) == 2
+    assert rejected == len(BAD)
+    assert duplicates == 0
+    assert engine.catalog_snapshot()["F001"]["stock"] == 17
+def test_replay_rejects_badly_typed_fields(shop):
+    write_orders("orders.jsonl", BAD + [GOOD])
+    committed, rejected = engine.replay_orders("orders.jsonl")
+    assert len(committed) == 1
+    assert rejected == len(BAD)
@@ -0,0 +1,41 @@
+import csv
+import os
+from decimal import Decimal
+import checkout_engine as engine
+def write_legacy_invoice(path):
+    # The layout invoices had before customer IDs and unit costs were saved.
+    rows = [
+        ["shop_name", engine.SHOP_NAME], ["gst_number", engine.GST_NUMBER], ["invoice_number", "7"],
+        ["date", "2024-03-01 10:00:00"], ["customer_name", "Sample Customer"], ["customer_phone", "1234567890"],
+        ["total_item_count", "2"], [],
+        ["code", "name", "price", "qty", "total"],
+        ["F001", "Grilled Sandwich", "120.00", "2", "240.00"], [],
+        ["subtotal", "240.00"], ["discount_percent", "0"], ["discount_amount", "0.00"],
+        ["subtotal_after_discount", "240.00"], ["gst_percent", "18"], ["gst_total", "43.20"],
+        ["cgst", "21.60"], ["sgst", "21.60"], ["grand_total", "283.20"], ["points_awarded", "28"],
+        ["payment_status", "paid"],
+    ]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows(rows)
+def test_return_against_legacy_invoice(shop):
+    path = os.path.join(engine.INVOICES_DIR, "invoice_7.csv")
+    write_legacy_invoice(path)
+    record = engine.read_invoice(path)
+    assert "customer_id" not in record.fields
+    item = record.items[0]
+    assert item["cost_price"] is None
+    products = engine.catalog_copy()
+    customers = engine.read_customers()
+    return_items = [{"code": "F001", "name": item["name"], "price": item["price"], "qty": -1,
+                     "line_total": -item["price"], "cost_price": products["F001"]["cost_price"]}]
+    return_num, return_data, levels = engine.commit_return(path, record.fields, return_items, products, customers)
+    assert return_data["customer_id"] == ""
+    assert return_data["grand_total"] == Decimal("-141.60")
+    # The customer is found by name and loses the points for the refund.
+    assert return_data["points_deducted"] == -14
+    assert customers["C001"]["loyalty_points"] == 36
+    assert levels == {"F001": 20}
+    assert products["F001"]["stock"] == 20
+    assert os.path.exists(os.path.join(engine.INVOICES_DIR, f"return_{return_num}.csv"))
+    assert engine.read_invoice(path).fields["payment_status"] == "partial/refunded"
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+from decimal import Decimal
+import checkout_engine as engine
+def test_parallel_scan_leaves_shop_files_alone(shop, monkeypatch):
+    products = engine.catalog_copy()
+    for i in range(4):
+        cart = engine.Cart()
+        cart.add("F001", "Grilled Sandwich", Decimal("120"), 1, Decimal("60"))
+        engine.checkout(cart, products, payment_status="paid")
+    conn = engine.get_db()
+    meta = conn.execute("SELECT key, value FROM meta ORDER BY key").fetchall()
+    assert int(engine.meta_get(conn, "stock_changes", 0))
+    with open(engine.PRODUCTS_CSV, "rb") as f:
+        catalog = f.read()
+    stat = os.stat(engine.PRODUCTS_CSV)
+    monkeypatch.setattr(engine, "SCAN_PARALLEL_MIN", 1)
+    records = list(engine.scan_invoices(workers=2, chunk_size=1))
+    assert len(records) == 4
+    # Pool workers import checkout_engine too; exiting must not run the
+    # parent's compaction hooks.
+    assert conn.execute("SELECT key, value FROM meta ORDER BY key").fetchall() == meta
+    with open(engine.PRODUCTS_CSV, "rb") as f:
+        assert f.read() == catalog
+    assert os.stat(engine.PRODUCTS_CSV).st_mtime_ns == stat.st_mtime_ns
+def test_parallel_scan_from_a_main_script(shop):
+    # Spawned workers re-import the main script, and with it checkout_engine,
+    # before they know they are workers.
+    script = shop / "till.py"
+    script.write_text(f"""import sys
+sys.path.insert(0, {os.path.dirname(os.path.abspath(engine.__file__))!r})
+import checkout_engine as engine
+from decimal import Decimal
+if __name__ == "__main__":
+    products = engine.catalog_copy()
+    for i in range(3):
+        cart = engine.Cart()
+        cart.add("F001", "Grilled Sandwich", Decimal("120"), 1, Decimal("60"))
+        engine.checkout(cart, products, payment_status="paid")
+    with open(engine.PRODUCTS_CSV) as f:
+        before = f.read(), engine.meta_get(engine.get_db(), "stock_changes")
+    engine.SCAN_PARALLEL_MIN = 1
+    assert len(list(engine.scan_invoices(workers=2, chunk_size=1))) == 3
+    with open(engine.PRODUCTS_CSV) as f:
+        assert (f.read(), engine.meta_get(engine.get_db(), "stock_changes")) == before
+""")
+    result = subprocess.run([sys.executable, str(script)], cwd=shop, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,29 @@
+from decimal import Decimal
+import pytest
+import checkout_engine as engine
+def cart_of(code, qty):
+    cart = engine.Cart()
+    cart.add(code, code, Decimal("100"), qty, Decimal("50"))
+    return cart
+def test_stock_conflict_leaves_no_gap_in_invoice_numbers(shop):
+    products = engine.catalog_copy()
+    first, _, _, _ = engine.checkout(cart_of("F003", 4), products, payment_status="paid")
+    # Another till sells the last unit this one still thinks it has.
+    engine.apply_stock_changes({"F003": -1})
+    with pytest.raises(engine.StockConflict):
+        engine.checkout(cart_of("F003", 1), products, payment_status="paid")
+    with pytest.raises(engine.StockConflict):
+        engine.commit_sale_batch([(engine.build_invoice(cart_of("F003", 1)), {}, None)], None, products=products)
+    second, _, _, _ = engine.checkout(cart_of("F001", 1), products, payment_status="paid")
+    numbers, _ = engine.commit_sale_batch([(engine.build_invoice(cart_of("F001", 1)), {}, None)] * 2, None, products=products)
+    assert [first, second] + numbers == [first, first + 1, first + 2, first + 3]
+def test_sale_of_deleted_product_is_a_conflict(shop):
+    products = engine.catalog_copy()
+    # Another till deletes F003 from the catalog.
+    catalog = engine.catalog_copy()
+    del catalog["F003"]
+    engine.save_product_catalog(catalog)
+    with pytest.raises(engine.StockConflict) as conflict:
+        engine.checkout(cart_of("F003", 1), products, payment_status="paid")
+    assert conflict.value.shortages == {"F003": 0}
+    assert not engine.invoice_index_rows()